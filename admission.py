@@ -0,0 +1,100 @@
+import math
+import os
+
+from rq import Queue, Worker
+from rq.worker_registration import WORKERS_BY_QUEUE_KEY
+
+# Priority lanes. Workers drain queues in this order, so a single song
+# submitted interactively starts ahead of batch and playlist items, and a
+# short song is not stuck behind an hour-long mix.
+HIGH_PRIORITY = 'high'
+MEDIUM_PRIORITY = 'default'
+LONG_PRIORITY = 'long'
+LOW_PRIORITY = 'low'
+PRIORITY_QUEUES = [HIGH_PRIORITY, MEDIUM_PRIORITY, LONG_PRIORITY, LOW_PRIORITY]
+
+# Interactive downloads are routed by their probed duration: tracks up to
+# SHORT_TRACK_SECONDS (or of unknown length) take the fast lane, those up to
+# LONG_TRACK_SECONDS the default lane and anything longer the long lane
+SHORT_TRACK_SECONDS = int(os.getenv('SHORT_TRACK_SECONDS', '600'))
+LONG_TRACK_SECONDS = int(os.getenv('LONG_TRACK_SECONDS', '1800'))
+
+# Job timeouts grow with the length of the track, never below the default
+DEFAULT_TIMEOUT = 600
+TIMEOUT_PER_AUDIO_SECOND = float(os.getenv('TIMEOUT_PER_AUDIO_SECOND', '0.5'))
+
+# Running average of how long jobs take in each lane, for wait estimates.
+# Fields are '<queue>:sum' and '<queue>:count'; both are halved every
+# LANE_WINDOW jobs so the average follows recent jobs.
+LANE_SECONDS_KEY = 'tinnito:lane_seconds'
+LANE_WINDOW = 200
+
+# Rate limits in flask-limiter notation, per browser session and per IP
+SESSION_RATE_LIMIT = os.getenv('SESSION_RATE_LIMIT', '10/minute;100/hour')
+IP_RATE_LIMIT = os.getenv('IP_RATE_LIMIT', '30/minute;300/hour')
+
+# New work is refused once a queue holds this many waiting jobs, instead of
+# letting the backlog grow until users give up on it
+MAX_QUEUE_DEPTH = int(os.getenv('MAX_QUEUE_DEPTH', '200'))
+# Typical time a worker spends on one job, for the Retry-After estimate
+AVG_JOB_SECONDS = float(os.getenv('AVG_JOB_SECONDS', '30'))
+
+
+def retry_after(queue, needed=1, max_depth=MAX_QUEUE_DEPTH):
+    """Seconds until `queue` has room for `needed` more jobs, or None if it has room now"""
+    depth = queue.count
+    excess = depth + needed - max_depth
+    if excess <= 0:
+        return None
+    workers = Worker.count(queue=queue) or 1
+    return max(1, math.ceil(excess * AVG_JOB_SECONDS / workers))
+
+
+def lane(duration):
+    """Queue for an interactive download of a track lasting `duration` seconds (None if unknown)"""
+    if not duration or duration <= SHORT_TRACK_SECONDS:
+        return HIGH_PRIORITY
+    if duration <= LONG_TRACK_SECONDS:
+        return MEDIUM_PRIORITY
+    return LONG_PRIORITY
+
+
+def job_timeout(duration):
+    """Seconds a job for a track of `duration` seconds may run"""
+    return max(DEFAULT_TIMEOUT, math.ceil((duration or 0) * TIMEOUT_PER_AUDIO_SECOND))
+
+
+def record_job_seconds(conn, queue_name, seconds):
+    """Add a finished job's run time to its lane's average"""
+    pipe = conn.pipeline(transaction=False)
+    pipe.hincrbyfloat(LANE_SECONDS_KEY, f'{queue_name}:sum', seconds)
+    pipe.hincrbyfloat(LANE_SECONDS_KEY, f'{queue_name}:count', 1)
+    _, count = pipe.execute()
+    if count >= LANE_WINDOW:
+        # Not atomic with other workers' updates; an occasional lost sample is harmless
+        total = float(conn.hget(LANE_SECONDS_KEY, f'{queue_name}:sum') or 0)
+        conn.hset(LANE_SECONDS_KEY, mapping={f'{queue_name}:sum': total / 2, f'{queue_name}:count': count / 2})
+
+
+def estimated_wait(conn, queue_name):
+    """Seconds until a job queued now on `queue_name` starts, or None for a queue outside the lanes.
+
+    Workers drain the lanes in order, so everything waiting in this lane
+    and the ones before it is ahead of the new job.
+    """
+    if queue_name not in PRIORITY_QUEUES:
+        return None
+    ahead = PRIORITY_QUEUES[:PRIORITY_QUEUES.index(queue_name) + 1]
+    pipe = conn.pipeline(transaction=False)
+    for name in ahead:
+        pipe.llen(Queue(name, connection=conn).key)
+    pipe.scard(WORKERS_BY_QUEUE_KEY % queue_name)
+    pipe.hgetall(LANE_SECONDS_KEY)
+    *depths, workers, averages = pipe.execute()
+
+    averages = {field.decode(): float(value) for field, value in averages.items()}
+    work = 0.0
+    for name, depth in zip(ahead, depths):
+        count = averages.get(f'{name}:count')
+        work += depth * (averages[f'{name}:sum'] / count if count else AVG_JOB_SECONDS)
+    return math.ceil(work / max(1, workers))
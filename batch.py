@@ -0,0 +1,210 @@
+import json
+import os
+from urllib.parse import urlparse, parse_qs
+
+from rq import Queue
+
+import admission
+import cache
+import progress
+import storage
+
+# A batch is a list of URLs processed as separate jobs, at most `concurrency`
+# at a time. Items past the limit wait in a pending list and are enqueued by
+# the job that frees their slot.
+BATCH_PREFIX = 'tinnito:batch:'
+BATCH_TTL = 24 * 3600
+MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '100'))
+DEFAULT_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '3'))
+MAX_CONCURRENCY = int(os.getenv('BATCH_MAX_CONCURRENCY', '10'))
+
+
+def batch_key(batch_id, suffix=''):
+    return f"{BATCH_PREFIX}{batch_id}{suffix}"
+
+
+def item_job_id(batch_id, index):
+    return f"{batch_id}-{index}"
+
+
+def is_playlist(url):
+    """True for playlist URLs that should be expanded into their videos"""
+    parsed = urlparse(url)
+    query = parse_qs(parsed.query)
+    return 'list' in query and (parsed.path == '/playlist' or 'v' not in query)
+
+
+def _item_data(batch_id, index, url, user_id, duration=None):
+    return Queue.prepare_data(
+        'tasks.process_batch_item',
+        args=(batch_id, index, url, user_id),
+        # Scaled to the track's length when it is known, e.g. from a playlist
+        timeout=admission.job_timeout(duration),
+        job_id=item_job_id(batch_id, index)
+    )
+
+
+def create(conn, batch_id, user_id, concurrency, bundle, state='running'):
+    """Record a batch before its URLs are known (e.g. while a playlist expands)"""
+    conn.hset(batch_key(batch_id), mapping={
+        'user_id': user_id,
+        'state': state,
+        'concurrency': concurrency,
+        'bundle': int(bundle),
+        'total': 0,
+        'done': 0,
+        'failed': 0,
+    })
+    conn.expire(batch_key(batch_id), BATCH_TTL)
+
+
+def start(queue, batch_id, user_id, urls, concurrency=DEFAULT_CONCURRENCY, bundle=False, durations=None):
+    """Record a batch and enqueue its first `concurrency` items.
+
+    `durations`, if given, holds each URL's length in seconds (or None), which
+    sets its job timeout. The batch record and the jobs are written in a
+    single pipelined call.
+    """
+    urls = urls[:MAX_ITEMS]
+    durations = (durations or [None] * len(urls))[:MAX_ITEMS]
+    key = batch_key(batch_id)
+    pipe = queue.connection.pipeline()
+    pipe.hset(key, mapping={
+        'user_id': user_id,
+        'state': 'running',
+        'concurrency': concurrency,
+        'bundle': int(bundle),
+        'total': len(urls),
+        'done': 0,
+        'failed': 0,
+    })
+    pipe.rpush(key + ':urls', *urls)
+    known = {i: duration for i, duration in enumerate(durations) if duration}
+    if known:
+        pipe.hset(key + ':durations', mapping=known)
+    pending = list(range(concurrency, len(urls)))
+    if pending:
+        pipe.rpush(key + ':pending', *pending)
+    for suffix in ('', ':urls', ':durations', ':pending'):
+        pipe.expire(key + suffix, BATCH_TTL)
+    for i in range(min(concurrency, len(urls))):
+        progress.create(queue.connection, item_job_id(batch_id, i), pipeline=pipe)
+    jobs = queue.enqueue_many(
+        [_item_data(batch_id, i, url, user_id, durations[i]) for i, url in enumerate(urls[:concurrency])],
+        pipeline=pipe
+    )
+    pipe.execute()
+    return jobs
+
+
+def fail(conn, batch_id, error):
+    conn.hset(batch_key(batch_id), mapping={'state': 'failed', 'error': error})
+
+
+def finish_item(queue, batch_id, index, result):
+    """Record an item's result and hand its slot to the next pending item.
+
+    Enqueues the bundle job once the last item is done, if one was requested.
+    An item reported twice (its job and the worker that lost it) counts once.
+    """
+    conn = queue.connection
+    key = batch_key(batch_id)
+    if not conn.hsetnx(key + ':results', index, json.dumps(result)):
+        return
+    pipe = conn.pipeline()
+    pipe.expire(key + ':results', BATCH_TTL)
+    pipe.hincrby(key, 'done', 1)
+    pipe.hincrby(key, 'failed', 0 if result.get('success') else 1)
+    pipe.lpop(key + ':pending')
+    pipe.hmget(key, 'total', 'user_id', 'bundle')
+    _, done, _, next_index, (total, user_id, bundle) = pipe.execute()
+
+    if bundle == b'1' and result.get('object_key'):
+        # Cache entries last minutes; the bundle may be built hours later
+        key = cache.key_for_object(result['object_key'])
+        if key:
+            storage.keep_artifact(conn, key, BATCH_TTL)
+
+    if next_index is not None:
+        next_index = int(next_index)
+        pipe = conn.pipeline()
+        pipe.lindex(key + ':urls', next_index)
+        pipe.hget(key + ':durations', next_index)
+        url, duration = pipe.execute()
+        pipe = conn.pipeline()
+        progress.create(conn, item_job_id(batch_id, next_index), pipeline=pipe)
+        queue.enqueue_many([_item_data(batch_id, next_index, url.decode(), user_id.decode(),
+                                       float(duration) if duration else None)], pipeline=pipe)
+        pipe.execute()
+
+    if done == int(total):
+        if bundle == b'1':
+            conn.hset(key, 'state', 'bundling')
+            queue.enqueue('tasks.bundle_batch', args=(batch_id,), job_id=f"{batch_id}-bundle")
+        else:
+            conn.hset(key, 'state', 'finished')
+
+
+def finish_bundle(conn, batch_id, bundle_url, skipped):
+    """Record the built bundle and the items that could not go into it"""
+    conn.hset(batch_key(batch_id), mapping={
+        'state': 'finished',
+        'bundle_url': bundle_url,
+        'bundle_skipped': json.dumps(skipped),
+    })
+
+
+def results(conn, batch_id):
+    """Finished item results by index"""
+    return {int(i): json.loads(r) for i, r in conn.hgetall(batch_key(batch_id, ':results')).items()}
+
+
+def status(conn, batch_id):
+    """Aggregate status of a batch with per-item results, or None if unknown"""
+    key = batch_key(batch_id)
+    pipe = conn.pipeline()
+    pipe.hgetall(key)
+    pipe.lrange(key + ':urls', 0, -1)
+    pipe.hgetall(key + ':results')
+    pipe.lrange(key + ':pending', 0, -1)
+    meta, urls, finished, pending = pipe.execute()
+    if not meta:
+        return None
+
+    meta = {k.decode(): v.decode() for k, v in meta.items()}
+    finished = {int(i): json.loads(r) for i, r in finished.items()}
+    pending = {int(i) for i in pending}
+
+    # Progress of running items, read in one round trip
+    running = [i for i in range(len(urls)) if i not in finished and i not in pending]
+    pipe = conn.pipeline()
+    for i in running:
+        pipe.hgetall(progress.progress_key(item_job_id(batch_id, i)))
+    running_progress = dict(zip(running, pipe.execute()))
+
+    items = []
+    for i, url in enumerate(urls):
+        item = {'index': i, 'url': url.decode(), 'job_id': item_job_id(batch_id, i)}
+        if i in finished:
+            item.update(status='finished', progress=1.0, result=finished[i])
+        elif i in pending:
+            item.update(status='pending', progress=0)
+        else:
+            fields = running_progress[i]
+            state = fields[b'state'].decode() if b'state' in fields else 'started' if fields else 'queued'
+            item.update(status=state,
+                        progress=float(fields.get(b'progress', 0)),
+                        message=fields.get(b'message', b'').decode())
+        items.append(item)
+
+    return {
+        'id': batch_id,
+        'status': meta['state'],
+        'total': int(meta['total']),
+        'done': int(meta['done']),
+        'failed': int(meta['failed']),
+        'error': meta.get('error'),
+        'bundle_url': meta.get('bundle_url'),
+        'bundle_skipped': json.loads(meta.get('bundle_skipped', '[]')),
+        'items': items,
+    }
@@ -0,0 +1,474 @@
+"""Offline benchmark of the submit -> worker -> upload path.
+
+Runs the real Flask app, RQ jobs and tasks in one process against fakes for
+everything external: fakeredis for Redis, an in-memory stand-in for the R2
+client, and a fake yt-dlp that "extracts" generated audio fixtures served
+over a local HTTP server. Real ffmpeg is used for transcoding when it is on
+PATH; otherwise conversion is a file copy and only the plumbing is measured.
+
+    python benchmarks/bench_pipeline.py --jobs 200 --clients 20 --workers 4
+    python benchmarks/bench_pipeline.py --compare benchmarks/results/baseline.json
+
+Results are written as JSON (see --output) so runs can be compared.
+"""
+import argparse
+import contextlib
+import functools
+import http.server
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import wave
+from datetime import datetime
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import fakeredis
+import yt_dlp
+from rq import Queue, SimpleWorker
+from rq.exceptions import DequeueTimeout
+from rq.timeouts import TimerDeathPenalty
+
+import metrics
+import profiles
+from downloader import stream
+
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+def summarize(values):
+    """Count, mean and p50/p90/p99 of a list of seconds, in milliseconds"""
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean_ms': round(sum(values) / len(values) * 1000, 2),
+        'p50_ms': round(percentile(values, 50) * 1000, 2),
+        'p90_ms': round(percentile(values, 90) * 1000, 2),
+        'p99_ms': round(percentile(values, 99) * 1000, 2),
+        'max_ms': round(max(values) * 1000, 2),
+    }
+
+
+def write_fixture(path, seconds, rate=44100):
+    """A stereo 16-bit WAV of silence, `seconds` long"""
+    with wave.open(path, 'wb') as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(b'\0' * 4 * rate * int(seconds))
+
+
+class FixtureServer:
+    """Serves the fixture directory over HTTP on a free local port"""
+
+    def __init__(self, directory):
+        handler = functools.partial(QuietHandler, directory=directory)
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class FakeYoutubeDL:
+    """Enough of yt_dlp.YoutubeDL for probe.py and tasks.py, backed by the fixture server.
+
+    Every video ID maps to the same fixture file; titles and IDs still differ
+    so each submission is a cache miss.
+    """
+    fixture_url = None
+    duration = 0
+    has_ffmpeg = False
+
+    def __init__(self, params=None):
+        self.params = params or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    sanitize_info = staticmethod(yt_dlp.YoutubeDL.sanitize_info)
+
+    def extract_info(self, url, download=True):
+        video_id = url.rsplit('v=', 1)[-1][:11]
+        info = {
+            'id': video_id,
+            'extractor_key': 'Youtube',
+            'title': f'Benchmark {video_id}',
+            'duration': self.duration,
+            'url': self.fixture_url,
+            'protocol': 'http',
+            'ext': 'wav',
+            'acodec': 'pcm_s16le',
+            'abr': 1411,
+        }
+        return self.process_ie_result(info, download)
+
+    def process_ie_result(self, info, download=True):
+        info = dict(info)
+        if download:
+            info['requested_downloads'] = [{'filepath': self._download(info)}]
+        return info
+
+    def _hooks(self, name, **status):
+        for hook in self.params.get(name, []):
+            hook(status)
+
+    def _download(self, info):
+        outtmpl = self.params['outtmpl']
+        if isinstance(outtmpl, dict):
+            outtmpl = outtmpl['default']
+        path = outtmpl % {'id': info['id'], 'ext': info['ext']}
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        started = time.time()
+        downloaded = 0
+        with urllib.request.urlopen(info['url']) as response, open(path, 'wb') as out:
+            total = int(response.headers.get('Content-Length') or 0)
+            while True:
+                chunk = response.read(256 * 1024)
+                if not chunk:
+                    break
+                out.write(chunk)
+                downloaded += len(chunk)
+                self._hooks('progress_hooks', status='downloading', downloaded_bytes=downloaded,
+                            total_bytes=total, elapsed=time.time() - started)
+        self._hooks('progress_hooks', status='finished', downloaded_bytes=downloaded,
+                    total_bytes=downloaded, elapsed=time.time() - started, filename=path)
+
+        for pp in self.params.get('postprocessors', []):
+            if pp['key'] == 'FFmpegExtractAudio':
+                path = self._extract_audio(path, pp['preferredcodec'])
+        return path
+
+    def _extract_audio(self, source, codec):
+        self._hooks('postprocessor_hooks', status='started', postprocessor='ExtractAudio')
+        output = os.path.splitext(source)[0] + '.' + codec
+        if self.has_ffmpeg:
+            profile = profiles.get_profile(codec)
+            subprocess.run(stream.file_command(source, output, profile), check=True, capture_output=True)
+            os.remove(source)
+        else:
+            os.replace(source, output)
+        self._hooks('postprocessor_hooks', status='finished', postprocessor='ExtractAudio')
+        return output
+
+
+class StubR2:
+    """In-memory stand-in for the boto3 S3 client, with optional per-call latency"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def upload_file(self, path, bucket, key, ExtraArgs=None, Config=None, Callback=None):
+        with open(path, 'rb') as f:
+            self.upload_fileobj(f, bucket, key, ExtraArgs, Config, Callback)
+
+    def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None, Config=None, Callback=None):
+        size = 0
+        while True:
+            chunk = fileobj.read(8 * 1024 * 1024)
+            if not chunk:
+                break
+            size += len(chunk)
+            if Callback:
+                Callback(len(chunk))
+        time.sleep(self.latency)
+        with self.lock:
+            self.objects[key] = size
+
+    def generate_presigned_url(self, operation, Params=None, ExpiresIn=None):
+        return f"https://r2.invalid/{Params['Key']}?expires={ExpiresIn}"
+
+    def head_bucket(self, Bucket=None):
+        return {}
+
+
+class StageRecorder:
+    """Keeps every raw metrics observation so percentiles can be computed exactly"""
+
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+        self._observe = metrics.observe
+
+    def observe(self, conn, name, value, pipeline=None, **labels):
+        label = labels.get('stage') or labels.get('queue') or ''
+        with self.lock:
+            self.samples.setdefault(f"{name}:{label}", []).append(value)
+        return self._observe(conn, name, value, pipeline=pipeline, **labels)
+
+
+def worker_loop(server, queue_names, stop, job_times):
+    """Run jobs in this thread until `stop` is set, like a non-forking RQ worker"""
+    conn = fakeredis.FakeRedis(server=server)
+    queues = [Queue(name, connection=conn) for name in queue_names]
+    worker = SimpleWorker(queues, connection=conn)
+    # The default death penalty uses SIGALRM, which only works in the main thread
+    worker.death_penalty_class = TimerDeathPenalty
+    worker.register_birth()
+    try:
+        while not stop.is_set():
+            try:
+                result = Queue.dequeue_any(queues, timeout=1, connection=conn)
+            except DequeueTimeout:
+                continue
+            if not result:
+                continue
+            job, queue = result
+            started = time.monotonic()
+            worker.prepare_job_execution(job)
+            worker.perform_job(job, queue)
+            job_times.append(time.monotonic() - started)
+    finally:
+        worker.register_death()
+
+
+def client_loop(app, urls, poll_interval, wait, timings, errors):
+    """Submit each URL and poll its status until it finishes"""
+    client = app.test_client()
+    for url in urls:
+        began = time.monotonic()
+        response = client.post('/download', data={'url': url})
+        timings['submit'].append(time.monotonic() - began)
+        data = response.get_json()
+        if response.status_code != 200:
+            errors.append(data.get('error'))
+            continue
+        if 'job_id' not in data:
+            timings['end_to_end'].append(time.monotonic() - began)
+            continue
+
+        query = f"?wait={wait}" if wait else ''
+        while True:
+            polled = time.monotonic()
+            status = client.get(f"/status/{data['job_id']}{query}").get_json()
+            timings['status'].append(time.monotonic() - polled)
+            if status['status'] in ('finished', 'failed'):
+                break
+            if not wait:
+                time.sleep(poll_interval)
+        timings['end_to_end'].append(time.monotonic() - began)
+        if status['status'] == 'failed' or not (status.get('result') or {}).get('success'):
+            errors.append(status.get('error') or (status.get('result') or {}).get('error'))
+
+
+def video_urls(count):
+    return [f"https://www.youtube.com/watch?v=bench{i:06d}" for i in range(count)]
+
+
+def run(jobs=50, clients=10, workers=2, fixture_seconds=30, poll_interval=0.05, wait=0,
+        streaming=None, r2_latency=0.0):
+    """Run one benchmark and return its results as a dict"""
+    has_ffmpeg = shutil.which('ffmpeg') is not None
+    streaming = has_ffmpeg if streaming is None else streaming
+    server = fakeredis.FakeServer()
+    conn = fakeredis.FakeRedis(server=server)
+    r2 = StubR2(r2_latency)
+    recorder = StageRecorder()
+
+    previous_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir, contextlib.ExitStack() as patches:
+        # Jobs write temp files relative to the working directory
+        os.chdir(work_dir)
+        patches.callback(os.chdir, previous_dir)
+
+        fixture_dir = os.path.join(work_dir, 'fixtures')
+        os.makedirs(fixture_dir)
+        write_fixture(os.path.join(fixture_dir, 'source.wav'), fixture_seconds)
+        fixtures = patches.enter_context(FixtureServer(fixture_dir))
+
+        FakeYoutubeDL.fixture_url = fixtures.url + '/source.wav'
+        FakeYoutubeDL.duration = fixture_seconds
+        FakeYoutubeDL.has_ffmpeg = has_ffmpeg
+
+        import events
+        import storage
+        import tasks
+        import url_server
+
+        patches.enter_context(mock.patch.dict(os.environ, {'R2_BUCKET': 'bench'}))
+        patches.enter_context(mock.patch.object(yt_dlp, 'YoutubeDL', FakeYoutubeDL))
+        patches.enter_context(mock.patch.object(metrics, 'observe', recorder.observe))
+        patches.enter_context(mock.patch.object(tasks, 'get_r2_client', lambda: r2))
+        patches.enter_context(mock.patch.object(tasks, 'STREAMING_UPLOADS', streaming))
+        patches.enter_context(mock.patch.object(storage, 'get_r2_client', lambda: r2))
+        patches.enter_context(mock.patch.object(url_server, 'redis_conn', conn))
+        patches.enter_context(mock.patch.object(url_server, 'event_hub', events.Hub(conn)))
+        patches.callback(url_server.event_hub.stop)
+        for name in ('high_q', 'default_q', 'long_q', 'low_q', 'fetch_q'):
+            queue = getattr(url_server, name)
+            patches.enter_context(mock.patch.object(url_server, name, Queue(queue.name, connection=conn)))
+        # Measure the pipeline, not admission control
+        patches.enter_context(mock.patch.object(url_server.limiter, 'enabled', False))
+        patches.enter_context(mock.patch.object(url_server, 'queue_full', lambda *args: None))
+
+        stop = threading.Event()
+        job_times = []
+        queue_names = ['high', 'default', 'long', 'low', 'fetch', 'transcode', 'upload']
+        worker_threads = [
+            threading.Thread(target=worker_loop, args=(server, queue_names, stop, job_times), daemon=True)
+            for _ in range(workers)
+        ]
+        for thread in worker_threads:
+            thread.start()
+
+        timings = {'submit': [], 'status': [], 'end_to_end': []}
+        errors = []
+        urls = video_urls(jobs)
+        client_threads = [
+            threading.Thread(target=client_loop, args=(url_server.app, urls[i::clients], poll_interval,
+                                                       wait, timings, errors))
+            for i in range(clients)
+        ]
+        started = time.monotonic()
+        for thread in client_threads:
+            thread.start()
+        for thread in client_threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+
+        stop.set()
+        for thread in worker_threads:
+            thread.join()
+
+    return {
+        'timestamp': datetime.now().isoformat(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {
+            'jobs': jobs,
+            'clients': clients,
+            'workers': workers,
+            'fixture_seconds': fixture_seconds,
+            'poll_interval': poll_interval,
+            'wait': wait,
+            'streaming': streaming,
+            'ffmpeg': has_ffmpeg,
+            'r2_latency': r2_latency,
+            'pipeline_mode': os.environ.get('PIPELINE_MODE', 'single'),
+        },
+        'elapsed_s': round(elapsed, 3),
+        'throughput_jobs_per_s': round(len(timings['end_to_end']) / elapsed, 3) if elapsed else None,
+        'errors': len(errors),
+        'error_samples': sorted(set(map(str, errors)))[:5],
+        'web': {name: summarize(values) for name, values in timings.items()},
+        'worker': {
+            'job': summarize(job_times),
+            **{name: summarize(values) for name, values in sorted(recorder.samples.items())},
+        },
+        'uploaded_objects': len(r2.objects),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(baseline, current):
+    """Print p50/p99 changes between two result files"""
+    def rows(results):
+        for section in ('web', 'worker'):
+            for name, stats in results.get(section, {}).items():
+                yield f"{section}.{name}", stats
+
+    old = dict(rows(baseline))
+    print(f"{'metric':48} {'p50 ms':>20} {'p99 ms':>20}")
+    for name, stats in rows(current):
+        before = old.get(name, {})
+        cells = []
+        for key in ('p50_ms', 'p99_ms'):
+            now, then = stats.get(key), before.get(key)
+            if now is None:
+                cells.append(f"{'-':>20}")
+            elif not then:
+                cells.append(f"{now:>20}")
+            else:
+                cells.append(f"{f'{then} -> {now} ({(now - then) / then:+.0%})':>20}")
+        print(f"{name:48} {cells[0]} {cells[1]}")
+    print(f"throughput: {baseline.get('throughput_jobs_per_s')} -> {current.get('throughput_jobs_per_s')} jobs/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--jobs', type=int, default=50, help='downloads to submit')
+    parser.add_argument('--clients', type=int, default=10, help='concurrent web clients')
+    parser.add_argument('--workers', type=int, default=2, help='worker threads')
+    parser.add_argument('--fixture-seconds', type=int, default=30, help='length of the source audio')
+    parser.add_argument('--poll-interval', type=float, default=0.05, help='seconds between /status polls')
+    parser.add_argument('--wait', type=float, default=0, help='long-poll /status?wait= instead of polling')
+    parser.add_argument('--no-streaming', action='store_true', help='force the temp-file path')
+    parser.add_argument('--r2-latency', type=float, default=0.0, help='seconds added to each upload')
+    parser.add_argument('--output', help='result file (default: benchmarks/results/<timestamp>.json)')
+    parser.add_argument('--compare', help='earlier result file to compare against')
+    args = parser.parse_args()
+
+    results = run(
+        jobs=args.jobs,
+        clients=args.clients,
+        workers=args.workers,
+        fixture_seconds=args.fixture_seconds,
+        poll_interval=args.poll_interval,
+        wait=args.wait,
+        streaming=False if args.no_streaming else None,
+        r2_latency=args.r2_latency,
+    )
+
+    output = args.output or os.path.join(RESULTS_DIR, datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print(json.dumps({k: results[k] for k in ('elapsed_s', 'throughput_jobs_per_s', 'errors')}))
+    for section in ('web', 'worker'):
+        for name, stats in results[section].items():
+            if stats['count']:
+                print(f"{section}.{name:40} n={stats['count']:<6} p50={stats['p50_ms']}ms p99={stats['p99_ms']}ms")
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+import re
+import time
+from urllib.parse import urlparse, parse_qs
+
+import locks
+
+# Finished files are shared between users: one R2 object per
+# extractor + video ID + codec/quality, indexed in Redis.
+ARTIFACT_PREFIX = 'tinnito:artifact:'
+ARTIFACT_TTL = 900  # matches the presigned URL lifetime
+
+# Artifacts being produced right now, mapped to the job producing them, so
+# identical submissions attach to that job instead of starting another
+INFLIGHT_PREFIX = 'tinnito:inflight:'
+INFLIGHT_TTL = 1800  # outlives queue wait plus the default job timeout; longer jobs claim longer
+
+DEFAULT_CODEC = 'mp3'
+DEFAULT_QUALITY = '192'
+
+_YOUTUBE_ID = re.compile(r'^[A-Za-z0-9_-]{11}$')
+_YOUTUBE_HOSTS = ('youtube.com', 'www.youtube.com', 'm.youtube.com', 'music.youtube.com')
+
+
+def parse_video_id(url):
+    """Return (extractor, video_id) for URLs we can recognise without extraction"""
+    try:
+        parsed = urlparse(url.strip())
+    except (AttributeError, ValueError):
+        return None
+
+    host = (parsed.hostname or '').lower()
+    video_id = None
+    if host in ('youtu.be', 'www.youtu.be'):
+        video_id = parsed.path.lstrip('/').split('/')[0]
+    elif host in _YOUTUBE_HOSTS:
+        if parsed.path == '/watch':
+            video_id = parse_qs(parsed.query).get('v', [None])[0]
+        else:
+            parts = parsed.path.strip('/').split('/')
+            if len(parts) >= 2 and parts[0] in ('shorts', 'embed', 'live', 'v'):
+                video_id = parts[1]
+
+    if video_id and _YOUTUBE_ID.match(video_id):
+        return ('youtube', video_id)
+    return None
+
+
+def artifact_key(extractor, video_id, codec=DEFAULT_CODEC, quality=DEFAULT_QUALITY):
+    """Build the cache key for a finished file"""
+    return f"{extractor.lower()}:{video_id}:{codec}-{quality}"
+
+
+def object_key(key):
+    """R2 object key for a cached artifact"""
+    extractor, video_id, variant = key.split(':', 2)
+    codec = variant.split('-', 1)[0]
+    return f"cache/{extractor}/{video_id}/{variant}.{codec}"
+
+
+def lookup(conn, key):
+    """Return the cached artifact entry or None"""
+    entry = conn.hgetall(ARTIFACT_PREFIX + key)
+    if not entry:
+        return None
+    return {k.decode(): v.decode() for k, v in entry.items()}
+
+
+def store(conn, key, title, ttl=ARTIFACT_TTL):
+    """Record a freshly uploaded artifact, kept for `ttl` seconds"""
+    redis_key = ARTIFACT_PREFIX + key
+    expires_at = time.time() + ttl
+    pipe = conn.pipeline()
+    pipe.hset(redis_key, mapping={
+        'object_key': object_key(key),
+        'title': title,
+        'created_at': time.time(),
+        'expires_at': expires_at,
+    })
+    pipe.expire(redis_key, ttl)
+    pipe.execute()
+    return expires_at
+
+
+def acquire(conn, key, ttl=ARTIFACT_TTL):
+    """Extend a cached artifact for one more presigned URL.
+
+    Every URL handed out is valid for `ttl` seconds, so the entry (and the
+    object behind it) must outlive the newest one; an entry held for longer,
+    e.g. for a batch bundle, is never shortened. Returns the entry, or None if
+    the artifact is gone.
+    """
+    redis_key = ARTIFACT_PREFIX + key
+    held_until = conn.hget(redis_key, 'expires_at')
+    expires_at = max(time.time() + ttl, float(held_until or 0))
+    pipe = conn.pipeline()
+    pipe.exists(redis_key)
+    pipe.hset(redis_key, 'expires_at', expires_at)
+    pipe.expireat(redis_key, int(expires_at) + 1)
+    pipe.hgetall(redis_key)
+    exists, _, _, entry = pipe.execute()
+    if not exists or b'object_key' not in entry:
+        # Raced with expiry; drop the half-written entry
+        conn.delete(redis_key)
+        return None
+    return {k.decode(): v.decode() for k, v in entry.items()}
+
+
+def key_for_object(r2_key):
+    """The artifact key of a cached object, or None for other objects"""
+    if not r2_key.startswith('cache/'):
+        return None
+    _, extractor, video_id, filename = r2_key.split('/', 3)
+    variant = filename.rsplit('.', 1)[0]
+    return f"{extractor}:{video_id}:{variant}"
+
+
+def is_live(conn, r2_key):
+    """True if a cached object is still needed by an unexpired URL"""
+    key = key_for_object(r2_key)
+    return bool(key and conn.exists(ARTIFACT_PREFIX + key))
+
+
+def claim(conn, key, job_id, ttl=INFLIGHT_TTL):
+    """Mark `key` as in flight for `job_id`.
+
+    Returns None if the claim succeeded, else the ID of the job that already
+    holds it.
+    """
+    return locks.claim(conn, INFLIGHT_PREFIX + key, job_id, ttl)
+
+
+def take_over(conn, key, stale_job_id, job_id, ttl=INFLIGHT_TTL):
+    """Replace a claim whose job died without releasing it; False if someone else got there first"""
+    return locks.compare_and_set(conn, INFLIGHT_PREFIX + key, stale_job_id, job_id, ttl)
+
+
+def release(conn, key, job_id):
+    """Drop the in-flight marker for `key`, if `job_id` still holds it"""
+    return locks.compare_and_set(conn, INFLIGHT_PREFIX + key, job_id, None)
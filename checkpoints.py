@@ -0,0 +1,61 @@
+import os
+
+import locks
+
+# How far a download has got, per artifact, so a retry or a resubmission of
+# the same video picks up where the last attempt stopped instead of starting
+# over. The files themselves stay in the artifact's work directory.
+CHECKPOINT_PREFIX = 'tinnito:checkpoint:'
+# Also how long an abandoned work directory is kept on disk
+CHECKPOINT_TTL = int(os.getenv('CHECKPOINT_TTL', str(6 * 3600)))
+
+# Only the job holding an artifact's lease writes to its work directory and
+# checkpoint; another job for the same artifact waits for it
+LEASE_PREFIX = 'tinnito:lease:'
+
+# In the order they are reached
+DOWNLOADED = 'downloaded'
+ENCODED = 'encoded'
+UPLOADED = 'uploaded'
+STAGES = (DOWNLOADED, ENCODED, UPLOADED)
+
+
+def checkpoint_key(key):
+    return CHECKPOINT_PREFIX + key
+
+
+def load(conn, key):
+    """The last checkpoint of an artifact ({} if none): its stage and the file it left behind"""
+    return {k.decode(): v.decode() for k, v in conn.hgetall(checkpoint_key(key)).items()}
+
+
+def save(conn, key, stage, path=''):
+    pipe = conn.pipeline(transaction=False)
+    pipe.hset(checkpoint_key(key), mapping={'stage': stage, 'path': path})
+    pipe.expire(checkpoint_key(key), CHECKPOINT_TTL)
+    pipe.execute()
+
+
+def clear(conn, key):
+    conn.delete(checkpoint_key(key))
+
+
+def lease(conn, key, job_id, ttl):
+    """Take the lease on an artifact; returns None if taken, else the ID of the job holding it"""
+    return locks.claim(conn, LEASE_PREFIX + key, job_id, ttl)
+
+
+def take_over_lease(conn, key, stale_job_id, job_id, ttl):
+    """Replace the lease of a job that ended without releasing it; False if someone else got there first"""
+    return locks.compare_and_set(conn, LEASE_PREFIX + key, stale_job_id, job_id, ttl)
+
+
+def release_lease(conn, key, job_id):
+    return locks.compare_and_set(conn, LEASE_PREFIX + key, job_id, None)
+
+
+def reached(checkpoint, stage):
+    """True if `checkpoint` is at `stage` or later and the file it names (if any) still exists"""
+    if checkpoint.get('stage') not in STAGES or STAGES.index(checkpoint['stage']) < STAGES.index(stage):
+        return False
+    return not checkpoint.get('path') or os.path.exists(checkpoint['path'])
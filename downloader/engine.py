@@ -0,0 +1,126 @@
+import threading
+from contextlib import contextmanager
+
+import yt_dlp
+
+import profiles
+from downloader import ranged
+
+# Options every download shares; profiles add format selection and conversion
+BASE_OPTIONS = {
+    'noplaylist': True,
+    'quiet': True,
+    'no_warnings': True,
+    'concurrent_fragment_downloads': ranged.CONCURRENCY,
+}
+DEFAULT_OUTTMPL = '%(id)s.%(ext)s'
+# On top of those, for YoutubeDLs that only extract metadata, by purpose
+EXTRACT_OPTIONS = {
+    # Checking a submitted URL before it is queued
+    'probe': {'format': 'bestaudio/best', 'socket_timeout': 10},
+    # Listing a playlist's videos without resolving each one
+    'playlist': {'extract_flat': 'in_playlist', 'noplaylist': False},
+}
+
+_local = threading.local()
+
+
+def options(profile=None, convert=True, **extra):
+    """yt-dlp options for a profile; without `convert`, only its source format is selected"""
+    opts = dict(BASE_OPTIONS)
+    if profile:
+        opts.update(profiles.ydl_options(profile) if convert else {'format': profile['format']})
+    opts.update(extra)
+    return opts
+
+
+class Engine:
+    """A YoutubeDL kept warm across jobs.
+
+    Building one loads the extractor list, the cookie jar and the URL opener,
+    and the first use of an extractor initializes it; a worker that keeps
+    the instance pays for that once instead of on every job. Per-job output
+    paths and hooks are swapped in by `job()`.
+    """
+
+    def __init__(self, profile=None, convert=True):
+        self.profile = profile
+        self.progress_hooks = []
+        self.postprocessor_hooks = []
+        self.ydl = yt_dlp.YoutubeDL(options(
+            profile,
+            convert,
+            outtmpl={'default': DEFAULT_OUTTMPL},
+            progress_hooks=[self._on_progress],
+            postprocessor_hooks=[self._on_postprocess],
+        ))
+
+    def _on_progress(self, d):
+        for hook in self.progress_hooks:
+            hook(d)
+
+    def _on_postprocess(self, d):
+        for hook in self.postprocessor_hooks:
+            hook(d)
+
+    def warm(self, extractor='Youtube'):
+        """Create and initialize an extractor ahead of the first job"""
+        self.ydl.get_info_extractor(extractor).initialize()
+
+    @contextmanager
+    def job(self, outtmpl=DEFAULT_OUTTMPL, progress_hooks=(), postprocessor_hooks=()):
+        """The YoutubeDL, set up to write to `outtmpl` and report to the given hooks"""
+        self.output(outtmpl)
+        self.progress_hooks = list(progress_hooks)
+        self.postprocessor_hooks = list(postprocessor_hooks)
+        try:
+            yield self.ydl
+        except Exception:
+            # Whatever state the failure left behind is not carried into the next job
+            discard(self)
+            raise
+        finally:
+            self.progress_hooks = []
+            self.postprocessor_hooks = []
+            self.output(DEFAULT_OUTTMPL)
+
+    def output(self, outtmpl):
+        """Change where downloads are written, e.g. once extraction has identified the video"""
+        self.ydl.params['outtmpl']['default'] = outtmpl
+
+
+def _engines():
+    if not hasattr(_local, 'engines'):
+        _local.engines = {}
+    return _local.engines
+
+
+def get_engine(profile=None, convert=True):
+    """This thread's engine for a profile, created on first use"""
+    key = (profile['name'] if profile else None, convert)
+    engines = _engines()
+    if key not in engines:
+        engines[key] = Engine(profile, convert)
+    return engines[key]
+
+
+def extractor(purpose, **extra):
+    """This thread's YoutubeDL for extracting metadata only (see EXTRACT_OPTIONS), created on first use"""
+    key = (purpose, tuple(sorted(extra.items())))
+    engines = _engines()
+    if key not in engines:
+        engines[key] = yt_dlp.YoutubeDL(options(**{**EXTRACT_OPTIONS[purpose], **extra}))
+    return engines[key]
+
+
+def discard(engine):
+    engines = _engines()
+    for key, cached in list(engines.items()):
+        if cached is engine:
+            del engines[key]
+
+
+def warm(profile_names=None):
+    """Build and initialize engines before the first job arrives"""
+    for name in profile_names or [profiles.DEFAULT_PROFILE]:
+        get_engine(profiles.get_profile(name)).warm()
@@ -0,0 +1,190 @@
+import os
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPException
+
+# Some hosts throttle each connection, so a single stream is slow however
+# fast the link is. Fetching byte ranges over several connections at once
+# gets around that.
+CONCURRENCY = int(os.getenv('DOWNLOAD_CONCURRENCY', '4'))
+CHUNK_SIZE = int(float(os.getenv('DOWNLOAD_CHUNK_MB', '4')) * 1024 * 1024)
+RETRIES = int(os.getenv('DOWNLOAD_RETRIES', '3'))
+BLOCK_SIZE = 64 * 1024
+
+CONTENT_RANGE = re.compile(r'bytes (\d+)-(\d+)/(\d+)')
+
+
+class FetchError(IOError):
+    """The source could not be downloaded completely"""
+
+
+# Chunks already written to a partial download are listed in this file next
+# to it, so a later attempt only fetches the rest
+JOURNAL_SUFFIX = '.ranges'
+
+
+class RangedFetcher:
+    """Download a URL over several connections into a preallocated file.
+
+    Each chunk is a separate Range request. A chunk whose connection fails
+    is resumed from the last byte written rather than restarted, and chunks
+    finished by an earlier, failed attempt at the same file are skipped.
+    Servers that ignore Range are read over a single connection instead.
+    """
+
+    def __init__(self, url, headers=None, concurrency=CONCURRENCY, chunk_size=CHUNK_SIZE,
+                 retries=RETRIES, timeout=30):
+        self.url = url
+        self.headers = dict(headers or {})
+        self.concurrency = max(1, concurrency)
+        self.chunk_size = max(BLOCK_SIZE, chunk_size)
+        self.retries = retries
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._downloaded = 0
+        self._progress = None
+        self._total = None
+
+    def _open(self, start=None, end=None):
+        headers = dict(self.headers)
+        if start is not None:
+            headers['Range'] = f'bytes={start}-{"" if end is None else end}'
+        request = urllib.request.Request(self.url, headers=headers)
+        return urllib.request.urlopen(request, timeout=self.timeout)
+
+    def _advance(self, nbytes):
+        with self._lock:
+            self._downloaded += nbytes
+            downloaded = self._downloaded
+        if self._progress:
+            self._progress(downloaded, self._total)
+
+    def fetch(self, path, progress=None, resume=True):
+        """Download to `path` and return its size. `progress(downloaded, total)` is called as bytes arrive."""
+        self._progress = progress
+        self._downloaded = 0
+        journal = path + JOURNAL_SUFFIX
+
+        response = self._open(0, self.chunk_size - 1)
+        match = CONTENT_RANGE.match(response.headers.get('Content-Range', ''))
+        if response.status != 206 or not match:
+            # No range support: the response is the whole file
+            length = response.headers.get('Content-Length')
+            self._total = int(length) if length else None
+            with response, open(path, 'wb') as f:
+                self._copy(response, f.fileno(), 0)
+            if self._total is not None and self._downloaded != self._total:
+                raise FetchError(f'Expected {self._total} bytes, got {self._downloaded}')
+            return self._downloaded
+
+        self._total = total = int(match.group(3))
+        done = read_journal(journal, path, total) if resume else set()
+        if not done:
+            with open(path, 'wb') as f:
+                f.truncate(total)
+            with open(journal, 'w') as f:
+                f.write(f'{total}\n')
+        self._downloaded = sum(end - start + 1 for start, end in done)
+
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            # The probe already carries the first chunk
+            first = (0, int(match.group(2)))
+            if first in done:
+                response.close()
+            else:
+                before = self._downloaded
+                try:
+                    with response:
+                        self._copy(response, fd, 0)
+                except (HTTPException, OSError):
+                    pass
+                written = self._downloaded - before
+                if written < first[1] + 1:
+                    self._fetch_range(fd, written, first[1])
+                self._record(journal, first)
+
+            chunks = [(start, min(start + self.chunk_size, total) - 1)
+                      for start in range(first[1] + 1, total, self.chunk_size)]
+            with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                futures = [pool.submit(self._fetch_chunk, fd, chunk, journal)
+                           for chunk in chunks if chunk not in done]
+                for future in futures:
+                    future.result()
+        finally:
+            os.close(fd)
+
+        if self._downloaded != total:
+            raise FetchError(f'Expected {total} bytes, got {self._downloaded}')
+        os.remove(journal)
+        return total
+
+    def _fetch_chunk(self, fd, chunk, journal):
+        self._fetch_range(fd, *chunk)
+        self._record(journal, chunk)
+
+    def _record(self, journal, chunk):
+        # Only after the chunk is fully written; a line cut short by a crash is ignored on read
+        with self._lock, open(journal, 'a') as f:
+            f.write(f'{chunk[0]}-{chunk[1]}\n')
+
+    def _copy(self, response, fd, offset):
+        """Write a response body at `offset`; returns the number of bytes written"""
+        written = 0
+        while True:
+            block = response.read(BLOCK_SIZE)
+            if not block:
+                return written
+            os.pwrite(fd, block, offset + written)
+            written += len(block)
+            self._advance(len(block))
+
+    def _fetch_range(self, fd, start, end):
+        offset = start
+        failures = 0
+        while offset <= end:
+            try:
+                with self._open(offset, end) as response:
+                    if response.status != 206:
+                        raise FetchError(f'Server ignored the range request (HTTP {response.status})')
+                    # Track the offset per block so a dropped connection resumes where it stopped
+                    while offset <= end:
+                        block = response.read(min(BLOCK_SIZE, end - offset + 1))
+                        if not block:
+                            break
+                        os.pwrite(fd, block, offset)
+                        offset += len(block)
+                        self._advance(len(block))
+                if offset <= end:
+                    raise ConnectionError(f'Connection closed at byte {offset} of {end + 1}')
+            except FetchError:
+                raise
+            except (urllib.error.URLError, HTTPException, OSError) as e:
+                if isinstance(e, urllib.error.HTTPError) and e.code < 500 and e.code != 429:
+                    raise FetchError(f'HTTP {e.code} fetching bytes {offset}-{end}') from e
+                failures += 1
+                if failures > self.retries:
+                    raise FetchError(f'Giving up on bytes {offset}-{end}: {e}') from e
+                time.sleep(min(2 ** failures * 0.1, 2))
+
+
+def read_journal(journal, path, total):
+    """Chunks an earlier attempt finished writing to `path`, or an empty set if it cannot be resumed"""
+    try:
+        with open(journal) as f:
+            lines = f.read().split('\n')
+        if int(lines[0]) != total or os.path.getsize(path) != total:
+            return set()
+    except (OSError, ValueError):
+        return set()
+    done = set()
+    # The last element is either empty or a line whose write was cut short
+    for line in lines[1:-1]:
+        start, _, end = line.partition('-')
+        if start.isdigit() and end.isdigit():
+            done.add((int(start), int(end)))
+    return done
@@ -0,0 +1,105 @@
+import subprocess
+import threading
+
+import profiles
+
+# Protocols ffmpeg can read directly from the format URL yt-dlp resolved
+STREAMABLE_PROTOCOLS = ('http', 'https', 'm3u8', 'm3u8_native')
+
+def can_stream(info):
+    """True if the selected format can be piped through ffmpeg without a local copy"""
+    return (
+        bool(info.get('url'))
+        and info.get('protocol') in STREAMABLE_PROTOCOLS
+        and not info.get('requested_formats')
+    )
+
+
+def ffmpeg_command(info, profile, passthrough=False):
+    """Build an ffmpeg command reading the source URL and writing audio to stdout"""
+    cmd = ['ffmpeg', '-hide_banner', '-nostdin', '-loglevel', 'error']
+
+    headers = ''.join(f'{k}: {v}\r\n' for k, v in (info.get('http_headers') or {}).items())
+    if headers:
+        cmd += ['-headers', headers]
+    if info.get('protocol') in ('http', 'https'):
+        # Long tracks outlive a single connection on some hosts
+        cmd += ['-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5']
+
+    cmd += ['-i', info['url']]
+    cmd += profiles.encode_args(profile, passthrough)
+    cmd += profiles.container_args(profile, piped=True)
+    cmd += ['pipe:1']
+    return cmd
+
+
+def file_command(source, output, profile, passthrough=False):
+    """Build an ffmpeg command transcoding (or remuxing) a local file"""
+    cmd = ['ffmpeg', '-hide_banner', '-nostdin', '-loglevel', 'error', '-y', '-i', source]
+    cmd += profiles.encode_args(profile, passthrough)
+    cmd += profiles.container_args(profile)
+    cmd += [output]
+    return cmd
+
+
+class TranscodeStream:
+    """Read-only file object over the stdout of a transcoding process.
+
+    Hand it to `upload_fileobj` so parts are uploaded while ffmpeg is still
+    encoding. If the process fails, reading raises instead of returning EOF,
+    so a truncated file is never completed as a multipart upload. Everything
+    read is also written to `tee`, if given.
+    """
+
+    def __init__(self, cmd, bufsize=1024 * 1024, tee=None):
+        self.cmd = cmd
+        self.bufsize = bufsize
+        self.tee = tee
+        self.bytes_read = 0
+        self._process = None
+        self._stderr = []
+        self._stderr_thread = None
+
+    def __enter__(self):
+        self._process = subprocess.Popen(
+            self.cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            bufsize=self.bufsize
+        )
+        # Drain stderr so a chatty process never blocks on a full pipe
+        self._stderr_thread = threading.Thread(target=self._drain_stderr, daemon=True)
+        self._stderr_thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._process.poll() is None:
+            self._process.kill()
+        self._process.wait()
+        self._process.stdout.close()
+        self._stderr_thread.join(timeout=1)
+        return False
+
+    def _drain_stderr(self):
+        for line in self._process.stderr:
+            self._stderr.append(line.decode(errors='replace').rstrip())
+        self._process.stderr.close()
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        data = self._process.stdout.read(size)
+        if data:
+            self.bytes_read += len(data)
+            if self.tee is not None:
+                self.tee.write(data)
+            return data
+
+        returncode = self._process.wait()
+        if returncode != 0:
+            self._stderr_thread.join(timeout=1)
+            error = self._stderr[-1] if self._stderr else f'exit code {returncode}'
+            raise IOError(f'Transcoding failed: {error}')
+        return data
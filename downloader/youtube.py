@@ -1,28 +1,25 @@
-import yt_dlp
 import os
 
-def download_song(url, user_id=None):
+import profiles
+from downloader import engine
+
+def download_song(url, user_id=None, profile_name=None):
     """Download a song from YouTube URL"""
+    profile = profiles.get_profile(profile_name)
+    if not profile:
+        return {
+            'success': False,
+            'error': f"Unknown format: {profile_name}"
+        }
+
     # Create user-specific directory
     output_dir = os.path.join('mpthrees', user_id) if user_id else 'mpthrees'
     os.makedirs(output_dir, exist_ok=True)
-    
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': '192',
-        }],
-        'outtmpl': os.path.join(output_dir, '%(title)s.%(ext)s'),
-        'quiet': True,
-        'no_warnings': True
-    }
-    
+
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        with engine.get_engine(profile).job(os.path.join(output_dir, '%(title)s.%(ext)s')) as ydl:
             info = ydl.extract_info(url, download=True)
-            song_path = os.path.join(output_dir, f"{info['title']}.mp3")
+            song_path = info['requested_downloads'][0]['filepath']
             return {
                 'success': True,
                 'file_path': song_path,
@@ -0,0 +1,180 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+# Job progress is pushed to clients over Redis pub/sub, one channel per job.
+# Every message has the same shape as the /status/<job_id> response.
+CHANNEL_PREFIX = 'tinnito:events:'
+TERMINAL_STATES = ('finished', 'failed', 'stopped', 'canceled')
+
+logger = logging.getLogger('tinnito.events')
+
+
+def channel(job_id):
+    return CHANNEL_PREFIX + job_id
+
+
+def publish(conn, job_id, status, pipeline=None):
+    """Publish a status update for a job"""
+    (pipeline or conn).publish(channel(job_id), json.dumps(status))
+
+
+def is_terminal(status):
+    return status.get('status') in TERMINAL_STATES
+
+
+def format_sse(status):
+    """Encode a status update as a Server-Sent Event"""
+    return f"event: status\ndata: {json.dumps(status)}\n\n"
+
+
+class Hub:
+    """Fans one Redis pattern subscription out to every listener in the process.
+
+    Without it each open event stream or long-poll holds its own pub/sub
+    connection, so thousands of idle clients mean thousands of connections.
+    The subscription runs on a background thread (a greenlet under gevent),
+    started on first use and again after a fork.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._listeners = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+
+    def subscribe(self, job_id):
+        """Register a listener for a job; returns the queue its updates arrive on"""
+        self._ensure_running()
+        updates = queue.Queue()
+        with self._lock:
+            self._listeners.setdefault(job_id, set()).add(updates)
+        return updates
+
+    def unsubscribe(self, job_id, updates):
+        with self._lock:
+            listeners = self._listeners.get(job_id)
+            if listeners:
+                listeners.discard(updates)
+                if not listeners:
+                    del self._listeners[job_id]
+
+    def listener_count(self):
+        with self._lock:
+            return sum(len(listeners) for listeners in self._listeners.values())
+
+    def stop(self):
+        self._stopping = True
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def _ensure_running(self):
+        with self._lock:
+            if self._pid != os.getpid() or not self._thread.is_alive():
+                self._pid = os.getpid()
+                self._listeners = {}
+                self._ready.clear()
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        # Updates published before the subscription is active would be lost
+        self._ready.wait(timeout=5)
+
+    def _run(self):
+        while not self._stopping:
+            pubsub = self.conn.pubsub()
+            try:
+                pubsub.psubscribe(CHANNEL_PREFIX + '*')
+                while not self._stopping:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is None:
+                        continue
+                    if message['type'] == 'psubscribe':
+                        self._ready.set()
+                    elif message['type'] == 'pmessage':
+                        self._dispatch(message['channel'], message['data'])
+            except Exception as e:
+                logger.warning('Event hub connection lost, reconnecting: %s', e)
+                self._ready.clear()
+                time.sleep(1)
+            finally:
+                pubsub.close()
+
+    def _dispatch(self, name, data):
+        if isinstance(name, bytes):
+            name = name.decode()
+        with self._lock:
+            listeners = list(self._listeners.get(name[len(CHANNEL_PREFIX):], ()))
+        if listeners:
+            status = json.loads(data)
+            for updates in listeners:
+                updates.put(status)
+
+
+def listen(conn, job_id, snapshot, timeout, heartbeat=15, hub=None):
+    """Yield status updates for a job until it ends or `timeout` seconds pass.
+
+    `snapshot()` returns the job's current status. It is read once after
+    subscribing, so updates published in between are not lost, and again
+    whenever the channel has been quiet for `heartbeat` seconds, which catches
+    jobs that died without publishing a result. Yields None on a quiet
+    heartbeat so callers can keep the connection alive. With a `hub`, updates
+    come through its shared subscription instead of a connection of our own.
+    """
+    if hub is not None:
+        updates = hub.subscribe(job_id)
+
+        def next_update(wait):
+            try:
+                return updates.get(timeout=wait)
+            except queue.Empty:
+                return None
+
+        def close():
+            hub.unsubscribe(job_id, updates)
+    else:
+        pubsub = conn.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(channel(job_id))
+
+        def next_update(wait):
+            message = pubsub.get_message(timeout=wait)
+            return json.loads(message['data']) if message else None
+
+        close = pubsub.close
+
+    try:
+        status = snapshot()
+        yield status
+        if is_terminal(status):
+            return
+
+        deadline = time.monotonic() + timeout
+        quiet_since = time.monotonic()
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            status = next_update(min(remaining, 1.0))
+            if status is None:
+                if time.monotonic() - quiet_since < heartbeat:
+                    continue
+                quiet_since = time.monotonic()
+                status = snapshot()
+                if is_terminal(status):
+                    yield status
+                    return
+                yield None
+                continue
+
+            quiet_since = time.monotonic()
+            yield status
+            if is_terminal(status):
+                return
+    finally:
+        close()
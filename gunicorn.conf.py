@@ -1,18 +1,31 @@
 import multiprocessing
 import os
 
+# The app is preloaded in the master, so patch before it imports redis and
+# friends rather than leaving it to the forked gevent workers
+if os.getenv("WEB_WORKER_CLASS", "gevent") == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
+
 # Bind to 0.0.0.0:5000
 bind = "0.0.0.0:5000"
 
-# Worker configuration
-workers = multiprocessing.cpu_count() * 2 + 1
-worker_class = "sync"
-worker_connections = 1000
+# Worker configuration. Most requests are status polls and event streams
+# that sit waiting on Redis, so the default gevent workers serve up to
+# `worker_connections` of them each; WEB_WORKER_CLASS=sync falls back to
+# one request per process.
+worker_class = os.getenv("WEB_WORKER_CLASS", "gevent")
+if worker_class == "sync":
+    workers = multiprocessing.cpu_count() * 2 + 1
+else:
+    workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() + 1))
+worker_connections = int(os.getenv("WEB_WORKER_CONNECTIONS", "2000"))
 timeout = 30
 keepalive = 2
 
-# Logging
-accesslog = "logs/access.log"
+# Logging. Requests are logged by the app itself, as sampled JSON lines that
+# carry the request ID (see log.py), so gunicorn's own access log is off.
+accesslog = None
 errorlog = "logs/error.log"
 loglevel = "info"
 
@@ -0,0 +1,102 @@
+import os
+import threading
+import time
+from datetime import datetime
+
+# Dependency checks run on a background thread and the health endpoints only
+# read the last result, so load balancer probes never wait on Redis or R2.
+HEALTH_INTERVAL = float(os.getenv('HEALTH_INTERVAL', '10'))
+# A result older than this many intervals means the prober itself is stuck
+STALE_INTERVALS = 3
+
+
+class HealthProber:
+    """Runs named checks every `interval` seconds and caches the outcome.
+
+    `checks` maps a name to a callable that raises on failure and may return
+    a message. Started on first use and again after a fork, since gunicorn
+    preloads the app in the master.
+    """
+
+    def __init__(self, checks, interval=HEALTH_INTERVAL, logger=None, clock=time.time):
+        self.checks = checks
+        self.interval = interval
+        self.logger = logger
+        self.clock = clock
+        self._results = {}
+        self._checked_at = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stop = threading.Event()
+
+    def start(self):
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.run_checks()
+            self._stop.wait(self.interval)
+
+    def run_checks(self):
+        """Run every check now and replace the cached results"""
+        results = {}
+        for name, check in self.checks.items():
+            started = time.monotonic()
+            try:
+                message = check()
+                result = {'status': 'healthy', 'message': message or 'Connected successfully'}
+            except Exception as e:
+                result = {'status': 'unhealthy', 'error': str(e)}
+            result['latency_ms'] = round((time.monotonic() - started) * 1000, 1)
+            results[name] = result
+
+        previous = self._results
+        self._results = results
+        self._checked_at = self.clock()
+
+        # Log transitions only; probes arrive far more often than state changes
+        if self.logger:
+            for name, result in results.items():
+                if result['status'] != previous.get(name, {}).get('status', 'healthy'):
+                    log = self.logger.info if result['status'] == 'healthy' else self.logger.error
+                    log(f"Health check {name} is now {result['status']}: "
+                        f"{result.get('error') or result['message']}")
+        return results
+
+    def is_stale(self):
+        return self._checked_at is None or self.clock() - self._checked_at > self.interval * STALE_INTERVALS
+
+    def snapshot(self):
+        """The cached results in the /health response shape; checks run once if none exist yet"""
+        if self._checked_at is None:
+            self.run_checks()
+        results = self._results
+        healthy = not self.is_stale() and all(r['status'] == 'healthy' for r in results.values())
+        return {
+            'status': 'healthy' if healthy else 'unhealthy',
+            'timestamp': datetime.now().isoformat(),
+            'checked_at': datetime.fromtimestamp(self._checked_at).isoformat(),
+            'stale': self.is_stale(),
+            'checks': results,
+        }
+
+    def is_ready(self):
+        """True if every check passed on a recent run; never runs checks itself"""
+        results = self._results
+        return (
+            not self.is_stale()
+            and bool(results)
+            and all(r['status'] == 'healthy' for r in results.values())
+        )
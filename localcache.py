@@ -0,0 +1,181 @@
+import os
+import shutil
+import tempfile
+import time
+
+# Finished files are also kept on local disk (the song_storage volume in
+# docker-compose), so hot tracks are served without a round trip to R2.
+# Files are named by their R2 object key and evicted least recently used
+# first once the directory outgrows LOCAL_CACHE_MAX_MB; 0 turns it off.
+CACHE_DIR = os.getenv('LOCAL_CACHE_DIR', 'mpthrees/cache')
+MAX_BYTES = int(float(os.getenv('LOCAL_CACHE_MAX_MB', '1024')) * 1024 * 1024)
+
+# Partial copies are written under this prefix and renamed into place
+TEMP_PREFIX = '.partial-'
+# Partial copies older than this were abandoned by a crashed writer
+TEMP_MAX_AGE = 3600
+
+
+def enabled():
+    return MAX_BYTES > 0
+
+
+def path_for(object_key):
+    """Local path of an artifact, or None if the key would escape the cache directory"""
+    parts = object_key.split('/')
+    if not object_key or object_key.startswith('/') or any(part in ('', '.', '..') for part in parts):
+        return None
+    return os.path.join(CACHE_DIR, *parts)
+
+
+def get(object_key):
+    """Path of a cached artifact, marking it as recently used, or None on a miss"""
+    path = path_for(object_key)
+    if not enabled() or not path:
+        return None
+    try:
+        # Eviction goes by access time. The modification time is left alone:
+        # it is part of the ETag that clients resume interrupted downloads with.
+        os.utime(path, (time.time(), os.stat(path).st_mtime))
+    except OSError:
+        return None
+    return path
+
+
+def contains(object_key):
+    path = path_for(object_key)
+    return enabled() and bool(path) and os.path.isfile(path)
+
+
+def put(source, object_key, max_bytes=None):
+    """Copy a finished file into the cache and evict old files to make room.
+
+    Readers never see a partial file: the copy is renamed into place.
+    Returns the cached path, or None if the cache is off or the file does
+    not fit.
+    """
+    max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+    path = path_for(object_key)
+    if max_bytes <= 0 or not path or os.path.getsize(source) > max_bytes:
+        return None
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        # copyfile uses sendfile on Linux, so the data never passes through Python
+        shutil.copyfile(source, temp_path)
+    except BaseException:
+        _remove(temp_path)
+        raise
+    return _publish(temp_path, path, max_bytes)
+
+
+def _publish(temp_path, path, max_bytes):
+    try:
+        # mkstemp creates the file private; web processes must be able to read it
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        _remove(temp_path)
+        raise
+    evict(max_bytes, keep=path)
+    return path
+
+
+class Partial:
+    """A cache entry written as its data is produced, e.g. teed off a streaming upload.
+
+    Readers see nothing until `commit()`. Writing never raises: a partial
+    that outgrows the cache or hits a disk error is simply abandoned.
+    """
+
+    def __init__(self, object_key, max_bytes=None):
+        self.max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+        self.path = path_for(object_key)
+        self.size = 0
+        self.file = None
+        self.temp_path = None
+        if self.max_bytes <= 0 or not self.path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd, self.temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=os.path.dirname(self.path))
+            self.file = os.fdopen(fd, 'wb')
+        except OSError:
+            self.discard()
+
+    def write(self, data):
+        if self.file is None:
+            return
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.discard()
+            return
+        try:
+            self.file.write(data)
+        except OSError:
+            self.discard()
+
+    def commit(self):
+        """Make the finished file visible; returns its cached path, or None if it was abandoned"""
+        if self.file is None:
+            return None
+        try:
+            self.file.close()
+        except OSError:
+            self.discard()
+            return None
+        self.file = None
+        return _publish(self.temp_path, self.path, self.max_bytes)
+
+    def discard(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError:
+                pass
+            self.file = None
+        if self.temp_path:
+            _remove(self.temp_path)
+
+
+def evict(max_bytes=None, keep=None, now=None):
+    """Delete least recently used files until the cache fits in `max_bytes`; returns bytes freed.
+
+    Several processes may evict at once; a file another process already
+    removed is simply skipped.
+    """
+    max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+    now = time.time() if now is None else now
+    files = []
+    total = 0
+    for root, _, names in os.walk(CACHE_DIR):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if name.startswith(TEMP_PREFIX):
+                if now - stat.st_mtime > TEMP_MAX_AGE:
+                    _remove(path)
+                continue
+            files.append((stat.st_atime, stat.st_size, path))
+            total += stat.st_size
+
+    freed = 0
+    for _, size, path in sorted(files):
+        if total - freed <= max_bytes:
+            break
+        if path != keep and _remove(path):
+            freed += size
+    return freed
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+        return True
+    except OSError:
+        return False
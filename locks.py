@@ -0,0 +1,37 @@
+from redis.exceptions import WatchError
+
+# Ownership markers shared between jobs: a Redis string holding the ID of
+# the job that owns something (an in-flight artifact, an artifact's work
+# directory), taken with SET NX and handed over or dropped only by a caller
+# that knows the current owner.
+
+
+def claim(conn, redis_key, job_id, ttl):
+    """Take `redis_key` for `job_id`; returns None if taken, else the ID of the job holding it"""
+    while True:
+        if conn.set(redis_key, job_id, nx=True, ex=ttl):
+            return None
+        holder = conn.get(redis_key)
+        # Otherwise it expired between the two calls; try again
+        if holder:
+            return holder.decode()
+
+
+def compare_and_set(conn, redis_key, expected, value, ttl=None):
+    """Replace the holder of `redis_key` (or drop it, if `value` is None) only if it is still `expected`"""
+    with conn.pipeline() as pipe:
+        try:
+            pipe.watch(redis_key)
+            current = pipe.get(redis_key)
+            if (current.decode() if current else None) != expected:
+                pipe.unwatch()
+                return False
+            pipe.multi()
+            if value is None:
+                pipe.delete(redis_key)
+            else:
+                pipe.set(redis_key, value, ex=ttl)
+            pipe.execute()
+            return True
+        except WatchError:
+            return False
@@ -0,0 +1,502 @@
+import _queue
+import atexit
+import contextlib
+import contextvars
+import errno
+import fcntl
+import importlib
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import time
+import traceback
+from datetime import datetime, timezone
+
+# Logging shared by the web and worker processes. A log call only formats
+# the message and puts the record on an in-memory queue; a background thread
+# turns records into JSON lines and ships them. In worker processes,
+# warnings and errors are written before the call returns instead; web
+# processes never write from the request's thread. One process per host (the
+# first to take LOG_SOCKET's lock, normally the gunicorn master or the worker
+# supervisor) owns the log file and receives every other process's lines
+# over a Unix datagram socket, so no two processes ever write or rotate the
+# same file. When the owner exits, the next process to log takes over; an
+# owner that exits cleanly writes out what it was sent first, one that is
+# killed loses the lines still waiting in its socket.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FILE = os.getenv('LOG_FILE', 'logs/tinnito.log')
+LOG_SOCKET = os.getenv('LOG_SOCKET', LOG_FILE.rsplit('.', 1)[0] + '.sock')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '5'))
+# Also echo lines to the owner's stderr, for `docker logs` and local runs
+LOG_STDERR = os.getenv('LOG_STDERR', '1') == '1'
+# Records waiting to be shipped; beyond this they are dropped, not waited for
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+# Fraction of INFO and DEBUG records kept per logger (and its children), for
+# events that fire on every request or progress tick. Warnings and errors
+# are always kept. Format: "tinnito.access=0.1,tinnito.progress=0.05".
+def parse_sample_rates(value):
+    rates = {}
+    for item in value.split(','):
+        name, _, rate = item.partition('=')
+        if name.strip() and rate.strip():
+            rates[name.strip()] = min(max(float(rate), 0.0), 1.0)
+    return rates
+
+
+SAMPLE_RATES = parse_sample_rates(os.getenv('LOG_SAMPLE_RATES', 'tinnito.access=0.1,tinnito.progress=0.05'))
+
+# Datagrams larger than this are truncated rather than refused by the kernel
+MAX_LINE_BYTES = 60 * 1024
+# How often a process whose lines cannot be delivered tries to take over
+TAKEOVER_INTERVAL = 1.0
+# How long a line waits for room in the owner's socket before it is dropped
+SEND_TIMEOUT = 0.5
+# Components whose warnings and errors are written by the logging call, so a
+# process that dies right after a failure still leaves it behind. Not the web:
+# under gevent a write from the request's thread would stall every greenlet.
+SYNC_WARNING_COMPONENTS = {'worker'}
+
+# Attributes every LogRecord has; anything else came in through `extra=`
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+_job_id = contextvars.ContextVar('job_id', default=None)
+_request_id = contextvars.ContextVar('request_id', default=None)
+
+_pipeline = None
+_component = None
+
+
+def _native(module, name):
+    """The unpatched `module.name`: the shipping threads are real OS threads even under gevent"""
+    if 'gevent.monkey' in sys.modules:
+        from gevent import monkey
+        return monkey.get_original(module, name)
+    return getattr(importlib.import_module(module), name)
+
+
+@contextlib.contextmanager
+def bind(job_id=None, request_id=None):
+    """Tag every record logged inside the block with a job and/or request id"""
+    tokens = []
+    if job_id is not None:
+        tokens.append((_job_id, _job_id.set(job_id)))
+    if request_id is not None:
+        tokens.append((_request_id, _request_id.set(request_id)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+@contextlib.contextmanager
+def job(job_id):
+    """Bind a job's id while it runs, and flush its records when it ends (see `flush`)"""
+    try:
+        with bind(job_id=job_id):
+            yield
+    finally:
+        flush()
+
+
+def bind_request(request_id):
+    """Like `bind`, for hooks that cannot wrap the request in a block; returns the token for `unbind_request`"""
+    return _request_id.set(request_id)
+
+
+def unbind_request(token):
+    _request_id.reset(token)
+
+
+def current_ids():
+    return {'job_id': _job_id.get(), 'request_id': _request_id.get()}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the correlation ids and any `extra=` fields"""
+
+    def __init__(self, component=None):
+        super().__init__()
+        self.component = component
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'component': self.component,
+            'pid': record.process,
+        }
+        for name in ('job_id', 'request_id'):
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        for name, value in vars(record).items():
+            if name not in RECORD_ATTRIBUTES and name not in entry:
+                entry[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = ''.join(traceback.format_exception(*record.exc_info)).rstrip()
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep a fraction of a noisy logger's INFO and DEBUG records; the kept ones say at what rate"""
+
+    def __init__(self, rates=None, rand=random.random):
+        super().__init__()
+        self.rates = SAMPLE_RATES if rates is None else rates
+        self.rand = rand
+
+    def rate_for(self, record):
+        if hasattr(record, 'sample_rate'):
+            return record.sample_rate
+        name = record.name
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition('.')[0]
+        return 1.0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate_for(record)
+        if rate >= 1.0:
+            return True
+        record.sample_rate = rate
+        return self.rand() < rate
+
+
+class RotatingFile:
+    """An append-only file rotated by size; only ever used by the process that owns the log"""
+
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, 'a', encoding='utf-8')
+        self.size = self.file.tell()
+
+    def write(self, line):
+        if self.max_bytes and self.size and self.size + len(line) + 1 > self.max_bytes:
+            self.rotate()
+        self.file.write(line + '\n')
+        self.file.flush()
+        self.size += len(line) + 1
+
+    def rotate(self):
+        self.file.close()
+        if self.backup_count:
+            for i in range(self.backup_count - 1, 0, -1):
+                if os.path.exists(f'{self.path}.{i}'):
+                    os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.truncate(self.path, 0)
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.size = 0
+
+    def close(self):
+        self.file.close()
+
+
+class HostSink:
+    """Where this process's lines go: the log file if it owns the log, else the owner's socket"""
+
+    def __init__(self, log_file=LOG_FILE, sock_path=LOG_SOCKET, stderr=LOG_STDERR):
+        self.log_file = log_file
+        self.sock_path = sock_path
+        self.stderr = stderr
+        self.lock = _native('_thread', 'allocate_lock')()
+        self.file = None
+        self.server = None
+        self.lock_fd = None
+        self.dropped = 0
+        self._next_takeover = 0.0
+        self._socket = _native('socket', 'socket')
+        self.client = self._socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.client.settimeout(SEND_TIMEOUT)
+        self.try_take_over()
+
+    @property
+    def owner(self):
+        return self.file is not None
+
+    def try_take_over(self):
+        """Become the owner if no live process holds the lock. Locks die with their process."""
+        self._next_takeover = time.monotonic() + TAKEOVER_INTERVAL
+        try:
+            if os.path.dirname(self.sock_path):
+                os.makedirs(os.path.dirname(self.sock_path), exist_ok=True)
+            fd = os.open(self.sock_path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        try:
+            # The socket file of an owner that died is still there
+            if os.path.exists(self.sock_path):
+                os.unlink(self.sock_path)
+            server = self._socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            server.bind(self.sock_path)
+            os.chmod(self.sock_path, 0o666)
+            log_file = RotatingFile(self.log_file)
+        except OSError:
+            os.close(fd)
+            return False
+        self.lock_fd, self.server, self.file = fd, server, log_file
+        # Released when the receiving thread is done
+        self.received = _native('_thread', 'allocate_lock')()
+        self.received.acquire()
+        _native('_thread', 'start_new_thread')(self._receive, (server, self.received))
+        return True
+
+    def _receive(self, server, done):
+        try:
+            while True:
+                try:
+                    data = server.recv(MAX_LINE_BYTES + 1024)
+                except OSError:
+                    return
+                # Lines are never empty; this is close() shutting the socket
+                # down, once whatever was already queued has been read
+                if not data:
+                    return
+                self._write(data.decode('utf-8', 'replace'))
+        finally:
+            done.release()
+
+    def _write(self, line):
+        with self.lock:
+            if self.file is None:
+                return
+            try:
+                self.file.write(line)
+            except OSError:
+                pass
+            if self.stderr:
+                try:
+                    sys.stderr.write(line + '\n')
+                    sys.stderr.flush()
+                except (OSError, ValueError):
+                    pass
+
+    def write(self, line):
+        if self.owner:
+            self._write(line)
+            return
+        data = line.encode('utf-8')[:MAX_LINE_BYTES]
+        try:
+            self.client.sendto(data, self.sock_path)
+            return
+        except (BlockingIOError, socket.timeout):
+            # The owner is alive but behind
+            self.dropped += 1
+            return
+        except OSError as e:
+            if e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+                self.dropped += 1
+                return
+        # The owner is gone or going away: take over, or send once more in
+        # case another process already has
+        if time.monotonic() >= self._next_takeover and self.try_take_over():
+            self._write(line)
+            return
+        try:
+            self.client.sendto(data, self.sock_path)
+        except OSError:
+            self.dropped += 1
+
+    def close(self):
+        """Stop owning the log on a clean exit; the next process to log takes over"""
+        if not self.owner:
+            return
+        # Senders get ENOENT from here on rather than queueing lines nobody
+        # reads; they count them as dropped until the lock is free
+        try:
+            os.unlink(self.sock_path)
+        except OSError:
+            pass
+        try:
+            self.server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.received.acquire(timeout=SEND_TIMEOUT * 2)
+        self.server.close()
+        self.server = None
+        with self.lock:
+            self.file.close()
+            self.file = None
+        self.client.close()
+        # Only now can another process take over
+        os.close(self.lock_fd)
+        self.lock_fd = None
+
+    def abandon(self):
+        """Forget a sink inherited over fork: the parent keeps the log, the child becomes a sender"""
+        # Closing the child's copies leaves the parent's socket, file and lock in place
+        for resource in (self.client, self.server, self.file):
+            if resource is not None:
+                try:
+                    resource.close()
+                except (OSError, ValueError):
+                    pass
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)
+        self.file = self.server = self.lock_fd = None
+
+
+class Pipeline:
+    """Per-process queue and the thread that ships its records"""
+
+    def __init__(self, component, sink=None, queue_size=LOG_QUEUE_SIZE):
+        self.component = component
+        self.formatter = JsonFormatter(component)
+        self.sink = sink or HostSink()
+        self.queue = _queue.SimpleQueue()
+        self.queue_size = queue_size
+        self.dropped = 0
+        # Records only leave the queue under this lock, whichever thread
+        # writes them, so lines stay in the order they were logged
+        self.write_lock = _native('_thread', 'allocate_lock')()
+        # Released by put() to wake the thread
+        self.wakeup = _native('_thread', 'allocate_lock')()
+        self.wakeup.acquire()
+        self.pid = os.getpid()
+        _native('_thread', 'start_new_thread')(self._ship, ())
+
+    def put(self, record):
+        if self.queue.qsize() >= self.queue_size:
+            self.dropped += 1
+            return
+        self.queue.put(record)
+        try:
+            self.wakeup.release()
+        except RuntimeError:
+            # Already awake
+            pass
+
+    def _ship(self):
+        while True:
+            self.wakeup.acquire()
+            with self.write_lock:
+                self._write_queued()
+
+    def _write(self, record):
+        try:
+            self.sink.write(self.formatter.format(record))
+        except Exception:
+            pass
+        dropped = self.dropped + self.sink.dropped
+        if dropped and self.queue.empty():
+            self.dropped = self.sink.dropped = 0
+            self.sink.write(self.formatter.format(logging.makeLogRecord({
+                'name': 'tinnito.log', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                'msg': f'Dropped {dropped} log records', 'dropped': dropped, 'process': self.pid,
+            })))
+
+    def _write_queued(self):
+        while True:
+            try:
+                record = self.queue.get_nowait()
+            except _queue.Empty:
+                return
+            self._write(record)
+
+    def write_now(self, record):
+        """Write a record from the calling thread, after everything queued before it"""
+        with self.write_lock:
+            self._write_queued()
+            self._write(record)
+
+    def drain(self):
+        """Write everything queued so far from the calling thread"""
+        with self.write_lock:
+            self._write_queued()
+
+
+class QueueHandler(logging.Handler):
+    """Hands records to the process's pipeline without blocking on I/O"""
+
+    def __init__(self, component):
+        super().__init__()
+        self.component = component
+        self.addFilter(SamplingFilter())
+
+    def prepare(self, record):
+        # Everything that depends on the caller is resolved here: the ids of
+        # the job or request being handled and the message and traceback text
+        for name, value in current_ids().items():
+            if value is not None and getattr(record, name, None) is None:
+                setattr(record, name, value)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = ''.join(traceback.format_exception(*record.exc_info)).rstrip()
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            record = self.prepare(record)
+            if record.levelno >= logging.WARNING and self.component in SYNC_WARNING_COMPONENTS:
+                pipeline().write_now(record)
+            else:
+                pipeline().put(record)
+        except Exception:
+            self.handleError(record)
+
+
+def pipeline():
+    """This process's pipeline; a forked child starts its own instead of using the parent's"""
+    global _pipeline
+    if _pipeline is None or _pipeline.pid != os.getpid():
+        if _pipeline is not None:
+            _pipeline.sink.abandon()
+        _pipeline = Pipeline(_component)
+    return _pipeline
+
+
+def setup(component):
+    """Route the 'tinnito' loggers through the pipeline. Only the first call in a process counts."""
+    global _component
+    logger = logging.getLogger('tinnito')
+    if _component is not None:
+        return logger
+    _component = component
+    logger.setLevel(LOG_LEVEL)
+    logger.addHandler(QueueHandler(component))
+    # Records are shipped by the pipeline only, not also written by root handlers
+    logger.propagate = False
+    # Claim the log now, so a pre-forking parent owns it rather than its first child to log
+    pipeline()
+    return logger
+
+
+def flush():
+    """Write out this process's queued records. RQ's forked work-horses end
+    with os._exit, which skips atexit, so each job flushes before it returns."""
+    if _pipeline is not None and _pipeline.pid == os.getpid():
+        _pipeline.drain()
+
+
+def shutdown():
+    if _pipeline is not None and _pipeline.pid == os.getpid():
+        _pipeline.drain()
+        _pipeline.sink.close()
+
+
+atexit.register(shutdown)
@@ -0,0 +1,100 @@
+import math
+import time
+from contextlib import contextmanager
+
+# Counters and histograms are kept in one Redis hash, so web processes and
+# workers on other hosts add to the same series and any web process can
+# serve /metrics. Fields are the series exactly as Prometheus expects them,
+# e.g. tinnito_stage_seconds_bucket{le="1",stage="upload"}.
+METRICS_KEY = 'tinnito:metrics'
+
+# Seconds; steps range from sub-second presigns to multi-minute transcodes
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+FAMILIES = {
+    'tinnito_stage_seconds': ('histogram', 'Time spent in each step of a download job'),
+    'tinnito_queue_wait_seconds': ('histogram', 'Time jobs waited in their queue before a worker started them'),
+    'tinnito_jobs_total': ('counter', 'Finished jobs by task and outcome'),
+    'tinnito_retries_total': ('counter', 'Steps retried after a transient failure'),
+    'tinnito_bytes_total': ('counter', 'Bytes downloaded from sources and uploaded to storage'),
+    'tinnito_cache_requests_total': ('counter', 'Artifact and metadata cache lookups by result'),
+    'tinnito_queue_depth': ('gauge', 'Jobs waiting in each queue'),
+    'tinnito_queue_workers': ('gauge', 'Workers listening on each queue'),
+}
+
+
+def _format(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def series(name, **labels):
+    """Series name with labels in a stable order"""
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{k}="{v}"' for k, v in sorted(labels.items())) + '}'
+
+
+def inc(conn, name, amount=1, pipeline=None, **labels):
+    (pipeline or conn).hincrbyfloat(METRICS_KEY, series(name, **labels), amount)
+
+
+def observe(conn, name, value, pipeline=None, **labels):
+    """Record one observation of a histogram in a single round trip"""
+    pipe = pipeline or conn.pipeline(transaction=False)
+    for bound in BUCKETS + (math.inf,):
+        # Every bucket is written, so the series are complete from the first sample
+        pipe.hincrby(METRICS_KEY, series(name + '_bucket', le=_format(bound), **labels), int(value <= bound))
+    pipe.hincrbyfloat(METRICS_KEY, series(name + '_sum', **labels), value)
+    pipe.hincrby(METRICS_KEY, series(name + '_count', **labels), 1)
+    if pipeline is None:
+        pipe.execute()
+
+
+@contextmanager
+def timer(conn, name, **labels):
+    """Observe the duration of the block, whether or not it raises"""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(conn, name, time.monotonic() - started, **labels)
+
+
+def _family(name):
+    base = name.split('{', 1)[0]
+    for suffix in ('_bucket', '_sum', '_count'):
+        if base.endswith(suffix) and FAMILIES.get(base[:-len(suffix)], ('',))[0] == 'histogram':
+            return base[:-len(suffix)]
+    return base
+
+
+def _sort_key(name):
+    # Buckets in ascending `le` order, as Prometheus clients emit them
+    base, _, labels = name.partition('{')
+    le = math.inf
+    if 'le="' in labels:
+        bound = labels.split('le="', 1)[1].split('"', 1)[0]
+        le = math.inf if bound == '+Inf' else float(bound)
+        labels = labels.replace(f'le="{bound}"', '')
+    return base, labels, le
+
+
+def render(conn, gauges=None):
+    """Everything recorded so far, plus `gauges` ({series: value}), in the Prometheus text format"""
+    values = {field.decode(): float(value) for field, value in conn.hgetall(METRICS_KEY).items()}
+    values.update(gauges or {})
+
+    families = {}
+    for name, value in values.items():
+        families.setdefault(_family(name), []).append((name, value))
+
+    lines = []
+    for family in sorted(families):
+        kind, description = FAMILIES.get(family, ('untyped', ''))
+        lines.append(f"# HELP {family} {description}")
+        lines.append(f"# TYPE {family} {kind}")
+        for name, value in sorted(families[family], key=lambda item: _sort_key(item[0])):
+            lines.append(f"{name} {_format(value)}")
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+from urllib.parse import urlparse
+
+import cache
+
+# Extracted metadata, cached by video so the web tier can validate URLs up
+# front and the worker can skip a second extraction. Format URLs in the info
+# expire after a few hours, so keep entries well short of that.
+PROBE_PREFIX = 'tinnito:probe:'
+PROBE_URL_PREFIX = 'tinnito:probe-url:'
+PROBE_TTL = int(os.getenv('PROBE_TTL', '1800'))
+# Unavailable/private/unsupported URLs are remembered briefly too
+NEGATIVE_TTL = int(os.getenv('PROBE_NEGATIVE_TTL', '300'))
+
+class ProbeError(Exception):
+    """The URL cannot be downloaded; the message is safe to show to users"""
+
+
+def validate_url(url):
+    """Cheap checks that need no network access"""
+    parsed = urlparse(url.strip())
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        raise ProbeError('Invalid URL')
+
+
+def summary(info):
+    """The parts of the metadata worth returning to the client"""
+    return {
+        'id': info.get('id'),
+        'extractor': info.get('extractor_key'),
+        'title': info.get('title'),
+        'duration': info.get('duration'),
+        'uploader': info.get('uploader'),
+        'thumbnail': info.get('thumbnail'),
+    }
+
+
+def _url_key(url):
+    return PROBE_URL_PREFIX + hashlib.sha1(url.strip().encode()).hexdigest()
+
+
+def _video_key(url, conn):
+    """Cache key for a URL: parsed locally when possible, else via the URL index"""
+    parsed = cache.parse_video_id(url)
+    if parsed:
+        return PROBE_PREFIX + f"{parsed[0]}:{parsed[1]}"
+    key = conn.get(_url_key(url))
+    return key.decode() if key else None
+
+
+def cached_info(conn, url):
+    """Return cached info for a URL, or None. Raises ProbeError for known-bad URLs."""
+    key = _video_key(url, conn)
+    data = conn.get(key) if key else None
+    if not data:
+        data = conn.get(_url_key(url) + ':error')
+        if data:
+            raise ProbeError(data.decode())
+        return None
+    return json.loads(data)
+
+
+def store(conn, url, info):
+    """Cache sanitized info under its video and the URL it was requested by"""
+    key = PROBE_PREFIX + f"{info['extractor_key'].lower()}:{info['id']}"
+    pipe = conn.pipeline()
+    pipe.set(key, json.dumps(info), ex=PROBE_TTL)
+    pipe.set(_url_key(url), key, ex=PROBE_TTL)
+    pipe.execute()
+
+
+def _error_message(error):
+    cause = getattr(error, 'exc_info', None)
+    cause = cause[1] if cause else error
+    if getattr(cause, 'expected', False):
+        return getattr(cause, 'orig_msg', None) or str(cause)
+    return None
+
+
+def _extract_info(url, ydl):
+    if ydl is None:
+        # Loaded on the first probe, not when the web tier starts
+        from downloader import engine
+        ydl = engine.extractor('probe')
+    return ydl.extract_info(url, download=False)
+
+
+def _call(func, *args):
+    return func(*args)
+
+
+def extract(conn, url, ydl=None, run=None):
+    """Return (info, from_cache) for a URL, extracting without downloading on a miss.
+
+    Pass the caller's YoutubeDL to share its options; the selected format in
+    the cached info follows the engine's probe options either way. `run(func, *args)`, if
+    given, runs the extraction itself (not the cache lookups), e.g. on a
+    thread pool.
+    """
+    validate_url(url)
+    info = cached_info(conn, url)
+    if info is not None:
+        return info, True
+
+    import yt_dlp
+    try:
+        info = (run or _call)(_extract_info, url, ydl)
+    except yt_dlp.utils.DownloadError as e:
+        message = _error_message(e)
+        if message:
+            # The URL itself is bad; remember that instead of asking again
+            conn.set(_url_key(url) + ':error', message, ex=NEGATIVE_TTL)
+            raise ProbeError(message)
+        raise
+
+    if info.get('_type') == 'playlist':
+        raise ProbeError('This is a playlist; submit it as a batch')
+
+    info = yt_dlp.YoutubeDL.sanitize_info(info)
+    store(conn, url, info)
+    return info, False
@@ -0,0 +1,98 @@
+import os
+
+# Output formats users can ask for. `codec` is the yt-dlp FFmpegExtractAudio
+# codec name; `source_codecs` are source stream codecs that can be copied
+# into the output without re-encoding.
+PROFILES = {
+    'mp3': {
+        'codec': 'mp3',
+        'quality': '192',
+        'ext': 'mp3',
+        'mime': 'audio/mpeg',
+        'encoder': 'libmp3lame',
+        'container': 'mp3',
+        'format': 'bestaudio/best',
+        'source_codecs': ('mp3',),
+    },
+    'm4a': {
+        'codec': 'm4a',
+        'quality': '192',
+        'ext': 'm4a',
+        'mime': 'audio/mp4',
+        'encoder': 'aac',
+        'container': 'ipod',
+        'format': 'bestaudio[ext=m4a]/bestaudio/best',
+        'source_codecs': ('mp4a', 'aac'),
+    },
+    'opus': {
+        'codec': 'opus',
+        'quality': '128',
+        'ext': 'opus',
+        'mime': 'audio/ogg',
+        'encoder': 'libopus',
+        'container': 'opus',
+        'format': 'bestaudio[acodec=opus]/bestaudio/best',
+        'source_codecs': ('opus',),
+    },
+}
+
+DEFAULT_PROFILE = os.getenv('DEFAULT_PROFILE', 'mp3')
+# Encoder threads per ffmpeg process; empty lets ffmpeg decide
+FFMPEG_THREADS = os.getenv('FFMPEG_THREADS', '')
+
+
+def get_profile(name=None):
+    """Return the named profile, or None if there is no such profile"""
+    profile = PROFILES.get(name or DEFAULT_PROFILE)
+    return dict(profile, name=name or DEFAULT_PROFILE) if profile else None
+
+
+def can_passthrough(info, profile):
+    """True if the selected source stream can be copied instead of re-encoded"""
+    acodec = (info.get('acodec') or '').split('.')[0].lower()
+    return acodec in profile['source_codecs']
+
+
+def thread_args():
+    return ['-threads', FFMPEG_THREADS] if FFMPEG_THREADS else []
+
+
+def encode_args(profile, passthrough=False):
+    """ffmpeg output arguments for the audio stream"""
+    if passthrough:
+        return ['-vn', '-c:a', 'copy']
+    return ['-vn', '-c:a', profile['encoder'], '-b:a', f"{profile['quality']}k"] + thread_args()
+
+
+def container_args(profile, piped=False):
+    args = ['-f', profile['container']]
+    if piped and profile['container'] == 'ipod':
+        # MP4 needs a seekable output unless it is written as fragments
+        args += ['-movflags', '+frag_keyframe+empty_moov']
+    return args
+
+
+def ydl_options(profile):
+    """yt-dlp options selecting and converting audio for a profile.
+
+    FFmpegExtractAudio already copies the stream when the source codec
+    matches, so only the thread count needs passing on.
+    """
+    opts = {
+        'format': profile['format'],
+        'postprocessors': [{
+            'key': 'FFmpegExtractAudio',
+            'preferredcodec': profile['codec'],
+            'preferredquality': profile['quality'],
+        }],
+    }
+    if FFMPEG_THREADS:
+        opts['postprocessor_args'] = {'extractaudio': thread_args()}
+    return opts
+
+
+def expected_size(info, profile, passthrough=False):
+    """Rough output size in bytes, for progress reporting"""
+    duration = info.get('duration') or 0
+    kbps = (info.get('abr') or 0) if passthrough else int(profile['quality'])
+    return duration * kbps * 1000 / 8
@@ -0,0 +1,184 @@
+import json
+import logging
+import threading
+import time
+
+import events
+
+# Everything a client polls for lives in one small hash per job (state,
+# progress, message, result and error code), kept up to date by the web tier
+# and the workers. Reading a status is one HGETALL whatever the size of the
+# job's arguments, and an update never re-serializes the whole job.
+PROGRESS_PREFIX = 'tinnito:progress:'
+PROGRESS_TTL = 24 * 3600
+
+# Sampled (see log.SAMPLE_RATES); a long download writes hundreds of updates
+logger = logging.getLogger('tinnito.progress')
+
+# Error codes clients can act on; the error message is meant for people
+ERROR_INVALID_REQUEST = 'invalid_request'
+ERROR_SOURCE_UNAVAILABLE = 'source_unavailable'
+ERROR_STORAGE_UNAVAILABLE = 'storage_unavailable'
+ERROR_TIMEOUT = 'timeout'
+ERROR_WORKER_LOST = 'worker_lost'
+ERROR_INTERNAL = 'internal'
+
+
+def progress_key(job_id):
+    return PROGRESS_PREFIX + job_id
+
+
+def read(conn, job_id):
+    """Return the progress, message and (for staged pipelines) outcome of a job"""
+    fields = conn.hgetall(progress_key(job_id))
+    result = fields.get(b'result')
+    return {
+        'progress': float(fields.get(b'progress', 0)),
+        'message': fields.get(b'message', b'').decode(),
+        'state': fields[b'state'].decode() if b'state' in fields else None,
+        'result': json.loads(result) if result else None,
+    }
+
+
+def make_status(job_id, state, progress=0, message='', result=None):
+    """A status in the shape served by /status and pushed to event streams"""
+    failed = bool(result) and not result.get('success')
+    return {
+        'id': job_id,
+        'status': state,
+        'result': result,
+        'error': result.get('error') if failed else None,
+        'error_code': (result.get('error_code') or ERROR_INTERNAL) if failed else None,
+        'progress': progress,
+        'message': message
+    }
+
+
+def parse(job_id, fields):
+    """Status from the raw fields of a job's hash, or None for an unknown job"""
+    if b'state' not in fields:
+        return None
+    result = fields.get(b'result')
+    return make_status(
+        job_id,
+        fields[b'state'].decode(),
+        float(fields.get(b'progress', 0)),
+        fields.get(b'message', b'').decode(),
+        json.loads(result) if result else None
+    )
+
+
+def status(conn, job_id):
+    """Current status of a job in one round trip, or None if unknown"""
+    return parse(job_id, conn.hgetall(progress_key(job_id)))
+
+
+def statuses(conn, job_ids):
+    """Statuses of many jobs ({job_id: status or None}) in one round trip"""
+    pipe = conn.pipeline(transaction=False)
+    for job_id in job_ids:
+        pipe.hgetall(progress_key(job_id))
+    return {job_id: parse(job_id, fields) for job_id, fields in zip(job_ids, pipe.execute())}
+
+
+def create(conn, job_id, pipeline=None):
+    """Start the status of a job that is about to be queued"""
+    pipe = pipeline or conn.pipeline(transaction=False)
+    pipe.hset(progress_key(job_id), mapping={'state': 'queued', 'progress': 0, 'message': ''})
+    pipe.expire(progress_key(job_id), PROGRESS_TTL)
+    if pipeline is None:
+        pipe.execute()
+
+
+def discard(conn, job_id):
+    """Drop the status of a job that ended up not being queued"""
+    conn.delete(progress_key(job_id))
+
+
+def set_state(conn, job_id, state):
+    """Record a state change that comes without a progress update"""
+    pipe = conn.pipeline(transaction=False)
+    pipe.hset(progress_key(job_id), 'state', state)
+    pipe.expire(progress_key(job_id), PROGRESS_TTL)
+    pipe.execute()
+
+
+def finish(conn, job_id, result):
+    """Record the final result of a job and notify listeners"""
+    state = 'finished' if result.get('success') else 'failed'
+    final = make_status(job_id, state, 1.0 if state == 'finished' else 0,
+                        'Complete!' if state == 'finished' else '', result)
+    pipe = conn.pipeline(transaction=False)
+    pipe.hset(progress_key(job_id), mapping={
+        'state': state,
+        'result': json.dumps(result),
+        'progress': final['progress'],
+        'message': final['message'],
+    })
+    pipe.expire(progress_key(job_id), PROGRESS_TTL)
+    events.publish(conn, job_id, final, pipeline=pipe)
+    pipe.execute()
+
+
+class ProgressReporter:
+    """Coalesces progress updates for one job.
+
+    yt-dlp calls progress hooks for every chunk it receives. Updates are only
+    written when progress moved by at least `min_delta`, or when something
+    changed and `min_interval` seconds passed since the last write. Each write
+    is one pipelined HSET + PUBLISH.
+    """
+
+    def __init__(self, conn, job_id, min_delta=0.02, min_interval=1.0, clock=time.monotonic):
+        self.conn = conn
+        self.job_id = job_id
+        self.min_delta = min_delta
+        self.min_interval = min_interval
+        self.clock = clock
+        self.progress = None
+        self.message = None
+        self.sent_at = None
+        self.writes = 0
+        # Upload callbacks arrive from s3transfer's worker threads
+        self._lock = threading.Lock()
+
+    def report(self, progress, message='', force=False):
+        """Record progress; returns True if an update was written"""
+        if progress is None:
+            return False
+        with self._lock:
+            return self._report(progress, message, force)
+
+    def _report(self, progress, message, force):
+        if not force and self.progress is not None:
+            if progress == self.progress and message == self.message:
+                return False
+            moved = abs(progress - self.progress) >= self.min_delta
+            if not moved and self.clock() - self.sent_at < self.min_interval:
+                return False
+
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.hset(progress_key(self.job_id), mapping={'state': 'started', 'progress': progress, 'message': message})
+        pipe.expire(progress_key(self.job_id), PROGRESS_TTL)
+        events.publish(self.conn, self.job_id, make_status(self.job_id, 'started', progress, message), pipeline=pipe)
+        pipe.execute()
+        logger.info('Progress %s %s', progress, message, extra={'job_id': self.job_id, 'progress': progress})
+
+        self.progress = progress
+        self.message = message
+        self.sent_at = self.clock()
+        self.writes += 1
+        return True
+
+    def download_hook(self, start=0.1, end=0.6):
+        """yt-dlp progress hook mapping download progress onto [start, end]"""
+        def hook(d):
+            if d['status'] == 'downloading':
+                total = d.get('total_bytes') or d.get('total_bytes_estimate')
+                if total:
+                    fraction = min(1.0, d.get('downloaded_bytes', 0) / total)
+                    self.report(start + fraction * (end - start),
+                                f"Downloading... {d.get('_percent_str', '').strip()}")
+            elif d['status'] == 'finished':
+                self.report(end, 'Download complete', force=True)
+        return hook
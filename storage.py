@@ -0,0 +1,232 @@
+import logging
+import os
+import threading
+import time
+from urllib.parse import quote
+
+from redis.exceptions import WatchError
+
+import cache
+import metrics
+
+MB = 1024 * 1024
+
+logger = logging.getLogger('tinnito.storage')
+
+# Parallel part uploads; the connection pool must be at least this large
+MAX_CONCURRENCY = int(os.getenv('R2_MAX_CONCURRENCY', '8'))
+MAX_POOL_CONNECTIONS = max(int(os.getenv('R2_MAX_POOL_CONNECTIONS', '20')), MAX_CONCURRENCY)
+
+MULTIPART_THRESHOLD = int(os.getenv('R2_MULTIPART_THRESHOLD_MB', '8')) * MB
+MULTIPART_CHUNKSIZE = int(os.getenv('R2_MULTIPART_CHUNKSIZE_MB', '8')) * MB
+
+# boto3 and botocore are imported on first use: web processes only need
+# them to presign cache hits, and loading them costs every process memory
+_transfer_config = None
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+# Sorted set of R2 object keys scored by the unix time they may be deleted
+EXPIRY_INDEX = 'tinnito:expiry'
+# delete_objects accepts at most 1000 keys per call
+DELETE_BATCH_SIZE = 1000
+
+
+def get_r2_client():
+    """Get the process-wide Cloudflare R2 client.
+
+    boto3 clients are thread-safe, so one client and its connection pool are
+    shared by every thread. RQ forks a work-horse per job, and sockets must not
+    be shared across a fork, so a forked child builds its own.
+    """
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                import boto3
+                from botocore.client import Config
+
+                # Sessions are not thread-safe; never use the default one
+                session = boto3.session.Session()
+                _client = session.client('s3',
+                    endpoint_url=os.environ['R2_ENDPOINT_URL'],
+                    aws_access_key_id=os.environ['R2_ACCESS_KEY_ID'],
+                    aws_secret_access_key=os.environ['R2_SECRET_ACCESS_KEY'],
+                    config=Config(
+                        signature_version='s3v4',
+                        max_pool_connections=MAX_POOL_CONNECTIONS,
+                        tcp_keepalive=True,
+                        retries={'max_attempts': 3, 'mode': 'standard'}
+                    )
+                )
+                _client_pid = pid
+    return _client
+
+
+def transfer_config():
+    """Multipart settings for uploads"""
+    global _transfer_config
+    if _transfer_config is None:
+        from boto3.s3.transfer import TransferConfig
+        _transfer_config = TransferConfig(
+            multipart_threshold=MULTIPART_THRESHOLD,
+            multipart_chunksize=MULTIPART_CHUNKSIZE,
+            max_concurrency=MAX_CONCURRENCY,
+            use_threads=True
+        )
+    return _transfer_config
+
+
+def presign_artifact(r2, entry):
+    """Generate a 15-minute download URL for a cached artifact"""
+    filename = entry['title'] + os.path.splitext(entry['object_key'])[1]
+    return r2.generate_presigned_url(
+        'get_object',
+        Params={
+            'Bucket': os.environ['R2_BUCKET'],
+            'Key': entry['object_key'],
+            'ResponseContentDisposition': f"attachment; filename*=UTF-8''{quote(filename)}"
+        },
+        ExpiresIn=cache.ARTIFACT_TTL
+    )
+
+
+def object_exists(r2, object_key):
+    """True if the object is still in the bucket; the sweeper may have deleted it"""
+    try:
+        r2.head_object(Bucket=os.environ['R2_BUCKET'], Key=object_key)
+        return True
+    except Exception as e:
+        if is_not_found(e):
+            return False
+        raise
+
+
+def is_not_found(e):
+    """True for the error R2 raises for a missing object"""
+    # botocore's ClientError, without importing botocore here
+    return getattr(e, 'response', {}).get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+
+def keep_artifact(conn, key, ttl=cache.ARTIFACT_TTL):
+    """Keep a cached artifact, and the object behind it, for at least `ttl` seconds.
+
+    Returns the entry, or None if the artifact is gone.
+    """
+    entry = cache.acquire(conn, key, ttl)
+    if entry:
+        schedule_expiry(conn, entry['object_key'], float(entry['expires_at']))
+    return entry
+
+
+def cached_result(conn, key):
+    """Result dict for a cache hit, or None on a miss"""
+    entry = keep_artifact(conn, key)
+    if not entry:
+        return None
+    with metrics.timer(conn, 'tinnito_stage_seconds', stage='presign'):
+        download_url = presign_artifact(get_r2_client(), entry)
+    return {
+        'status': 'complete',
+        'success': True,
+        'cached': True,
+        'title': entry['title'],
+        'object_key': entry['object_key'],
+        'download_url': download_url
+    }
+
+
+def schedule_expiry(conn, key, expires_at, pipeline=None):
+    """Record (or push back) the time an uploaded object may be deleted"""
+    (pipeline or conn).zadd(EXPIRY_INDEX, {key: expires_at})
+
+
+def _unindex_if_expired(conn, key, now):
+    """Drop `key` from the expiry index if it is still due and no cache entry needs it.
+
+    Checked and removed in one transaction, so an artifact stored again
+    meanwhile keeps its entry and its new score. Returns the old score, or
+    None if the key stays.
+    """
+    artifact = cache.key_for_object(key)
+    watched = [EXPIRY_INDEX] + ([cache.ARTIFACT_PREFIX + artifact] if artifact else [])
+    with conn.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(*watched)
+                score = pipe.zscore(EXPIRY_INDEX, key)
+                if score is None or score > now or cache.is_live(pipe, key):
+                    pipe.unwatch()
+                    return None
+                pipe.multi()
+                pipe.zrem(EXPIRY_INDEX, key)
+                pipe.execute()
+                return score
+            except WatchError:
+                continue
+
+
+def sweep_expired(r2, conn, bucket, now=None, batch_size=DELETE_BATCH_SIZE):
+    """Delete expired objects listed in the expiry index.
+
+    Cost depends only on the number of expired objects, never on how many
+    files are live. Returns the number of objects deleted.
+    """
+    now = time.time() if now is None else now
+    deleted = 0
+
+    while True:
+        keys = [k.decode() for k in conn.zrangebyscore(EXPIRY_INDEX, '-inf', now, start=0, num=batch_size)]
+        if not keys:
+            return deleted
+
+        # Keys leave the index before their objects are deleted, never after,
+        # so a cache hit or a new upload since the scores were read wins
+        expired = {}
+        for key in keys:
+            score = _unindex_if_expired(conn, key, now)
+            if score is not None:
+                expired[key] = score
+
+        if expired:
+            response = r2.delete_objects(
+                Bucket=bucket,
+                Delete={'Objects': [{'Key': key} for key in expired], 'Quiet': True}
+            )
+            failed = {err['Key'] for err in response.get('Errors', [])}
+            if failed:
+                # Indexed again for the next sweep, unless stored again meanwhile
+                conn.zadd(EXPIRY_INDEX, {key: expired[key] for key in failed}, nx=True)
+            done = [key for key in expired if key not in failed]
+            deleted += len(done)
+            # An upload of the same artifact that finished between the two
+            # steps lost its object; drop its entry so the next request makes
+            # it again instead of handing out URLs that 404
+            for key in done:
+                if cache.is_live(conn, key):
+                    logger.warning('%s was stored again while it was deleted; dropping its cache entry', key)
+                    conn.delete(cache.ARTIFACT_PREFIX + cache.key_for_object(key))
+            if failed:
+                logger.warning('Failed to delete %d expired objects', len(failed))
+                return deleted
+
+        if len(keys) < batch_size or not expired:
+            return deleted
+
+
+def backfill_expiry_index(r2, conn, bucket, ttl=cache.ARTIFACT_TTL):
+    """Index every object already in the bucket by its upload time.
+
+    Only needed once, for objects uploaded before the expiry index existed.
+    """
+    indexed = 0
+    paginator = r2.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket):
+        pipe = conn.pipeline()
+        for obj in page.get('Contents', []):
+            schedule_expiry(conn, obj['Key'], obj['LastModified'].timestamp() + ttl, pipeline=pipe)
+            indexed += 1
+        pipe.execute()
+    return indexed
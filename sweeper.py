@@ -0,0 +1,31 @@
+import argparse
+import os
+import sys
+import time
+
+# Add the current directory to Python path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from tasks import get_r2_client, get_redis, sweep_expired_files
+import storage
+
+# Seconds between sweeps of the expiry index
+interval = int(os.getenv('SWEEP_INTERVAL', '60'))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Delete expired files from R2')
+    parser.add_argument('--once', action='store_true', help='run a single sweep and exit')
+    parser.add_argument('--backfill', action='store_true',
+                        help='index objects uploaded before the expiry index existed, then exit')
+    args = parser.parse_args()
+
+    if args.backfill:
+        indexed = storage.backfill_expiry_index(get_r2_client(), get_redis(), os.environ['R2_BUCKET'])
+        print(f"Indexed {indexed} objects")
+        sys.exit(0)
+
+    while True:
+        sweep_expired_files()
+        if args.once:
+            break
+        time.sleep(interval)
@@ -1,128 +1,737 @@
+import contextlib
+import functools
+import http.client
+import logging
 import yt_dlp
 import os
-from rq import get_current_job
-import boto3
-from botocore.client import Config
+import redis
+import shutil
+import socket
+import ssl
+import subprocess
+from rq import Queue, get_current_job
+from rq.timeouts import JobTimeoutException
+import tempfile
+import time
+import urllib.error
+import uuid
+import zipfile
 from datetime import datetime, timedelta
 
+import admission
+import batch
+import cache
+import checkpoints
+import events
+import localcache
+import log
+import metrics
+import probe
+import profiles
+import progress
+import storage
+from storage import get_r2_client
+from downloader import engine, ranged, stream
+
+# Pipe source -> ffmpeg -> R2 instead of going through temp files
+STREAMING_UPLOADS = os.getenv('STREAMING_UPLOADS', '1') == '1'
+
+# 'ranged' downloads plain HTTP sources over several connections with
+# downloader/ranged.py, ahead of streaming; fragmented formats still go
+# through yt-dlp, which fetches DOWNLOAD_CONCURRENCY fragments at once
+DOWNLOAD_ENGINE = os.getenv('DOWNLOAD_ENGINE', 'ytdlp')
+
+# Staged pipelines hand files between fetch, transcode and upload workers
+# through this directory, so those workers must share it
+WORK_DIR = os.getenv('WORK_DIR', 'work')
+STAGE_TIMEOUT = '10m'
+
+# Transient failures (dropped connections, timeouts, 5xx) are retried within
+# the job, after RETRY_BACKOFF, then twice that and so on up to RETRY_MAX_DELAY
+RETRIES = int(os.getenv('JOB_RETRIES', '3'))
+RETRY_BACKOFF = float(os.getenv('RETRY_BACKOFF_SECONDS', '5'))
+RETRY_MAX_DELAY = 60
+BOTO_TRANSIENT_ERRORS = ('EndpointConnectionError', 'ConnectionClosedError', 'ReadTimeoutError',
+                         'ConnectTimeoutError')
+
+# Worker processes that import tasks without going through worker.py (the
+# sweeper, rq's own CLI) log the same way
+log.setup('worker')
+logger = logging.getLogger('tinnito.tasks')
+
+# How often a job waiting for another job's lease on the same artifact checks back
+LEASE_POLL_SECONDS = 2
+
+_pruned_at = 0
+
+_reporter = None
+
+def get_reporter():
+    """Progress reporter for the current job, or None outside a worker"""
+    global _reporter
+    job = get_current_job()
+    if not job:
+        return None
+    job_id = pipeline_id(job)
+    if _reporter is None or _reporter.job_id != job_id:
+        _reporter = progress.ProgressReporter(job.connection, job_id)
+    return _reporter
+
+def pipeline_id(job):
+    """ID clients know a job by; later stages of a staged pipeline report under the first one's"""
+    return job.meta.get('pipeline_id', job.id)
+
 def update_progress(progress, message=''):
+    reporter = get_reporter()
+    if reporter:
+        reporter.report(progress, message, force=True)
+
+def record_queue_wait(job):
+    if job.enqueued_at and job.started_at:
+        wait = (job.started_at - job.enqueued_at).total_seconds()
+        metrics.observe(job.connection, 'tinnito_queue_wait_seconds', max(0, wait), queue=job.origin)
+
+def record_run_time(job):
+    """Feed the lane's average job time, which /download's wait estimates are based on"""
+    if job.started_at:
+        admission.record_job_seconds(job.connection, job.origin,
+                                     max(0, (datetime.utcnow() - job.started_at).total_seconds()))
+
+def outcome(result):
+    if not result.get('success'):
+        return 'error'
+    return 'cached' if result.get('cached') else 'success'
+
+def release_inflight(job):
+    """Let new submissions of this job's video start their own job again"""
+    key = job.meta.get('inflight')
+    if key:
+        cache.release(job.connection, key, pipeline_id(job))
+
+def error_code(e):
+    """Classify a failure for clients (see progress.ERROR_*)"""
+    if isinstance(e, JobTimeoutException):
+        return progress.ERROR_TIMEOUT
+    if isinstance(e, ValueError):
+        return progress.ERROR_INVALID_REQUEST
+    if isinstance(e, (yt_dlp.utils.YoutubeDLError, ranged.FetchError)):
+        return progress.ERROR_SOURCE_UNAVAILABLE
+    if type(e).__module__.split('.')[0] in ('boto3', 'botocore', 's3transfer'):
+        return progress.ERROR_STORAGE_UNAVAILABLE
+    return progress.ERROR_INTERNAL
+
+def error_result(e):
+    return {
+        'status': 'error',
+        'success': False,
+        'error': str(e),
+        'error_code': error_code(e)
+    }
+
+def publishes_result(func):
+    """Record a job's return value (or failure) as its final status and publish it"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        job = get_current_job()
+        if job:
+            record_queue_wait(job)
+        with log.job(job.id if job else None):
+            try:
+                try:
+                    result = func(*args, **kwargs)
+                finally:
+                    # Before publishing, so a client reacting to the event finds the cached file
+                    if job:
+                        release_inflight(job)
+                        record_run_time(job)
+            except Exception as e:
+                logger.exception('%s failed', func.__name__, extra={'error_code': error_code(e)})
+                if job:
+                    metrics.inc(job.connection, 'tinnito_jobs_total', task=func.__name__, outcome='error')
+                    progress.finish(job.connection, job.id, error_result(e))
+                raise
+            if job:
+                metrics.inc(job.connection, 'tinnito_jobs_total', task=func.__name__, outcome=outcome(result))
+                progress.finish(job.connection, job.id, result)
+            return result
+    return wrapper
+
+def work_horse_killed(job, retpid, ret_val, rusage):
+    """Worker hook for a work-horse that died mid-job, e.g. killed for memory"""
+    logger.error('Work horse %d died while running the job', retpid,
+                 extra={'job_id': pipeline_id(job), 'exit_status': ret_val})
+    result = {
+        'status': 'error',
+        'success': False,
+        'error': 'The worker stopped while processing this download',
+        'error_code': progress.ERROR_WORKER_LOST
+    }
+    release_inflight(job)
+    progress.finish(job.connection, pipeline_id(job), result)
+    if job.func_name == 'tasks.process_batch_item':
+        # The item's own finally never ran; free its slot so the batch goes on
+        batch_id, index = job.args[:2]
+        batch.finish_item(Queue(job.origin, connection=job.connection), batch_id, index, result)
+
+def metrics_hooks(conn):
+    """yt-dlp progress and postprocessor hooks recording download and conversion time"""
+    started = {}
+
+    def on_progress(d):
+        if d['status'] == 'finished':
+            metrics.observe(conn, 'tinnito_stage_seconds', d.get('elapsed') or 0, stage='download')
+            metrics.inc(conn, 'tinnito_bytes_total', d.get('total_bytes') or d.get('downloaded_bytes') or 0,
+                        direction='download')
+
+    def on_postprocess(d):
+        if d['status'] == 'started':
+            started[d['postprocessor']] = time.monotonic()
+        elif d['status'] == 'finished' and d['postprocessor'] in started:
+            elapsed = time.monotonic() - started.pop(d['postprocessor'])
+            metrics.observe(conn, 'tinnito_stage_seconds', elapsed, stage='transcode')
+
+    return on_progress, on_postprocess
+
+def get_redis():
+    """Redis connection of the current job, or a new one outside a worker"""
     job = get_current_job()
     if job:
-        job.meta['progress'] = progress
-        job.meta['message'] = message
-        job.save_meta()
-
-def get_r2_client():
-    """Get Cloudflare R2 client"""
-    return boto3.client('s3',
-        endpoint_url=os.environ['R2_ENDPOINT_URL'],
-        aws_access_key_id=os.environ['R2_ACCESS_KEY_ID'],
-        aws_secret_access_key=os.environ['R2_SECRET_ACCESS_KEY'],
-        config=Config(signature_version='s3v4')
+        return job.connection
+    return redis.from_url(os.environ.get('REDIS_URL', 'redis://localhost:6379'))
+
+def sweep_expired_files():
+    """Delete uploads whose download URLs have all expired"""
+    try:
+        deleted = storage.sweep_expired(get_r2_client(), get_redis(), os.environ['R2_BUCKET'])
+        if deleted:
+            logger.info('Deleted %d expired files', deleted)
+    except Exception:
+        logger.exception('Error cleaning up old files')
+
+def upload_streaming(conn, r2, info, key, profile, extra_args):
+    """Pipe the source through ffmpeg straight into a multipart upload.
+
+    Parts are uploaded while ffmpeg is still encoding. The only local copy
+    is the one teed into the local cache, kept once the upload succeeds.
+    """
+    update_progress(0.3, 'Converting and uploading...')
+
+    # Only an estimate: the real size is unknown until ffmpeg finishes
+    passthrough = profiles.can_passthrough(info, profile)
+    expected_bytes = profiles.expected_size(info, profile, passthrough)
+    uploaded = 0
+
+    reporter = get_reporter()
+
+    def on_progress(nbytes):
+        nonlocal uploaded
+        uploaded += nbytes
+        if expected_bytes and reporter:
+            reporter.report(min(0.95, 0.3 + uploaded / expected_bytes * 0.65), 'Converting and uploading...')
+
+    cmd = stream.ffmpeg_command(info, profile, passthrough)
+    cached = localcache.Partial(cache.object_key(key))
+    try:
+        # Download, transcode and upload overlap here, so they are timed as one step
+        with metrics.timer(conn, 'tinnito_stage_seconds', stage='stream'), \
+                stream.TranscodeStream(cmd, tee=cached) as audio:
+            r2.upload_fileobj(
+                audio,
+                os.environ['R2_BUCKET'],
+                cache.object_key(key),
+                ExtraArgs=extra_args,
+                Config=storage.transfer_config(),
+                Callback=on_progress
+            )
+    except BaseException:
+        cached.discard()
+        raise
+    metrics.inc(conn, 'tinnito_bytes_total', audio.bytes_read, direction='upload')
+    try:
+        cached.commit()
+    except OSError as e:
+        # The upload succeeded; web processes fall back to R2 for this one
+        logger.warning('Could not keep %s on local disk: %s', key, e)
+
+def upload_args(profile):
+    return {
+        'ContentType': profile['mime'],
+        'Metadata': {
+            'expiry': (datetime.now() + timedelta(minutes=15)).isoformat()
+        }
+    }
+
+def publish_artifact(conn, r2, key, title):
+    """Index a freshly uploaded artifact and return the job result for it"""
+    expires_at = cache.store(conn, key, title)
+    storage.schedule_expiry(conn, cache.object_key(key), expires_at)
+
+    # Generate presigned URL valid for 15 minutes
+    with metrics.timer(conn, 'tinnito_stage_seconds', stage='presign'):
+        presigned_url = storage.presign_artifact(r2, {
+            'title': title,
+            'object_key': cache.object_key(key)
+        })
+
+    return {
+        'status': 'complete',
+        'success': True,
+        'cached': False,
+        'title': title,
+        'object_key': cache.object_key(key),
+        'download_url': presigned_url
+    }
+
+def can_fetch_ranged(info):
+    return (
+        DOWNLOAD_ENGINE == 'ranged'
+        and info.get('protocol') in ('http', 'https')
+        and bool(info.get('url'))
+        and not info.get('requested_formats')
     )
 
-def cleanup_old_files():
-    """Delete files older than 15 minutes"""
-    r2 = get_r2_client()
-    cutoff_time = datetime.utcnow() - timedelta(minutes=15)
-    
+def fetch_ranged(info, path, hooks):
+    """Download the selected format with the ranged fetcher, reporting to yt-dlp progress hooks"""
+    started = time.time()
+
+    def on_progress(downloaded, total):
+        status = {'status': 'downloading', 'downloaded_bytes': downloaded, 'total_bytes': total,
+                  'elapsed': time.time() - started}
+        if total:
+            status['_percent_str'] = f"{downloaded / total * 100:.1f}%"
+        for hook in hooks:
+            hook(status)
+
+    size = ranged.RangedFetcher(info['url'], info.get('http_headers')).fetch(path, on_progress)
+    for hook in hooks:
+        hook({'status': 'finished', 'downloaded_bytes': size, 'total_bytes': size,
+              'elapsed': time.time() - started, 'filename': path})
+    return path
+
+def transcode_file(source, output, profile, passthrough=False):
+    process = subprocess.run(
+        stream.file_command(source, output, profile, passthrough),
+        stdin=subprocess.DEVNULL,
+        capture_output=True
+    )
+    if process.returncode != 0:
+        error = process.stderr.decode(errors='replace').strip().splitlines()
+        raise IOError(f"Transcoding failed: {error[-1] if error else process.returncode}")
+
+def upload_file(conn, r2, path, key, extra_args):
+    with metrics.timer(conn, 'tinnito_stage_seconds', stage='upload'):
+        r2.upload_file(
+            path,
+            os.environ['R2_BUCKET'],
+            cache.object_key(key),
+            ExtraArgs=extra_args,
+            Config=storage.transfer_config()
+        )
+    metrics.inc(conn, 'tinnito_bytes_total', os.path.getsize(path), direction='upload')
     try:
-        objects = r2.list_objects_v2(Bucket=os.environ['R2_BUCKET'])
-        for obj in objects.get('Contents', []):
-            if obj['LastModified'].replace(tzinfo=None) < cutoff_time:
-                r2.delete_object(
-                    Bucket=os.environ['R2_BUCKET'],
-                    Key=obj['Key']
-                )
-    except Exception as e:
-        print(f"Error cleaning up old files: {e}")
+        localcache.put(path, cache.object_key(key))
+    except OSError as e:
+        # The upload succeeded; web processes fall back to R2 for this one
+        logger.warning('Could not keep %s on local disk: %s', key, e)
+
+def is_transient(e):
+    """True for failures worth retrying: dropped connections, timeouts, 5xx and 429 responses"""
+    seen = set()
+    while e is not None and id(e) not in seen:
+        seen.add(id(e))
+        if isinstance(e, urllib.error.HTTPError):
+            return e.code >= 500 or e.code == 429
+        if isinstance(e, (ConnectionError, TimeoutError, socket.timeout, urllib.error.URLError,
+                          http.client.HTTPException, ssl.SSLError)):
+            return True
+        if type(e).__module__ == 'botocore.exceptions' and type(e).__name__ in BOTO_TRANSIENT_ERRORS:
+            return True
+        # yt-dlp wraps the underlying error rather than chaining it
+        wrapped = getattr(e, 'exc_info', None)
+        e = e.__cause__ or e.__context__ or (wrapped[1] if isinstance(wrapped, tuple) else None)
+    return False
+
+def retrying(step, *args):
+    """Run `step`, retrying transient failures with exponential backoff"""
+    for attempt in range(RETRIES + 1):
+        try:
+            return step(*args)
+        except Exception as e:
+            if attempt == RETRIES or not is_transient(e):
+                raise
+            delay = min(RETRY_BACKOFF * 2 ** attempt, RETRY_MAX_DELAY)
+            metrics.inc(get_redis(), 'tinnito_retries_total', step=step.__name__)
+            reporter = get_reporter()
+            if reporter:
+                reporter.report(reporter.progress or 0, f'Connection problem, retrying in {delay:.0f}s...', force=True)
+            logger.warning('%s failed (%s), retry %d of %d in %.0fs', step.__name__, e, attempt + 1, RETRIES, delay,
+                           extra={'step': step.__name__, 'attempt': attempt + 1})
+            time.sleep(delay)
+
+def artifact_dir(key):
+    """Work directory for producing an artifact; a later attempt at the same video finds its files here"""
+    return os.path.join(WORK_DIR, key.replace(':', '_'))
+
+def prune_work_dirs(now=None):
+    """Delete work directories abandoned longer than the checkpoint TTL; runs at most hourly per process"""
+    global _pruned_at
+    now = time.time() if now is None else now
+    if now - _pruned_at < 3600:
+        return
+    _pruned_at = now
+    try:
+        names = os.listdir(WORK_DIR)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(WORK_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > checkpoints.CHECKPOINT_TTL:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
 
-def process_youtube_url(url, user_id):
-    """Download YouTube video as MP3 and upload to R2"""
+@contextlib.contextmanager
+def artifact_lease(conn, key):
+    """Hold the lease on an artifact's work directory and checkpoint.
+
+    Two jobs can produce the same artifact, e.g. a batch item and a single
+    download of the same video. The second waits here until the first is
+    done, or takes over once the first has ended without releasing it.
+    """
+    job = get_current_job()
+    owner = pipeline_id(job) if job else str(uuid.uuid4())
+    ttl = int(job.timeout or admission.DEFAULT_TIMEOUT) if job else admission.DEFAULT_TIMEOUT
+    waiting = False
+    while True:
+        holder = checkpoints.lease(conn, key, owner, ttl)
+        if holder is None or holder == owner:
+            break
+        status = progress.status(conn, holder)
+        if (not status or events.is_terminal(status)) and checkpoints.take_over_lease(conn, key, holder, owner, ttl):
+            break
+        if not waiting:
+            update_progress(0.2, 'Waiting for another download of this video...')
+            waiting = True
+        time.sleep(LEASE_POLL_SECONDS)
+    try:
+        yield
+    finally:
+        checkpoints.release_lease(conn, key, owner)
+
+def deliver(conn, ydl, r2, info, key, work_dir, profile):
+    """Transcode the selected format and upload it as the artifact `key`.
+
+    Each finished step is checkpointed, so a retry skips straight to the
+    first unfinished one and partial downloads in `work_dir` are resumed.
+    Callers hold the artifact's lease.
+    """
+    extra_args = upload_args(profile)
+    checkpoint = checkpoints.load(conn, key)
+    if checkpoints.reached(checkpoint, checkpoints.UPLOADED):
+        if storage.object_exists(r2, cache.object_key(key)):
+            return
+        # Swept since an earlier attempt uploaded it; produce it again
+        checkpoints.clear(conn, key)
+        checkpoint = {}
+
+    if checkpoints.reached(checkpoint, checkpoints.ENCODED):
+        audio_file = checkpoint['path']
+    elif can_fetch_ranged(info):
+        os.makedirs(work_dir, exist_ok=True)
+        source = os.path.join(work_dir, f"{info['id']}.source")
+        if not checkpoints.reached(checkpoint, checkpoints.DOWNLOADED):
+            # Picks up the chunks a failed attempt already wrote
+            fetch_ranged(info, source, ydl.params.get('progress_hooks', []))
+            checkpoints.save(conn, key, checkpoints.DOWNLOADED, source)
+        audio_file = os.path.join(work_dir, f"{info['id']}.{profile['ext']}")
+        update_progress(0.6, 'Converting...')
+        with metrics.timer(conn, 'tinnito_stage_seconds', stage='transcode'):
+            transcode_file(source, audio_file, profile, profiles.can_passthrough(info, profile))
+        checkpoints.save(conn, key, checkpoints.ENCODED, audio_file)
+        os.remove(source)
+    elif STREAMING_UPLOADS and stream.can_stream(info):
+        upload_streaming(conn, r2, info, key, profile, extra_args)
+        checkpoints.save(conn, key, checkpoints.UPLOADED)
+        return
+    else:
+        # Download and convert on local disk, then upload. yt-dlp continues
+        # its .part file, and skips the download if only conversion failed.
+        os.makedirs(work_dir, exist_ok=True)
+        info = ydl.process_ie_result(info, download=True)
+        audio_file = info['requested_downloads'][0]['filepath']
+        checkpoints.save(conn, key, checkpoints.ENCODED, audio_file)
+
+    update_progress(0.7, 'Uploading to storage...')
+    upload_file(conn, r2, audio_file, key, extra_args)
+    checkpoints.save(conn, key, checkpoints.UPLOADED)
+
+def finish_artifact(conn, key, work_dir):
+    """Forget the checkpoints and files of an artifact that is done, or failed for good"""
+    checkpoints.clear(conn, key)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+@publishes_result
+def process_youtube_url(url, user_id, profile_name=None):
+    """Download YouTube video as audio (MP3 by default) and upload to R2"""
     update_progress(0.1, 'Starting download...')
-    
+    key = None
+
     try:
-        # Create temp directory for downloads
-        temp_dir = f"temp_{user_id}"
-        os.makedirs(temp_dir, exist_ok=True)
-
-        # Download options
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
-            'outtmpl': f'{temp_dir}/%(title)s.%(ext)s',
-            'quiet': True,
-            'no_warnings': True,
-            'progress_hooks': [lambda d: update_progress(
-                min(0.6, 0.1 + (d.get('downloaded_bytes', 0) / d.get('total_bytes', 1)) * 0.5)
-                if d['status'] == 'downloading' else None,
-                f"Downloading... {d.get('_percent_str', '')}"
-            )]
-        }
+        conn = get_redis()
+        profile = profiles.get_profile(profile_name)
+        if not profile:
+            raise ValueError(f"Unknown format: {profile_name}")
+        prune_work_dirs()
+
+        # Another job may have finished this video since it was queued
+        parsed = cache.parse_video_id(url)
+        if parsed:
+            result = storage.cached_result(conn, cache.artifact_key(*parsed, profile['name'], profile['quality']))
+            if result:
+                update_progress(1.0, 'Complete!')
+                return result
+
+        on_progress, on_postprocess = metrics_hooks(conn)
+        progress_hooks = [on_progress]
+        reporter = get_reporter()
+        if reporter:
+            progress_hooks.append(reporter.download_hook(0.1, 0.6))
 
         update_progress(0.2, 'Extracting audio...')
-        
-        # Download and convert to MP3
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            title = info['title']
-            mp3_file = f"{temp_dir}/{title}.mp3"
-            
-            update_progress(0.7, 'Uploading to storage...')
-            
-            # Get R2 client and clean up old files
-            r2 = get_r2_client()
-            cleanup_old_files()
-            
-            # Delete any existing files for this user
+
+        # The engine's YoutubeDL outlives the job, so later jobs in this worker start warm
+        warm = engine.get_engine(profile)
+        with warm.job(progress_hooks=progress_hooks, postprocessor_hooks=[on_postprocess]) as ydl:
+            # Usually already probed by /download
+            with metrics.timer(conn, 'tinnito_stage_seconds', stage='extract'):
+                info, from_cache = probe.extract(conn, url, ydl)
+            key = cache.artifact_key(info['extractor_key'], info['id'], profile['name'], profile['quality'])
+
+            with artifact_lease(conn, key):
+                # URLs we could not parse up front are only recognised here,
+                # and another job may have produced the file while this one waited
+                result = storage.cached_result(conn, key)
+                if result:
+                    update_progress(1.0, 'Complete!')
+                    return result
+
+                title = info['title']
+                r2 = get_r2_client()
+                work_dir = artifact_dir(key)
+                warm.output(os.path.join(work_dir, '%(id)s.%(ext)s'))
+
+                try:
+                    try:
+                        # Select this profile's format from the cached format list
+                        retrying(deliver, conn, ydl, r2, ydl.process_ie_result(info, download=False),
+                                 key, work_dir, profile)
+                    except Exception:
+                        if not from_cache:
+                            raise
+                        # Format URLs in cached info may have expired; extract again
+                        info = ydl.extract_info(url, download=False)
+                        probe.store(conn, url, ydl.sanitize_info(info))
+                        retrying(deliver, conn, ydl, r2, info, key, work_dir, profile)
+                    result = publish_artifact(conn, r2, key, title)
+                except Exception as e:
+                    # Work lost to a network problem is kept for a resubmission to resume
+                    if not is_transient(e):
+                        finish_artifact(conn, key, work_dir)
+                    raise
+                finish_artifact(conn, key, work_dir)
+
+        update_progress(1.0, 'Complete!')
+        return result
+
+    except Exception as e:
+        return error_result(e)
+
+def pipeline_stage(func):
+    """Run one step of a staged pipeline; a failure ends the whole pipeline"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        job = get_current_job()
+        job_id = pipeline_id(job)
+        record_queue_wait(job)
+        with log.job(job_id):
             try:
-                r2.delete_object(
-                    Bucket=os.environ['R2_BUCKET'],
-                    Key=f"{user_id}/current.mp3"
-                )
-            except:
-                pass  # Ignore if no file exists
-            
-            # Upload with 15-minute expiry
-            r2.upload_file(
-                mp3_file,
-                os.environ['R2_BUCKET'],
-                f"{user_id}/{title}.mp3",
-                ExtraArgs={
-                    'Metadata': {
-                        'expiry': (datetime.now() + timedelta(minutes=15)).isoformat()
-                    }
-                }
-            )
-            
-            # Generate presigned URL valid for 15 minutes
-            presigned_url = r2.generate_presigned_url(
-                'get_object',
-                Params={
-                    'Bucket': os.environ['R2_BUCKET'],
-                    'Key': f"{user_id}/{title}.mp3"
-                },
-                ExpiresIn=900  # 15 minutes
-            )
-            
-            # Clean up local file
-            os.remove(mp3_file)
-            os.rmdir(temp_dir)
-            
-            update_progress(1.0, 'Complete!')
-            
-            return {
-                'status': 'complete',
-                'title': title,
-                'download_url': presigned_url
-            }
+                result = func(*args, **kwargs)
+                metrics.inc(job.connection, 'tinnito_jobs_total', task=func.__name__,
+                            outcome=outcome(result) if result else 'success')
+                return result
+            except Exception as e:
+                logger.exception('%s failed', func.__name__, extra={'error_code': error_code(e)})
+                metrics.inc(job.connection, 'tinnito_jobs_total', task=func.__name__, outcome='error')
+                shutil.rmtree(os.path.join(WORK_DIR, job_id), ignore_errors=True)
+                release_inflight(job)
+                progress.finish(job.connection, job_id, error_result(e))
+    return wrapper
+
+def enqueue_stage(queue_name, func, *args):
+    """Hand the pipeline of the current job to the next stage's queue"""
+    job = get_current_job()
+    Queue(queue_name, connection=job.connection).enqueue(
+        func,
+        args=args,
+        # Scaled to the track's length when the pipeline was queued
+        job_timeout=job.timeout or STAGE_TIMEOUT,
+        meta={'pipeline_id': pipeline_id(job), 'inflight': job.meta.get('inflight')}
+    )
+
+def finish_pipeline(result):
+    job = get_current_job()
+    release_inflight(job)
+    progress.finish(job.connection, pipeline_id(job), result)
+    return result
+
+@pipeline_stage
+def fetch_stage(url, user_id, profile_name=None):
+    """Staged pipeline, step 1: download the source audio (network-bound)"""
+    job = get_current_job()
+    conn = job.connection
+    progress.set_state(conn, job.id, 'started')
+    update_progress(0.1, 'Starting download...')
+    profile = profiles.get_profile(profile_name)
+    if not profile:
+        raise ValueError(f"Unknown format: {profile_name}")
+
+    parsed = cache.parse_video_id(url)
+    if parsed:
+        result = storage.cached_result(conn, cache.artifact_key(*parsed, profile['name'], profile['quality']))
+        if result:
+            return finish_pipeline(result)
+
+    work_dir = os.path.join(WORK_DIR, job.id)
+    on_progress, _ = metrics_hooks(conn)
+    progress_hooks = [on_progress, get_reporter().download_hook(0.1, 0.5)]
+    with engine.get_engine(profile, convert=False).job(f'{work_dir}/source.%(ext)s', progress_hooks) as ydl:
+        with metrics.timer(conn, 'tinnito_stage_seconds', stage='extract'):
+            info, _ = probe.extract(conn, url, ydl)
+        key = cache.artifact_key(info['extractor_key'], info['id'], profile['name'], profile['quality'])
+        result = storage.cached_result(conn, key)
+        if result:
+            return finish_pipeline(result)
+        info = ydl.process_ie_result(info, download=False)
+        # Retries continue the partial download in work_dir
+        if can_fetch_ranged(info):
+            os.makedirs(work_dir, exist_ok=True)
+            source = retrying(fetch_ranged, info, os.path.join(work_dir, 'source'), progress_hooks)
+        else:
+            info = retrying(ydl.process_ie_result, info, True)
+            source = info['requested_downloads'][0]['filepath']
+
+    update_progress(0.5, 'Waiting to convert...')
+    enqueue_stage('transcode', 'tasks.transcode_stage', key, info['title'], source,
+                  profile['name'], profiles.can_passthrough(info, profile))
+
+@pipeline_stage
+def transcode_stage(key, title, source, profile_name=None, passthrough=False):
+    """Staged pipeline, step 2: encode the source (CPU-bound), or just remux it"""
+    profile = profiles.get_profile(profile_name)
+    update_progress(0.55, 'Converting...')
+    output = os.path.join(os.path.dirname(source), f"audio.{profile['ext']}")
+    try:
+        with metrics.timer(get_redis(), 'tinnito_stage_seconds', stage='transcode'):
+            transcode_file(source, output, profile, passthrough)
+    finally:
+        os.remove(source)
+
+    update_progress(0.8, 'Waiting to upload...')
+    enqueue_stage('upload', 'tasks.upload_stage', key, title, output, profile['name'])
+
+@pipeline_stage
+def upload_stage(key, title, path, profile_name=None):
+    """Staged pipeline, step 3: upload to R2 and hand out the download URL"""
+    update_progress(0.85, 'Uploading to storage...')
+    conn = get_redis()
+    r2 = get_r2_client()
+    retrying(upload_file, conn, r2, path, key, upload_args(profiles.get_profile(profile_name)))
+    shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+    return finish_pipeline(publish_artifact(conn, r2, key, title))
+
+def current_queue():
+    job = get_current_job()
+    return Queue(job.origin, connection=job.connection)
 
+def process_batch_item(batch_id, index, url, user_id):
+    """Process one URL of a batch, then start the next pending one"""
+    result = {'status': 'error', 'success': False, 'error': 'Job interrupted', 'error_code': progress.ERROR_INTERNAL}
+    try:
+        result = process_youtube_url(url, user_id)
+        return result
+    finally:
+        batch.finish_item(current_queue(), batch_id, index, result)
+
+def playlist_extractor():
+    """The YoutubeDL that lists playlists, kept warm like the download engines"""
+    return engine.extractor('playlist', playlistend=batch.MAX_ITEMS)
+
+def expand_playlist(batch_id, url, user_id, concurrency=batch.DEFAULT_CONCURRENCY, bundle=False):
+    """List the videos of a playlist and start them as a batch"""
+    queue = current_queue()
+    try:
+        info = playlist_extractor().extract_info(url, download=False)
+        entries = [entry for entry in info.get('entries') or [] if entry]
+        if not entries:
+            batch.fail(queue.connection, batch_id, 'Playlist is empty')
+            return
+        # Flat entries carry each video's length, which sets its job timeout
+        batch.start(queue, batch_id, user_id, [entry.get('webpage_url') or entry['url'] for entry in entries],
+                    concurrency, bundle, [entry.get('duration') for entry in entries])
     except Exception as e:
-        return {
-            'status': 'error',
-            'error': str(e)
-        }
+        batch.fail(queue.connection, batch_id, str(e))
+
+def bundle_member(conn, r2, bucket, object_key):
+    """Body of a finished item's file, kept for the bundle's URL; None if it is gone"""
+    key = cache.key_for_object(object_key)
+    if key and not storage.keep_artifact(conn, key):
+        return None
+    try:
+        return r2.get_object(Bucket=bucket, Key=object_key)['Body']
+    except Exception as e:
+        if storage.is_not_found(e):
+            return None
+        raise
+
+def bundle_batch(batch_id):
+    """Zip the finished files of a batch into one download"""
+    conn = get_redis()
+    r2 = get_r2_client()
+    bucket = os.environ['R2_BUCKET']
+    bundle_key = f"bundles/{batch_id}.zip"
+
+    skipped = []
+    try:
+        with tempfile.TemporaryFile() as archive:
+            # Compressed audio does not shrink further; store files as-is
+            with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED) as zf:
+                for index, result in sorted(batch.results(conn, batch_id).items()):
+                    if not result.get('success'):
+                        continue
+                    body = bundle_member(conn, r2, bucket, result['object_key'])
+                    if body is None:
+                        # Items are held for the bundle; one lost anyway is left out
+                        logger.warning('Item %d of batch %s is gone, leaving it out of the bundle',
+                                       index, batch_id)
+                        skipped.append(index)
+                        continue
+                    ext = os.path.splitext(result['object_key'])[1]
+                    name = f"{index + 1:02d} - {result['title'].replace('/', '_')}{ext}"
+                    with zf.open(name, 'w') as member:
+                        for chunk in body.iter_chunks(1024 * 1024):
+                            member.write(chunk)
+            archive.seek(0)
+            r2.upload_fileobj(archive, bucket, bundle_key,
+                              ExtraArgs={'ContentType': 'application/zip'},
+                              Config=storage.transfer_config())
+
+        storage.schedule_expiry(conn, bundle_key, time.time() + cache.ARTIFACT_TTL)
+        bundle_url = r2.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': bucket, 'Key': bundle_key},
+            ExpiresIn=cache.ARTIFACT_TTL
+        )
+        batch.finish_bundle(conn, batch_id, bundle_url, skipped)
+    except Exception as e:
+        batch.fail(conn, batch_id, f"Bundling failed: {e}")
@@ -0,0 +1,80 @@
+"""Serve the app under gevent, hold many long-polls open and submit a download
+whose probe keeps a CPU busy; prints when each finished.
+
+Run in its own process by tests/test_url_server.py, since monkey-patching
+cannot be undone.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import json
+import sys
+import time
+import urllib.parse
+import urllib.request
+
+import fakeredis
+import gevent
+from gevent.pywsgi import WSGIServer
+from rq import Queue
+
+import events
+import probe
+import progress
+import url_server
+
+HELD, PROBE_SECONDS = int(sys.argv[1]), float(sys.argv[2])
+INFO = {'id': 'abc', 'extractor_key': 'Generic', 'title': 'Song', 'duration': 180}
+
+conn = fakeredis.FakeRedis()
+url_server.redis_conn = conn
+url_server.event_hub = events.Hub(conn)
+url_server.high_q = Queue('high', connection=conn)
+url_server.queue_full = lambda queue, needed=1: None
+url_server.limiter.enabled = False
+times = {}
+
+
+def slow_extract(url, ydl):
+    # yt-dlp's player and signature work: pure CPU, no I/O to yield on
+    deadline = time.monotonic() + PROBE_SECONDS
+    while time.monotonic() < deadline:
+        pass
+    times['probe'] = time.monotonic()
+    return INFO
+
+
+probe._extract_info = slow_extract
+
+server = WSGIServer(('127.0.0.1', 0), url_server.app, log=None, error_log=None)
+server.start()
+base = f'http://127.0.0.1:{server.server_port}'
+
+
+def poll():
+    with urllib.request.urlopen(f'{base}/status/job?wait=20', timeout=30) as response:
+        return json.load(response)['status'], time.monotonic()
+
+
+def submit():
+    data = urllib.parse.urlencode({'url': 'https://example.com/song'}).encode()
+    with urllib.request.urlopen(f'{base}/download', data, timeout=30) as response:
+        return response.status
+
+
+progress.create(conn, 'job')
+polls = [gevent.spawn(poll) for _ in range(HELD)]
+deadline = time.monotonic() + 30
+while url_server.event_hub.listener_count() < HELD and time.monotonic() < deadline:
+    gevent.sleep(0.05)
+
+download = gevent.spawn(submit)
+gevent.sleep(0.2)
+progress.finish(conn, 'job', {'success': True})
+gevent.joinall(polls + [download], timeout=30)
+
+print(json.dumps({
+    'finished': sum(1 for p in polls if p.value and p.value[0] == 'finished'),
+    'before_probe': sum(1 for p in polls if p.value and p.value[1] < times.get('probe', 0)),
+    'download': download.value,
+}))
@@ -0,0 +1,56 @@
+import fakeredis
+from rq import Queue
+import admission
+
+def test_retry_after_when_queue_has_room():
+    """Test that a queue below the limit admits new work"""
+    queue = Queue('high', connection=fakeredis.FakeRedis())
+    queue.enqueue('tasks.process_youtube_url', args=('url', 'user'))
+    assert admission.retry_after(queue, max_depth=2) is None
+
+def test_retry_after_when_queue_is_full():
+    """Test that a full queue is refused with an estimate scaled by the excess"""
+    queue = Queue('high', connection=fakeredis.FakeRedis())
+    for _ in range(3):
+        queue.enqueue('tasks.process_youtube_url', args=('url', 'user'))
+    one = admission.retry_after(queue, max_depth=3)
+    five = admission.retry_after(queue, needed=5, max_depth=3)
+    assert one == admission.AVG_JOB_SECONDS
+    assert five == 5 * admission.AVG_JOB_SECONDS
+
+def test_lanes_follow_track_length():
+    """Test that short, medium and long tracks take separate lanes with scaled timeouts"""
+    assert admission.lane(None) == admission.HIGH_PRIORITY
+    assert admission.lane(200) == admission.HIGH_PRIORITY
+    assert admission.lane(admission.SHORT_TRACK_SECONDS + 1) == admission.MEDIUM_PRIORITY
+    assert admission.lane(3 * 3600) == admission.LONG_PRIORITY
+
+    assert admission.job_timeout(None) == admission.DEFAULT_TIMEOUT
+    assert admission.job_timeout(200) == admission.DEFAULT_TIMEOUT
+    assert admission.job_timeout(3 * 3600) == 3 * 3600 * admission.TIMEOUT_PER_AUDIO_SECOND
+
+def test_estimated_wait_counts_faster_lanes_ahead():
+    """Test that the wait for a lane includes the jobs waiting in it and the lanes drained before it"""
+    conn = fakeredis.FakeRedis()
+    assert admission.estimated_wait(conn, admission.HIGH_PRIORITY) == 0
+    for _ in range(2):
+        Queue('high', connection=conn).enqueue('tasks.process_youtube_url', args=('url', 'user'))
+    Queue('long', connection=conn).enqueue('tasks.process_youtube_url', args=('url', 'user'))
+    admission.record_job_seconds(conn, 'high', 10)
+    admission.record_job_seconds(conn, 'high', 20)
+    admission.record_job_seconds(conn, 'long', 600)
+
+    assert admission.estimated_wait(conn, admission.HIGH_PRIORITY) == 30
+    assert admission.estimated_wait(conn, admission.LONG_PRIORITY) == 630
+    assert admission.estimated_wait(conn, 'fetch') is None
+
+def test_lane_average_follows_recent_jobs():
+    """Test that old samples are halved away once the window fills"""
+    conn = fakeredis.FakeRedis()
+    for _ in range(admission.LANE_WINDOW):
+        admission.record_job_seconds(conn, 'high', 100)
+    for _ in range(admission.LANE_WINDOW // 2):
+        admission.record_job_seconds(conn, 'high', 10)
+    fields = conn.hgetall(admission.LANE_SECONDS_KEY)
+    average = float(fields[b'high:sum']) / float(fields[b'high:count'])
+    assert average < 60
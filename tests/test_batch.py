@@ -0,0 +1,133 @@
+import io
+import zipfile
+import fakeredis
+import pytest
+from rq import Queue
+import batch
+import cache
+
+@pytest.fixture
+def queue():
+    return Queue(connection=fakeredis.FakeRedis())
+
+def test_start_limits_concurrency(queue):
+    """Test that only `concurrency` items are enqueued up front"""
+    urls = [f'https://youtu.be/video{i:06d}' for i in range(5)]
+    jobs = batch.start(queue, 'b1', 'user', urls, concurrency=2)
+
+    assert [job.id for job in jobs] == ['b1-0', 'b1-1']
+    assert queue.job_ids == ['b1-0', 'b1-1']
+    status = batch.status(queue.connection, 'b1')
+    assert [item['status'] for item in status['items']] == ['queued', 'queued', 'pending', 'pending', 'pending']
+
+def test_finish_item_frees_slot(queue):
+    """Test that a finished item starts the next pending one and records its result"""
+    urls = [f'https://youtu.be/video{i:06d}' for i in range(3)]
+    batch.start(queue, 'b1', 'user', urls, concurrency=2)
+
+    batch.finish_item(queue, 'b1', 0, {'success': True, 'title': 'One'})
+    assert queue.job_ids == ['b1-0', 'b1-1', 'b1-2']
+    assert queue.fetch_job('b1-2').args == ('b1', 2, urls[2], 'user')
+
+    batch.finish_item(queue, 'b1', 1, {'success': False, 'error': 'Unavailable'})
+    batch.finish_item(queue, 'b1', 2, {'success': True, 'title': 'Three'})
+    status = batch.status(queue.connection, 'b1')
+    assert (status['status'], status['done'], status['failed']) == ('finished', 3, 1)
+    assert status['items'][0]['result']['title'] == 'One'
+
+def test_finish_last_item_enqueues_bundle(queue):
+    """Test that the zip bundle is built once every item is done"""
+    batch.start(queue, 'b1', 'user', ['https://youtu.be/video000000'], bundle=True)
+    batch.finish_item(queue, 'b1', 0, {'success': True, 'title': 'One'})
+    assert 'b1-bundle' in queue.job_ids
+    assert batch.status(queue.connection, 'b1')['status'] == 'bundling'
+
+def test_killed_item_fails_and_frees_its_slot(queue):
+    """Test that an item whose work-horse was killed is marked failed and the batch moves on"""
+    import tasks
+    urls = [f'https://youtu.be/video{i:06d}' for i in range(2)]
+    batch.start(queue, 'b1', 'user', urls, concurrency=1)
+
+    tasks.work_horse_killed(queue.fetch_job('b1-0'), 1234, 9, None)
+    assert queue.job_ids == ['b1-0', 'b1-1']
+    status = batch.status(queue.connection, 'b1')
+    assert status['items'][0]['result']['error_code'] == 'worker_lost'
+    assert (status['status'], status['done'], status['failed']) == ('running', 1, 1)
+
+    # A late report for the same item is not counted again
+    batch.finish_item(queue, 'b1', 0, {'success': True, 'title': 'One'})
+    batch.finish_item(queue, 'b1', 1, {'success': True, 'title': 'Two'})
+    status = batch.status(queue.connection, 'b1')
+    assert (status['status'], status['done'], status['failed']) == ('finished', 2, 1)
+
+class Body:
+    def __init__(self, data):
+        self.data = data
+
+    def iter_chunks(self, size):
+        yield self.data
+
+class BundleR2:
+    def __init__(self, objects):
+        self.objects = objects
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise NotFound()
+        return {'Body': Body(self.objects[Key])}
+
+    def upload_fileobj(self, fileobj, bucket, key, **kwargs):
+        self.objects[key] = fileobj.read()
+
+    def generate_presigned_url(self, *args, **kwargs):
+        return 'https://r2.example.com/bundle'
+
+class NotFound(Exception):
+    response = {'Error': {'Code': 'NoSuchKey'}}
+
+def test_bundle_holds_items_and_skips_lost_ones(queue, monkeypatch):
+    """Test that bundled items outlive the cache TTL and one lost anyway is reported, not fatal"""
+    import tasks
+    conn = queue.connection
+    keys = [f'youtube:video00000{i}:mp3-192' for i in range(3)]
+    r2 = BundleR2({cache.object_key(keys[0]): b'one', cache.object_key(keys[1]): b'two'})
+    monkeypatch.setattr(tasks, 'get_redis', lambda: conn)
+    monkeypatch.setattr(tasks, 'get_r2_client', lambda: r2)
+    monkeypatch.setenv('R2_BUCKET', 'bucket')
+    batch.start(queue, 'b1', 'user', [f'https://youtu.be/video00000{i}' for i in range(3)], bundle=True)
+
+    for i, title in enumerate(['One', 'Two']):
+        cache.store(conn, keys[i], title)
+        batch.finish_item(queue, 'b1', i, {'success': True, 'title': title, 'object_key': cache.object_key(keys[i])})
+    batch.finish_item(queue, 'b1', 2, {'success': False, 'error': 'Unavailable'})
+    assert conn.ttl(cache.ARTIFACT_PREFIX + keys[0]) > cache.ARTIFACT_TTL
+    # A cache hit meanwhile does not cut the hold short
+    cache.acquire(conn, keys[0])
+    assert conn.ttl(cache.ARTIFACT_PREFIX + keys[0]) > cache.ARTIFACT_TTL
+
+    # Item 1's file went missing all the same
+    del r2.objects[cache.object_key(keys[1])]
+    tasks.bundle_batch('b1')
+
+    status = batch.status(conn, 'b1')
+    assert (status['status'], status['bundle_url'], status['bundle_skipped']) == (
+        'finished', 'https://r2.example.com/bundle', [1])
+    with zipfile.ZipFile(io.BytesIO(r2.objects['bundles/b1.zip'])) as zf:
+        assert zf.namelist() == ['01 - One.mp3']
+        assert zf.read('01 - One.mp3') == b'one'
+
+def test_item_timeouts_follow_durations(queue):
+    """Test that a long mix in a playlist gets a timeout scaled to its length, now and when it is dequeued later"""
+    urls = [f'https://youtu.be/video{i:06d}' for i in range(3)]
+    batch.start(queue, 'b1', 'user', urls, concurrency=2, durations=[3 * 3600, None, 3 * 3600])
+    assert queue.fetch_job('b1-0').timeout == batch.admission.job_timeout(3 * 3600)
+    assert queue.fetch_job('b1-1').timeout == batch.admission.DEFAULT_TIMEOUT
+
+    batch.finish_item(queue, 'b1', 0, {'success': True, 'title': 'One'})
+    assert queue.fetch_job('b1-2').timeout == batch.admission.job_timeout(3 * 3600)
+
+def test_is_playlist():
+    """Test that only playlist URLs without a selected video are expanded"""
+    assert batch.is_playlist('https://www.youtube.com/playlist?list=PL123')
+    assert not batch.is_playlist('https://www.youtube.com/watch?v=dQw4w9WgXcQ&list=PL123')
+    assert not batch.is_playlist('https://youtu.be/dQw4w9WgXcQ')
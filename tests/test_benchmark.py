@@ -0,0 +1,13 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+import bench_pipeline
+
+def test_benchmark_runs_offline():
+    """Test that a tiny benchmark completes every job against the fakes"""
+    results = bench_pipeline.run(jobs=4, clients=2, workers=1, fixture_seconds=1, streaming=False)
+    assert results['errors'] == 0, results['error_samples']
+    assert results['uploaded_objects'] == 4
+    assert results['web']['end_to_end']['count'] == 4
+    assert results['worker']['tinnito_stage_seconds:upload']['count'] == 4
@@ -0,0 +1,58 @@
+import fakeredis
+import pytest
+import cache
+
+@pytest.mark.parametrize('url', [
+    'https://www.youtube.com/watch?v=dQw4w9WgXcQ',
+    'https://youtube.com/watch?v=dQw4w9WgXcQ&list=PL123&t=42',
+    'https://youtu.be/dQw4w9WgXcQ?si=abc',
+    'https://m.youtube.com/shorts/dQw4w9WgXcQ',
+    'https://music.youtube.com/watch?v=dQw4w9WgXcQ',
+])
+def test_parse_video_id(url):
+    """Test that common YouTube URL shapes map to the same video"""
+    assert cache.parse_video_id(url) == ('youtube', 'dQw4w9WgXcQ')
+
+@pytest.mark.parametrize('url', [
+    'https://example.com/watch?v=dQw4w9WgXcQ',
+    'https://www.youtube.com/watch?v=short',
+    'https://www.youtube.com/playlist?list=PL123',
+    'not a url',
+])
+def test_parse_video_id_unknown(url):
+    """Test that unrecognised URLs are left to the extractor"""
+    assert cache.parse_video_id(url) is None
+
+def test_object_key_round_trip():
+    """Test that R2 keys of cached files map back to their index entry"""
+    key = cache.artifact_key('Youtube', 'dQw4w9WgXcQ')
+    assert key == 'youtube:dQw4w9WgXcQ:mp3-192'
+    assert cache.object_key(key) == 'cache/youtube/dQw4w9WgXcQ/mp3-192.mp3'
+
+    class FakeRedis:
+        def exists(self, name):
+            return name == cache.ARTIFACT_PREFIX + key
+
+    assert cache.is_live(FakeRedis(), cache.object_key(key))
+    assert not cache.is_live(FakeRedis(), 'someuser/song.mp3')
+
+def test_inflight_claim_is_exclusive():
+    """Test that the second submission of a video gets the first job's ID"""
+    conn = fakeredis.FakeRedis()
+    key = cache.artifact_key('youtube', 'dQw4w9WgXcQ')
+    assert cache.claim(conn, key, 'job-1') is None
+    assert cache.claim(conn, key, 'job-2') == 'job-1'
+
+    # Only the holder can release the claim
+    assert not cache.release(conn, key, 'job-2')
+    assert cache.release(conn, key, 'job-1')
+    assert cache.claim(conn, key, 'job-3') is None
+
+def test_inflight_take_over():
+    """Test that a dead holder's claim can be replaced exactly once"""
+    conn = fakeredis.FakeRedis()
+    key = cache.artifact_key('youtube', 'dQw4w9WgXcQ')
+    cache.claim(conn, key, 'dead')
+    assert cache.take_over(conn, key, 'dead', 'job-1')
+    assert not cache.take_over(conn, key, 'dead', 'job-2')
+    assert cache.claim(conn, key, 'job-3') == 'job-1'
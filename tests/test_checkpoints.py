@@ -0,0 +1,133 @@
+import os
+import urllib.error
+import fakeredis
+import pytest
+import yt_dlp
+import checkpoints
+import localcache
+import tasks
+
+@pytest.fixture
+def conn(monkeypatch, tmp_path):
+    conn = fakeredis.FakeRedis()
+    monkeypatch.setattr(tasks, 'get_redis', lambda: conn)
+    monkeypatch.setattr(tasks, 'RETRY_BACKOFF', 0)
+    monkeypatch.setattr(tasks, 'STREAMING_UPLOADS', False)
+    monkeypatch.setattr(tasks, 'WORK_DIR', str(tmp_path / 'work'))
+    monkeypatch.setattr(localcache, 'MAX_BYTES', 0)
+    monkeypatch.setenv('R2_BUCKET', 'bucket')
+    return conn
+
+class FakeYDL:
+    def __init__(self, work_dir):
+        self.params = {'progress_hooks': []}
+        self.work_dir = work_dir
+        self.downloads = 0
+
+    def process_ie_result(self, info, download=True):
+        self.downloads += 1
+        path = os.path.join(self.work_dir, f"{info['id']}.mp3")
+        with open(path, 'wb') as f:
+            f.write(b'audio')
+        return dict(info, requested_downloads=[{'filepath': path}])
+
+class FlakyR2:
+    def __init__(self, failures):
+        self.failures = failures
+        self.uploads = []
+
+    def upload_file(self, path, bucket, key, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionResetError('connection reset by peer')
+        self.uploads.append(key)
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.uploads:
+            raise NotFound()
+        return {}
+
+class NotFound(Exception):
+    response = {'Error': {'Code': '404'}}
+
+def test_retry_skips_finished_download(conn):
+    """Test that a failed upload is retried without downloading or encoding again"""
+    key = 'youtube:abc:mp3-192'
+    work_dir = tasks.artifact_dir(key)
+    ydl, r2 = FakeYDL(work_dir), FlakyR2(failures=2)
+    info = {'id': 'abc', 'url': 'https://example.com/a', 'protocol': 'https'}
+
+    tasks.retrying(tasks.deliver, conn, ydl, r2, info, key, work_dir, tasks.profiles.get_profile('mp3'))
+    assert ydl.downloads == 1
+    assert r2.uploads == ['cache/youtube/abc/mp3-192.mp3']
+    assert checkpoints.load(conn, key)['stage'] == checkpoints.UPLOADED
+
+    # A resubmission after the upload went through only needs publishing
+    tasks.deliver(conn, ydl, r2, info, key, work_dir, tasks.profiles.get_profile('mp3'))
+    assert (ydl.downloads, len(r2.uploads)) == (1, 1)
+
+def test_swept_upload_is_produced_again(conn):
+    """Test that an upload checkpoint is not trusted once the object has been deleted"""
+    key = 'youtube:abc:mp3-192'
+    work_dir = tasks.artifact_dir(key)
+    ydl, r2 = FakeYDL(work_dir), FlakyR2(failures=0)
+    info = {'id': 'abc', 'url': 'https://example.com/a', 'protocol': 'https'}
+    checkpoints.save(conn, key, checkpoints.UPLOADED)
+
+    tasks.deliver(conn, ydl, r2, info, key, work_dir, tasks.profiles.get_profile('mp3'))
+    assert ydl.downloads == 1
+    assert r2.uploads == ['cache/youtube/abc/mp3-192.mp3']
+
+def test_second_job_waits_for_the_artifact_lease(conn, monkeypatch):
+    """Test that a job for an artifact another live job is producing waits, then takes over once it ends"""
+    key = 'youtube:abc:mp3-192'
+    tasks.progress.create(conn, 'job-a')
+    assert checkpoints.lease(conn, key, 'job-a', 60) is None
+
+    waits = []
+
+    def first_job_finishes(seconds):
+        waits.append(seconds)
+        # Ends without releasing its lease, as if its work-horse was killed
+        tasks.progress.finish(conn, 'job-a', {'success': False, 'error': 'killed'})
+    monkeypatch.setattr(tasks.time, 'sleep', first_job_finishes)
+
+    with tasks.artifact_lease(conn, key):
+        assert checkpoints.lease(conn, key, 'job-c', 60) not in (None, 'job-a')
+    assert waits == [tasks.LEASE_POLL_SECONDS]
+    assert checkpoints.lease(conn, key, 'job-c', 60) is None
+
+def test_permanent_failures_are_not_retried(conn):
+    """Test that retrying gives up at once on errors a retry cannot fix"""
+    calls = []
+
+    def step():
+        calls.append(1)
+        raise urllib.error.HTTPError('https://example.com', 403, 'Forbidden', {}, None)
+    with pytest.raises(urllib.error.HTTPError):
+        tasks.retrying(step)
+    assert len(calls) == 1
+
+def test_transient_errors_are_recognised_through_wrappers():
+    """Test that network errors wrapped by yt-dlp or the ranged fetcher count as transient"""
+    try:
+        raise ConnectionResetError('reset')
+    except ConnectionResetError as e:
+        wrapped = yt_dlp.utils.DownloadError('ERROR: unable to download', exc_info=(type(e), e, None))
+    assert tasks.is_transient(wrapped)
+    try:
+        raise tasks.ranged.FetchError('Giving up') from TimeoutError('timed out')
+    except tasks.ranged.FetchError as e:
+        assert tasks.is_transient(e)
+    assert not tasks.is_transient(ValueError('Unknown format'))
+    assert not tasks.is_transient(urllib.error.HTTPError('u', 404, 'Not Found', {}, None))
+    assert tasks.is_transient(urllib.error.HTTPError('u', 503, 'Unavailable', {}, None))
+
+def test_checkpoint_needs_its_file(conn, tmp_path):
+    """Test that a checkpoint whose file is gone (e.g. another host's disk) does not count"""
+    path = tmp_path / 'song.mp3'
+    checkpoints.save(conn, 'k', checkpoints.ENCODED, str(path))
+    assert not checkpoints.reached(checkpoints.load(conn, 'k'), checkpoints.DOWNLOADED)
+    path.write_bytes(b'x')
+    assert checkpoints.reached(checkpoints.load(conn, 'k'), checkpoints.DOWNLOADED)
+    assert not checkpoints.reached(checkpoints.load(conn, 'k'), checkpoints.UPLOADED)
@@ -0,0 +1,75 @@
+import threading
+import pytest
+import profiles
+from downloader import engine
+
+@pytest.fixture(autouse=True)
+def fresh_engines():
+    engine._engines().clear()
+    yield
+    engine._engines().clear()
+
+def test_engine_is_reused_per_profile():
+    """Test that a thread gets the same engine back for the same profile and mode"""
+    mp3 = profiles.get_profile('mp3')
+    first = engine.get_engine(mp3)
+    assert engine.get_engine(mp3) is first
+    assert engine.get_engine(mp3, convert=False) is not first
+    assert engine.get_engine(profiles.get_profile('opus')) is not first
+
+def test_engines_are_per_thread():
+    """Test that another thread builds its own engine instead of sharing one"""
+    mp3 = profiles.get_profile('mp3')
+    mine = engine.get_engine(mp3)
+    theirs = []
+    thread = threading.Thread(target=lambda: theirs.append(engine.get_engine(mp3)))
+    thread.start()
+    thread.join()
+    assert theirs[0] is not mine
+
+def test_extractors_are_reused_per_purpose():
+    """Test that metadata-only YoutubeDLs are built once per purpose and options, on top of the shared ones"""
+    probe = engine.extractor('probe')
+    assert engine.extractor('probe') is probe
+    assert probe.params['format'] == 'bestaudio/best' and probe.params['quiet'] is True
+
+    playlist = engine.extractor('playlist', playlistend=5)
+    assert engine.extractor('playlist', playlistend=5) is playlist
+    assert engine.extractor('playlist', playlistend=10) is not playlist
+    assert playlist.params['extract_flat'] == 'in_playlist' and playlist.params['playlistend'] == 5
+
+def test_options_follow_profile():
+    """Test that options carry the profile's format and conversion only when converting"""
+    opus = profiles.get_profile('opus')
+    converting = engine.options(opus)
+    assert converting['format'] == opus['format']
+    assert converting['postprocessors']
+    assert converting['noplaylist'] is True
+
+    source_only = engine.options(opus, convert=False)
+    assert source_only['format'] == opus['format']
+    assert 'postprocessors' not in source_only
+
+def test_job_sets_and_resets_output_and_hooks():
+    """Test that a job's output template and hooks apply only for the duration of the job"""
+    warm = engine.get_engine(profiles.get_profile('mp3'))
+    seen = []
+    with warm.job('/tmp/job/%(id)s.%(ext)s', [seen.append]) as ydl:
+        assert ydl.params['outtmpl']['default'] == '/tmp/job/%(id)s.%(ext)s'
+        for hook in ydl._progress_hooks:
+            hook({'status': 'downloading'})
+    assert seen == [{'status': 'downloading'}]
+    assert warm.ydl.params['outtmpl']['default'] == engine.DEFAULT_OUTTMPL
+
+    for hook in warm.ydl._progress_hooks:
+        hook({'status': 'finished'})
+    assert len(seen) == 1
+
+def test_failed_job_discards_engine():
+    """Test that an engine whose job raised is rebuilt for the next job"""
+    mp3 = profiles.get_profile('mp3')
+    failed = engine.get_engine(mp3)
+    with pytest.raises(RuntimeError):
+        with failed.job():
+            raise RuntimeError('extractor broke')
+    assert engine.get_engine(mp3) is not failed
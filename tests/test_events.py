@@ -0,0 +1,63 @@
+import threading
+import fakeredis
+import events
+
+def test_listen_stops_on_terminal_snapshot():
+    """Test that a finished job yields its snapshot and nothing else"""
+    conn = fakeredis.FakeRedis()
+    snapshot = {'id': 'job', 'status': 'finished', 'progress': 1.0}
+    assert list(events.listen(conn, 'job', lambda: snapshot, timeout=5)) == [snapshot]
+
+def test_listen_streams_published_updates():
+    """Test that updates published by the worker reach the listener in order"""
+    conn = fakeredis.FakeRedis()
+    updates = events.listen(conn, 'job', lambda: {'status': 'queued'}, timeout=5)
+    assert next(updates) == {'status': 'queued'}
+
+    def worker():
+        events.publish(conn, 'job', {'status': 'started', 'progress': 0.5})
+        events.publish(conn, 'job', {'status': 'finished', 'progress': 1.0})
+    threading.Thread(target=worker).start()
+
+    assert list(updates) == [
+        {'status': 'started', 'progress': 0.5},
+        {'status': 'finished', 'progress': 1.0},
+    ]
+
+def test_listen_times_out():
+    """Test that a quiet job ends the stream at the deadline"""
+    conn = fakeredis.FakeRedis()
+    updates = list(events.listen(conn, 'job', lambda: {'status': 'queued'}, timeout=0.2))
+    assert updates == [{'status': 'queued'}]
+
+def test_hub_fans_out_to_many_listeners():
+    """Test that thousands of listeners share one subscription and all get the update"""
+    conn = fakeredis.FakeRedis()
+    hub = events.Hub(conn)
+    try:
+        queues = [hub.subscribe('job') for _ in range(2000)]
+        other = hub.subscribe('other')
+        assert hub.listener_count() == 2001
+
+        events.publish(conn, 'job', {'status': 'finished'})
+        assert all(q.get(timeout=5) == {'status': 'finished'} for q in queues)
+        assert other.empty()
+
+        for q in queues:
+            hub.unsubscribe('job', q)
+        assert hub.listener_count() == 1
+    finally:
+        hub.stop()
+
+def test_listen_through_hub():
+    """Test that listen() delivers updates from a hub like from its own subscription"""
+    conn = fakeredis.FakeRedis()
+    hub = events.Hub(conn)
+    try:
+        updates = events.listen(conn, 'job', lambda: {'status': 'queued'}, timeout=5, hub=hub)
+        assert next(updates) == {'status': 'queued'}
+        events.publish(conn, 'job', {'status': 'finished'})
+        assert list(updates) == [{'status': 'finished'}]
+        assert hub.listener_count() == 0
+    finally:
+        hub.stop()
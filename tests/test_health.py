@@ -0,0 +1,58 @@
+import time
+import health
+
+class Clock:
+    def __init__(self):
+        self.now = 1700000000.0
+
+    def __call__(self):
+        return self.now
+
+def failing():
+    raise ConnectionError('refused')
+
+def test_snapshot_reads_cached_results():
+    """Test that health responses come from the last run, not a new check"""
+    calls = []
+    prober = health.HealthProber({'redis': lambda: calls.append(1)}, interval=10, clock=Clock())
+    assert not prober.is_ready()
+
+    status = prober.snapshot()
+    assert status['status'] == 'healthy'
+    assert status['checks']['redis']['status'] == 'healthy'
+    prober.snapshot()
+    assert prober.is_ready()
+    assert len(calls) == 1
+
+def test_failed_check_makes_service_unready():
+    """Test that one failing dependency marks the whole service unhealthy"""
+    prober = health.HealthProber({'redis': lambda: None, 'r2_storage': failing}, clock=Clock())
+    prober.run_checks()
+    status = prober.snapshot()
+    assert status['status'] == 'unhealthy'
+    assert status['checks']['r2_storage']['error'] == 'refused'
+    assert not prober.is_ready()
+
+def test_stale_results_are_not_ready():
+    """Test that a prober that stopped refreshing stops reporting ready"""
+    clock = Clock()
+    prober = health.HealthProber({'redis': lambda: None}, interval=10, clock=clock)
+    prober.run_checks()
+    assert prober.is_ready()
+    clock.now += 31
+    assert not prober.is_ready()
+    assert prober.snapshot()['stale']
+
+def test_background_thread_refreshes():
+    """Test that the prober keeps checking on its own"""
+    calls = []
+    prober = health.HealthProber({'redis': lambda: calls.append(1)}, interval=0.01)
+    prober.start()
+    try:
+        deadline = time.monotonic() + 2
+        while len(calls) < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert len(calls) >= 3
+        assert prober.is_ready()
+    finally:
+        prober.stop()
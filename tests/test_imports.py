@@ -0,0 +1,43 @@
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Every gunicorn worker pays for what url_server imports, on each start and
+# on each recycle after max_requests. Budgets leave headroom for slow CI.
+IMPORT_SECONDS_BUDGET = 1.5
+RSS_MB_BUDGET = 50
+# Needed by workers only; the web tier enqueues tasks by name
+WORKER_ONLY_MODULES = ['tasks', 'yt_dlp', 'boto3', 'botocore', 's3transfer']
+
+MEASURE = """
+import json, os, resource, sys, time
+started = time.perf_counter()
+import url_server
+seconds = time.perf_counter() - started
+if os.path.exists('/proc/self/statm'):
+    # ru_maxrss would include the forking parent's peak on Linux
+    with open('/proc/self/statm') as f:
+        rss_mb = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+else:
+    rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024)
+print(json.dumps({'seconds': seconds, 'rss_mb': rss_mb, 'modules': sorted(sys.modules)}))
+"""
+
+def measure_web_import():
+    output = subprocess.run([sys.executable, '-c', MEASURE], cwd=ROOT, capture_output=True,
+                            text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def test_web_tier_does_not_load_worker_modules():
+    """Test that importing url_server leaves yt-dlp, boto3 and the task code unloaded"""
+    loaded = measure_web_import()['modules']
+    assert [name for name in WORKER_ONLY_MODULES if name in loaded] == []
+
+def test_web_tier_import_budget():
+    """Test that url_server imports within its time and memory budget"""
+    result = measure_web_import()
+    assert result['seconds'] < IMPORT_SECONDS_BUDGET
+    assert result['rss_mb'] < RSS_MB_BUDGET
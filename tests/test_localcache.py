@@ -0,0 +1,66 @@
+import os
+import pytest
+import localcache
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(localcache, 'CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(localcache, 'MAX_BYTES', 1024 * 1024)
+    return tmp_path / 'cache'
+
+def write(path, size):
+    path.write_bytes(b'x' * size)
+    return str(path)
+
+def test_put_then_get(tmp_path):
+    """Test that a cached file is found under its object key"""
+    source = write(tmp_path / 'song.mp3', 100)
+    cached = localcache.put(source, 'cache/youtube/abc/mp3-192.mp3')
+    assert localcache.get('cache/youtube/abc/mp3-192.mp3') == cached
+    assert open(cached, 'rb').read() == b'x' * 100
+    assert localcache.get('cache/youtube/other/mp3-192.mp3') is None
+
+def test_evicts_least_recently_used(tmp_path):
+    """Test that the least recently read files go first once the cache is over its size"""
+    for i, name in enumerate(['a', 'b', 'c']):
+        path = localcache.put(write(tmp_path / name, 400), f'cache/youtube/{name}/mp3-192.mp3', max_bytes=2000)
+        os.utime(path, (1000 + i, 1000 + i))
+    # Reading 'a' makes it the most recently used
+    assert localcache.get('cache/youtube/a/mp3-192.mp3')
+
+    localcache.put(write(tmp_path / 'd', 400), 'cache/youtube/d/mp3-192.mp3', max_bytes=1200)
+    assert localcache.contains('cache/youtube/a/mp3-192.mp3')
+    assert not localcache.contains('cache/youtube/b/mp3-192.mp3')
+    assert localcache.contains('cache/youtube/c/mp3-192.mp3')
+    assert localcache.contains('cache/youtube/d/mp3-192.mp3')
+
+def test_rejects_keys_outside_cache(tmp_path):
+    """Test that object keys cannot name files outside the cache directory"""
+    source = write(tmp_path / 'song.mp3', 10)
+    assert localcache.put(source, '../escape.mp3') is None
+    assert localcache.get('/etc/passwd') is None
+    assert localcache.path_for('cache//x.mp3') is None
+
+def test_oversized_file_is_not_cached(tmp_path):
+    """Test that a file larger than the whole cache is skipped instead of evicting everything"""
+    kept = localcache.put(write(tmp_path / 'small', 10), 'cache/youtube/s/mp3-192.mp3', max_bytes=100)
+    assert localcache.put(write(tmp_path / 'big', 200), 'cache/youtube/b/mp3-192.mp3', max_bytes=100) is None
+    assert os.path.exists(kept)
+
+def test_partial_is_invisible_until_committed():
+    """Test that a file written as it is produced only appears in the cache on commit"""
+    partial = localcache.Partial('cache/youtube/abc/mp3-192.mp3')
+    partial.write(b'a' * 100)
+    assert not localcache.contains('cache/youtube/abc/mp3-192.mp3')
+    path = partial.commit()
+    assert localcache.get('cache/youtube/abc/mp3-192.mp3') == path
+    assert open(path, 'rb').read() == b'a' * 100
+
+def test_partial_too_large_is_abandoned(cache_dir):
+    """Test that a partial outgrowing the cache is dropped without leaving a temp file"""
+    partial = localcache.Partial('cache/youtube/abc/mp3-192.mp3', max_bytes=150)
+    partial.write(b'a' * 100)
+    partial.write(b'a' * 100)
+    assert partial.commit() is None
+    assert not localcache.contains('cache/youtube/abc/mp3-192.mp3')
+    assert [p for p in cache_dir.rglob('*') if p.is_file()] == []
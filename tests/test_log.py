@@ -0,0 +1,199 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import pytest
+import log
+
+def make_record(name='tinnito.tasks', level=logging.INFO, msg='hello %s', args=('world',), **extra):
+    record = logging.LogRecord(name, level, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+def test_json_lines_carry_ids_and_extra_fields():
+    """Test that a formatted record is one JSON object with the correlation ids and extra fields"""
+    line = log.JsonFormatter('worker').format(make_record(job_id='job-1', request_id='req-1', attempt=2))
+    entry = json.loads(line)
+    assert '\n' not in line
+    assert entry['msg'] == 'hello world'
+    assert entry['component'] == 'worker'
+    assert entry['level'] == 'INFO'
+    assert (entry['job_id'], entry['request_id'], entry['attempt']) == ('job-1', 'req-1', 2)
+
+def test_prepare_binds_context_and_resolves_message():
+    """Test that records take the job and request ids bound where they were logged"""
+    handler = log.QueueHandler('worker')
+    with log.bind(job_id='job-1'):
+        token = log.bind_request('req-1')
+        try:
+            raise RuntimeError('boom')
+        except RuntimeError:
+            record = make_record(exc_info=None)
+            record.exc_info = sys.exc_info()
+            record = handler.prepare(record)
+        log.unbind_request(token)
+    assert log.current_ids() == {'job_id': None, 'request_id': None}
+    assert (record.job_id, record.request_id) == ('job-1', 'req-1')
+    assert record.msg == 'hello world' and record.args is None
+    assert record.exc_info is None and 'RuntimeError: boom' in record.exc_text
+
+def test_sampling_keeps_warnings_and_marks_rate():
+    """Test that sampled loggers keep a fraction of INFO records and every warning"""
+    sampler = log.SamplingFilter({'tinnito.access': 0.1}, rand=lambda: 0.5)
+    assert not sampler.filter(make_record('tinnito.access'))
+    assert sampler.filter(make_record('tinnito.access', level=logging.WARNING))
+    assert sampler.filter(make_record('tinnito.tasks'))
+
+    kept = make_record('tinnito.access.slow')
+    assert log.SamplingFilter({'tinnito.access': 0.1}, rand=lambda: 0.05).filter(kept)
+    assert kept.sample_rate == 0.1
+
+def test_parse_sample_rates():
+    """Test that sample rates are parsed per logger and clamped to [0, 1]"""
+    assert log.parse_sample_rates('tinnito.access=0.1, tinnito.progress=2,bad') == {
+        'tinnito.access': 0.1, 'tinnito.progress': 1.0}
+
+def test_one_process_owns_the_log_file(tmp_path):
+    """Test that the first sink owns the file and a second one sends its lines to it"""
+    log_file, sock_path = str(tmp_path / 'app.log'), str(tmp_path / 'app.sock')
+    owner = log.HostSink(log_file, sock_path, stderr=False)
+    sender = log.HostSink(log_file, sock_path, stderr=False)
+    assert owner.owner and not sender.owner
+
+    owner.write('{"from": "owner"}')
+    sender.write('{"from": "sender"}')
+    for _ in range(100):
+        with open(log_file) as f:
+            lines = f.read().splitlines()
+        if len(lines) == 2:
+            break
+        time.sleep(0.01)
+    assert sorted(lines) == ['{"from": "owner"}', '{"from": "sender"}']
+    owner.close()
+    sender.close()
+
+def read_lines(path, expected, timeout=5.0):
+    """Lines of the log at `path`, waiting for the owner's thread to write `expected` of them"""
+    deadline = time.monotonic() + timeout
+    while True:
+        lines = open(path).read().splitlines() if os.path.exists(path) else []
+        if len(lines) >= expected or time.monotonic() > deadline:
+            return lines
+        time.sleep(0.01)
+
+def fork_owner(log_file, sock_path, clean):
+    """A child process that owns the log until told to exit; returns its pid and the pipe to tell it"""
+    ready_r, ready_w = os.pipe()
+    exit_r, exit_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            owner = log.HostSink(log_file, sock_path, stderr=False)
+            os.write(ready_w, b'1' if owner.owner else b'0')
+            os.read(exit_r, 1)
+            if clean:
+                owner.close()
+        finally:
+            os._exit(0)
+    assert os.read(ready_r, 1) == b'1'
+    return pid, exit_w
+
+@pytest.mark.parametrize('clean', [True, False], ids=['clean-exit', 'killed'])
+def test_sender_takes_over_when_owner_exits(tmp_path, monkeypatch, clean):
+    """Test that a sender becomes the owner once the owning process exits, losing no line uncounted"""
+    monkeypatch.setattr(log, 'TAKEOVER_INTERVAL', 0)
+    log_file, sock_path = str(tmp_path / 'app.log'), str(tmp_path / 'app.sock')
+    pid, exit_w = fork_owner(log_file, sock_path, clean)
+    sender = log.HostSink(log_file, sock_path, stderr=False)
+    assert not sender.owner
+
+    sender.write('{"line": 0}')
+    assert read_lines(log_file, 1) == ['{"line": 0}']
+    os.write(exit_w, b'1')
+    if not clean:
+        os.waitpid(pid, 0)
+    # Lines written while the owner goes away are either delivered or counted
+    for i in range(1, 300):
+        sender.write(f'{{"line": {i}}}')
+    os.waitpid(pid, 0) if clean else None
+    sender.write('{"line": 300}')
+
+    assert sender.owner
+    lines = read_lines(log_file, 301 - sender.dropped)
+    assert len(lines) + sender.dropped == 301
+    assert lines[0] == '{"line": 0}' and lines[-1] == '{"line": 300}'
+    sender.close()
+
+def test_forked_job_logs_survive_os_exit(tmp_path):
+    """Test that a forked work-horse's lines, traceback included, reach the log although it ends with os._exit"""
+    import tasks
+    log_file, sock_path = str(tmp_path / 'app.log'), str(tmp_path / 'app.sock')
+    owner = log.HostSink(log_file, sock_path, stderr=False)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            log._pipeline = log.Pipeline('worker', sink=log.HostSink(log_file, sock_path, stderr=False))
+
+            @tasks.publishes_result
+            def failing_job():
+                for i in range(50):
+                    logging.getLogger('tinnito.tasks').info('step %d', i)
+                raise RuntimeError('boom')
+
+            try:
+                failing_job()
+            except RuntimeError:
+                pass
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
+    entries = [json.loads(line) for line in read_lines(log_file, 51)]
+    assert [entry['msg'] for entry in entries[:50]] == [f'step {i}' for i in range(50)]
+    assert entries[50]['msg'] == 'failing_job failed' and 'RuntimeError: boom' in entries[50]['exc']
+    owner.close()
+
+class ThreadSink:
+    dropped = 0
+
+    def __init__(self):
+        self.threads = []
+
+    def write(self, line):
+        self.threads.append(threading.get_ident())
+
+@pytest.mark.parametrize('component, in_caller', [('worker', True), ('web', False)])
+def test_warnings_are_written_by_the_caller_only_in_workers(monkeypatch, component, in_caller):
+    """Test that a worker writes warnings itself while web requests leave them to the shipping thread"""
+    sink = ThreadSink()
+    monkeypatch.setattr(log, '_pipeline', log.Pipeline(component, sink=sink))
+    log.QueueHandler(component).emit(make_record(level=logging.WARNING))
+    deadline = time.monotonic() + 5
+    while not sink.threads and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert (sink.threads[0] == threading.get_ident()) == in_caller
+
+def test_rotating_file_keeps_backups(tmp_path):
+    """Test that the log file is rotated by size into numbered backups"""
+    path = str(tmp_path / 'app.log')
+    rotating = log.RotatingFile(path, max_bytes=20, backup_count=2)
+    for line in ['a' * 15, 'b' * 15, 'c' * 15, 'd' * 15]:
+        rotating.write(line)
+    rotating.close()
+    assert open(path).read() == 'd' * 15 + '\n'
+    assert open(path + '.1').read() == 'c' * 15 + '\n'
+    assert open(path + '.2').read() == 'b' * 15 + '\n'
+
+class BlockedSink:
+    dropped = 0
+
+    def write(self, line):
+        raise AssertionError('the test never lets the pipeline ship')
+
+def test_full_queue_drops_instead_of_blocking():
+    """Test that records beyond the queue size are counted and dropped, not waited for"""
+    pipeline = log.Pipeline('worker', sink=BlockedSink(), queue_size=0)
+    pipeline.put(make_record())
+    assert pipeline.dropped == 1
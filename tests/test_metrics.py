@@ -0,0 +1,35 @@
+import fakeredis
+import metrics
+
+def test_histogram_buckets_are_cumulative():
+    """Test that an observation counts in every bucket at or above it"""
+    conn = fakeredis.FakeRedis()
+    metrics.observe(conn, 'tinnito_stage_seconds', 3, stage='upload')
+    metrics.observe(conn, 'tinnito_stage_seconds', 0.2, stage='upload')
+    text = metrics.render(conn)
+
+    assert '# TYPE tinnito_stage_seconds histogram' in text
+    assert 'tinnito_stage_seconds_bucket{le="0.1",stage="upload"} 0' in text
+    assert 'tinnito_stage_seconds_bucket{le="0.25",stage="upload"} 1' in text
+    assert 'tinnito_stage_seconds_bucket{le="5",stage="upload"} 2' in text
+    assert 'tinnito_stage_seconds_bucket{le="+Inf",stage="upload"} 2' in text
+    assert 'tinnito_stage_seconds_count{stage="upload"} 2' in text
+    assert 'tinnito_stage_seconds_sum{stage="upload"} 3.2' in text
+
+    # Buckets come out in ascending order
+    lines = [line for line in text.splitlines() if line.startswith('tinnito_stage_seconds_bucket')]
+    assert lines[0].startswith('tinnito_stage_seconds_bucket{le="0.05"')
+    assert lines[-1].startswith('tinnito_stage_seconds_bucket{le="+Inf"')
+
+def test_counters_and_gauges():
+    """Test that counters accumulate across callers and gauges are rendered with them"""
+    conn = fakeredis.FakeRedis()
+    metrics.inc(conn, 'tinnito_jobs_total', task='process_youtube_url', outcome='success')
+    metrics.inc(conn, 'tinnito_jobs_total', task='process_youtube_url', outcome='success')
+    metrics.inc(conn, 'tinnito_bytes_total', 1024, direction='upload')
+    text = metrics.render(conn, {metrics.series('tinnito_queue_depth', queue='high'): 3})
+
+    assert 'tinnito_jobs_total{outcome="success",task="process_youtube_url"} 2' in text
+    assert 'tinnito_bytes_total{direction="upload"} 1024' in text
+    assert '# TYPE tinnito_queue_depth gauge' in text
+    assert 'tinnito_queue_depth{queue="high"} 3' in text
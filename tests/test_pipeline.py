@@ -0,0 +1,70 @@
+import contextlib
+import os
+import sys
+import fakeredis
+import pytest
+from rq import Queue, SimpleWorker
+import localcache
+import progress
+import tasks
+from downloader import engine, stream
+
+INFO = {'id': 'abcdefghijk', 'extractor_key': 'Youtube', 'title': 'Song', 'duration': 3}
+
+@pytest.fixture
+def conn(monkeypatch, tmp_path):
+    conn = fakeredis.FakeRedis()
+    monkeypatch.setattr(tasks, 'get_redis', lambda: conn)
+    monkeypatch.setattr(tasks, 'WORK_DIR', str(tmp_path / 'work'))
+    monkeypatch.setattr(localcache, 'MAX_BYTES', 0)
+    monkeypatch.setenv('R2_BUCKET', 'bucket')
+    return conn
+
+class FakeYDL:
+    def __init__(self, outtmpl):
+        self.outtmpl = outtmpl
+
+    def process_ie_result(self, info, download=True):
+        path = self.outtmpl.replace('%(ext)s', 'webm')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'source audio')
+        return dict(info, requested_downloads=[{'filepath': path}])
+
+class FakeEngine:
+    @contextlib.contextmanager
+    def job(self, outtmpl, progress_hooks=()):
+        yield FakeYDL(outtmpl)
+
+class FakeR2:
+    def __init__(self):
+        self.uploads = {}
+
+    def upload_file(self, path, bucket, key, **kwargs):
+        with open(path, 'rb') as f:
+            self.uploads[key] = f.read()
+
+    def generate_presigned_url(self, *args, **kwargs):
+        return 'https://r2.example.com/signed'
+
+def copy_command(source, output, profile, passthrough=False):
+    return [sys.executable, '-c', f'import shutil; shutil.copy({source!r}, {output!r})']
+
+def test_stages_hand_the_download_on_through_work_dir(conn, monkeypatch):
+    """Test that fetch, transcode and upload jobs run in turn and leave one published result and no files"""
+    r2 = FakeR2()
+    monkeypatch.setattr(engine, 'get_engine', lambda profile, convert=True: FakeEngine())
+    monkeypatch.setattr(tasks.probe, 'extract', lambda conn, url, ydl: (INFO, False))
+    monkeypatch.setattr(tasks, 'get_r2_client', lambda: r2)
+    monkeypatch.setattr(stream, 'file_command', copy_command)
+
+    job = Queue('fetch', connection=conn).enqueue('tasks.fetch_stage', args=('https://youtu.be/abcdefghijk', 'user'))
+    progress.create(conn, job.id)
+    for name in ('fetch', 'transcode', 'upload'):
+        assert Queue(name, connection=conn).count == 1
+        SimpleWorker([Queue(name, connection=conn)], connection=conn).work(burst=True)
+
+    status = progress.status(conn, job.id)
+    assert status['status'] == 'finished' and status['result']['download_url'] == 'https://r2.example.com/signed'
+    assert r2.uploads == {'cache/youtube/abcdefghijk/mp3-192.mp3': b'source audio'}
+    assert os.listdir(tasks.WORK_DIR) == []
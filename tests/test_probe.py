@@ -0,0 +1,55 @@
+import fakeredis
+import pytest
+from yt_dlp.utils import DownloadError, ExtractorError
+import probe
+
+URL = 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+
+class FakeYDL:
+    def __init__(self, result):
+        self.result = result
+        self.calls = 0
+
+    def extract_info(self, url, download=True):
+        self.calls += 1
+        if isinstance(self.result, Exception):
+            raise self.result
+        return dict(self.result)
+
+@pytest.fixture
+def conn():
+    return fakeredis.FakeRedis()
+
+def test_extract_caches_info(conn):
+    """Test that a second probe of the same video needs no extraction"""
+    ydl = FakeYDL({'id': 'dQw4w9WgXcQ', 'extractor_key': 'Youtube', 'title': 'Song', 'duration': 212})
+    info, from_cache = probe.extract(conn, URL, ydl)
+    assert (info['title'], from_cache) == ('Song', False)
+
+    info, from_cache = probe.extract(conn, 'https://youtu.be/dQw4w9WgXcQ', ydl)
+    assert (info['title'], from_cache) == ('Song', True)
+    assert ydl.calls == 1
+    assert probe.summary(info)['duration'] == 212
+
+def test_extract_remembers_unavailable_urls(conn):
+    """Test that a URL that cannot be downloaded fails fast the second time"""
+    cause = ExtractorError('Video unavailable', expected=True)
+    ydl = FakeYDL(DownloadError('ERROR: Video unavailable', exc_info=(ExtractorError, cause, None)))
+    for _ in range(2):
+        with pytest.raises(probe.ProbeError, match='Video unavailable'):
+            probe.extract(conn, URL, ydl)
+    assert ydl.calls == 1
+
+def test_extract_does_not_cache_transient_errors(conn):
+    """Test that network errors are raised as-is and not remembered"""
+    cause = ExtractorError('Connection reset', expected=False)
+    ydl = FakeYDL(DownloadError('ERROR: Connection reset', exc_info=(ExtractorError, cause, None)))
+    with pytest.raises(DownloadError):
+        probe.extract(conn, URL, ydl)
+    assert probe.cached_info(conn, URL) is None
+
+@pytest.mark.parametrize('url', ['ftp://example.com/a.mp3', 'youtube.com/watch?v=x', 'javascript:alert(1)'])
+def test_validate_url_rejects(url):
+    """Test that malformed URLs are rejected without a network call"""
+    with pytest.raises(probe.ProbeError):
+        probe.validate_url(url)
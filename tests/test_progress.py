@@ -0,0 +1,83 @@
+import fakeredis
+import progress
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def make_reporter():
+    clock = Clock()
+    conn = fakeredis.FakeRedis()
+    return progress.ProgressReporter(conn, 'job', min_delta=0.05, min_interval=1.0, clock=clock), conn, clock
+
+def test_download_hook_coalesces_chunk_updates():
+    """Test that thousands of chunk callbacks turn into a handful of writes"""
+    reporter, conn, clock = make_reporter()
+    hook = reporter.download_hook(0.1, 0.6)
+    total = 10_000_000
+    for downloaded in range(0, total + 1, 1000):
+        hook({'status': 'downloading', 'downloaded_bytes': downloaded, 'total_bytes': total})
+    hook({'status': 'finished'})
+
+    assert reporter.writes <= 12
+    fields = progress.read(conn, 'job')
+    assert (fields['progress'], fields['message']) == (0.6, 'Download complete')
+
+def test_report_sends_small_changes_after_interval():
+    """Test that slow progress is still reported once per interval"""
+    reporter, conn, clock = make_reporter()
+    assert reporter.report(0.10, 'a')
+    assert not reporter.report(0.11, 'a')
+    clock.now = 1.5
+    assert reporter.report(0.12, 'a')
+    clock.now = 5
+    assert not reporter.report(0.12, 'a')
+
+def test_hook_ignores_non_download_statuses():
+    """Test that statuses without byte counts do not write empty progress"""
+    reporter, conn, clock = make_reporter()
+    reporter.download_hook()({'status': 'downloading', 'downloaded_bytes': 10})
+    reporter.download_hook()({'status': 'error'})
+    assert reporter.writes == 0
+    assert progress.read(conn, 'job')['progress'] == 0.0
+
+def test_finish_overrides_state():
+    """Test that a multi-stage job reports its outcome under the first job's ID"""
+    conn = fakeredis.FakeRedis()
+    progress.set_state(conn, 'job', 'started')
+    assert progress.read(conn, 'job')['state'] == 'started'
+
+    progress.finish(conn, 'job', {'success': False, 'error': 'boom'})
+    fields = progress.read(conn, 'job')
+    assert (fields['state'], fields['result']['error']) == ('failed', 'boom')
+
+def test_status_hash_tracks_job_lifecycle():
+    """Test that a job's status goes from queued to failed with an error code, read back in one call"""
+    conn = fakeredis.FakeRedis()
+    assert progress.status(conn, 'job') is None
+    progress.create(conn, 'job')
+    assert progress.status(conn, 'job')['status'] == 'queued'
+
+    progress.ProgressReporter(conn, 'job').report(0.4, 'Downloading...')
+    status = progress.status(conn, 'job')
+    assert (status['status'], status['progress'], status['message']) == ('started', 0.4, 'Downloading...')
+
+    progress.finish(conn, 'job', {'success': False, 'error': 'Video unavailable',
+                                  'error_code': progress.ERROR_SOURCE_UNAVAILABLE})
+    status = progress.status(conn, 'job')
+    assert status['status'] == 'failed'
+    assert (status['error'], status['error_code']) == ('Video unavailable', 'source_unavailable')
+
+def test_statuses_reads_many_jobs_at_once():
+    """Test that bulk reads return every known job and None for unknown ones"""
+    conn = fakeredis.FakeRedis()
+    progress.create(conn, 'a')
+    progress.finish(conn, 'b', {'success': True, 'title': 'Song', 'download_url': 'https://x'})
+    statuses = progress.statuses(conn, ['a', 'b', 'missing'])
+    assert statuses['a']['status'] == 'queued'
+    assert statuses['b']['result']['download_url'] == 'https://x'
+    assert statuses['b']['error_code'] is None
+    assert statuses['missing'] is None
@@ -0,0 +1,121 @@
+import http.server
+import os
+import re
+import threading
+import time
+import pytest
+from downloader import ranged
+
+PAYLOAD = os.urandom(512 * 1024)
+
+class ThrottledHandler(http.server.BaseHTTPRequestHandler):
+    """Serves PAYLOAD at a fixed rate per connection, like a throttling host"""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+            start, end = 0, len(PAYLOAD) - 1
+            if match and server.ranges:
+                start = int(match.group(1))
+                end = min(int(match.group(2) or end), end)
+                server.requested.append((start, end))
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{len(PAYLOAD)}')
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(end - start + 1))
+            self.end_headers()
+
+            body = PAYLOAD[start:end + 1]
+            if start in server.fail_once:
+                # Drop the connection halfway through this range, once
+                server.fail_once.discard(start)
+                self.wfile.write(body[:len(body) // 2])
+                return
+            for i in range(0, len(body), 16 * 1024):
+                self.wfile.write(body[i:i + 16 * 1024])
+                time.sleep(16 * 1024 / server.bytes_per_second)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ThrottledHandler)
+    httpd.daemon_threads = True
+    httpd.lock = threading.Lock()
+    httpd.active = httpd.max_active = 0
+    httpd.ranges = True
+    httpd.requested = []
+    httpd.fail_once = set()
+    httpd.bytes_per_second = 2 * 1024 * 1024
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}/audio"
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+def fetch(server, path, **kwargs):
+    progress = []
+    fetcher = ranged.RangedFetcher(server.url, **kwargs)
+    size = fetcher.fetch(str(path), progress=lambda done, total: progress.append((done, total)))
+    return size, progress
+
+def test_parallel_fetch_matches_source(server, tmp_path):
+    """Test that ranges fetched over several connections reassemble into the source"""
+    size, progress = fetch(server, tmp_path / 'out', concurrency=4, chunk_size=64 * 1024)
+    assert size == len(PAYLOAD)
+    assert (tmp_path / 'out').read_bytes() == PAYLOAD
+    assert server.max_active > 1
+    assert progress[-1] == (len(PAYLOAD), len(PAYLOAD))
+
+def test_parallel_fetch_beats_throttled_connection(server, tmp_path):
+    """Test that per-connection throttling no longer bounds the download time"""
+    started = time.monotonic()
+    fetch(server, tmp_path / 'single', concurrency=1, chunk_size=len(PAYLOAD))
+    single = time.monotonic() - started
+
+    started = time.monotonic()
+    fetch(server, tmp_path / 'parallel', concurrency=8, chunk_size=64 * 1024)
+    parallel = time.monotonic() - started
+    assert parallel < single * 0.6
+
+def test_dropped_connection_resumes_mid_range(server, tmp_path):
+    """Test that a failed range is resumed from the last byte written, not restarted"""
+    server.fail_once.add(128 * 1024)
+    fetch(server, tmp_path / 'out', concurrency=2, chunk_size=128 * 1024)
+    assert (tmp_path / 'out').read_bytes() == PAYLOAD
+    resumed = [start for start, end in server.requested if 128 * 1024 < start < 256 * 1024]
+    assert resumed == [128 * 1024 + 64 * 1024]
+
+def test_server_without_range_support(server, tmp_path):
+    """Test that a server ignoring Range is read over one connection"""
+    server.ranges = False
+    size, _ = fetch(server, tmp_path / 'out', concurrency=4, chunk_size=64 * 1024)
+    assert size == len(PAYLOAD)
+    assert (tmp_path / 'out').read_bytes() == PAYLOAD
+    assert server.max_active == 1
+
+def test_failed_fetch_resumes_from_finished_chunks(server, tmp_path):
+    """Test that a second attempt only fetches the chunks the first one did not finish"""
+    chunk = 128 * 1024
+    server.fail_once.add(2 * chunk)
+    with pytest.raises(ranged.FetchError):
+        fetch(server, tmp_path / 'out', concurrency=2, chunk_size=chunk, retries=0)
+    assert (tmp_path / ('out' + ranged.JOURNAL_SUFFIX)).exists()
+
+    server.requested = []
+    size, progress = fetch(server, tmp_path / 'out', concurrency=2, chunk_size=chunk)
+    assert size == len(PAYLOAD)
+    assert (tmp_path / 'out').read_bytes() == PAYLOAD
+    # The probe, then only the chunk that failed
+    assert server.requested == [(0, chunk - 1), (2 * chunk, 3 * chunk - 1)]
+    assert progress[-1] == (len(PAYLOAD), len(PAYLOAD))
+    assert not (tmp_path / ('out' + ranged.JOURNAL_SUFFIX)).exists()
@@ -0,0 +1,78 @@
+import fakeredis
+import pytest
+import cache
+import storage
+
+class FakeR2:
+    def __init__(self, fail=(), before_delete=None):
+        self.calls = []
+        self.fail = set(fail)
+        self.before_delete = before_delete
+
+    def delete_objects(self, Bucket, Delete):
+        keys = [obj['Key'] for obj in Delete['Objects']]
+        if self.before_delete:
+            self.before_delete()
+        self.calls.append(keys)
+        return {'Errors': [{'Key': k, 'Code': 'InternalError'} for k in keys if k in self.fail]}
+
+@pytest.fixture
+def conn():
+    return fakeredis.FakeRedis()
+
+def test_sweep_deletes_only_expired(conn):
+    """Test that only keys past their expiry are deleted, in batches"""
+    for i in range(5):
+        storage.schedule_expiry(conn, f'old/{i}.mp3', 100)
+    storage.schedule_expiry(conn, 'new.mp3', 300)
+
+    r2 = FakeR2()
+    assert storage.sweep_expired(r2, conn, 'bucket', now=200, batch_size=2) == 5
+    assert [len(batch) for batch in r2.calls] == [2, 2, 1]
+    assert conn.zrange(storage.EXPIRY_INDEX, 0, -1) == [b'new.mp3']
+
+def test_sweep_skips_referenced_artifacts(conn):
+    """Test that a cache hit racing the sweeper keeps its object"""
+    key = cache.artifact_key('youtube', 'dQw4w9WgXcQ')
+    cache.store(conn, key, 'Song')
+    storage.schedule_expiry(conn, cache.object_key(key), 100)
+
+    r2 = FakeR2()
+    assert storage.sweep_expired(r2, conn, 'bucket', now=200) == 0
+    assert r2.calls == []
+
+def test_sweep_keeps_failed_deletes_indexed(conn):
+    """Test that keys R2 failed to delete are retried on the next sweep"""
+    storage.schedule_expiry(conn, 'a.mp3', 100)
+    storage.schedule_expiry(conn, 'b.mp3', 100)
+
+    assert storage.sweep_expired(FakeR2(fail=['b.mp3']), conn, 'bucket', now=200) == 1
+    assert conn.zrange(storage.EXPIRY_INDEX, 0, -1) == [b'b.mp3']
+
+def test_sweep_racing_a_new_upload_keeps_its_score_and_drops_its_entry(conn):
+    """Test that an artifact stored again while the sweeper deletes it is not left as a hit without an object"""
+    key = cache.artifact_key('youtube', 'dQw4w9WgXcQ')
+    storage.schedule_expiry(conn, cache.object_key(key), 100)
+
+    def upload_again():
+        cache.store(conn, key, 'Song')
+        storage.schedule_expiry(conn, cache.object_key(key), 1000)
+
+    r2 = FakeR2(before_delete=upload_again)
+    assert storage.sweep_expired(r2, conn, 'bucket', now=200) == 1
+    assert conn.zscore(storage.EXPIRY_INDEX, cache.object_key(key)) == 1000
+    assert cache.lookup(conn, key) is None
+
+def test_r2_client_is_shared_per_process(monkeypatch):
+    """Test that the R2 client is built once per process and again after a fork"""
+    monkeypatch.setenv('R2_ENDPOINT_URL', 'https://test.r2.cloudflarestorage.com')
+    monkeypatch.setenv('R2_ACCESS_KEY_ID', 'test-key')
+    monkeypatch.setenv('R2_SECRET_ACCESS_KEY', 'test-secret')
+    monkeypatch.setattr(storage, '_client', None)
+
+    client = storage.get_r2_client()
+    assert storage.get_r2_client() is client
+    assert client.meta.config.max_pool_connections >= storage.MAX_CONCURRENCY
+
+    monkeypatch.setattr(storage.os, 'getpid', lambda: -1)
+    assert storage.get_r2_client() is not client
@@ -0,0 +1,99 @@
+import sys
+import fakeredis
+import pytest
+import localcache
+import profiles
+import tasks
+from downloader import stream
+
+def python_cmd(code):
+    return [sys.executable, '-c', code]
+
+def test_transcode_stream_reads_stdout():
+    """Test that process output is read through in chunks"""
+    cmd = python_cmd("import sys; sys.stdout.buffer.write(b'x' * 300000)")
+    with stream.TranscodeStream(cmd) as audio:
+        chunks = []
+        while True:
+            chunk = audio.read(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    assert sum(len(c) for c in chunks) == 300000
+    assert audio.bytes_read == 300000
+
+def test_transcode_stream_raises_on_failure():
+    """Test that a failed transcode raises instead of ending the upload early"""
+    cmd = python_cmd("import sys; sys.stdout.buffer.write(b'partial'); sys.stderr.write('boom\\n'); sys.exit(1)")
+    with stream.TranscodeStream(cmd) as audio:
+        assert audio.read(65536) == b'partial'
+        with pytest.raises(IOError, match='boom'):
+            audio.read(65536)
+
+def test_ffmpeg_command():
+    """Test that the source URL, headers and encoder settings are passed to ffmpeg"""
+    info = {
+        'url': 'https://example.com/audio.webm',
+        'protocol': 'https',
+        'http_headers': {'User-Agent': 'test'},
+    }
+    assert stream.can_stream(info)
+    cmd = stream.ffmpeg_command(info, profiles.get_profile('mp3'))
+    assert cmd[cmd.index('-i') + 1] == info['url']
+    assert cmd[cmd.index('-headers') + 1] == 'User-Agent: test\r\n'
+    assert cmd[cmd.index('-c:a') + 1] == 'libmp3lame'
+    assert cmd[-1] == 'pipe:1'
+    assert not stream.can_stream({'url': 'x', 'protocol': 'http_dash_segments'})
+
+def test_ffmpeg_command_passthrough():
+    """Test that a source already in the requested codec is copied, not re-encoded"""
+    info = {'url': 'https://example.com/audio.webm', 'protocol': 'https', 'acodec': 'opus'}
+    opus = profiles.get_profile('opus')
+    assert profiles.can_passthrough(info, opus)
+    assert not profiles.can_passthrough(info, profiles.get_profile('mp3'))
+
+    cmd = stream.ffmpeg_command(info, opus, passthrough=True)
+    assert cmd[cmd.index('-c:a') + 1] == 'copy'
+    assert '-b:a' not in cmd
+
+def test_piped_m4a_is_fragmented():
+    """Test that MP4 output written to a pipe does not need seeking"""
+    cmd = stream.ffmpeg_command({'url': 'x', 'protocol': 'https'}, profiles.get_profile('m4a'))
+    assert '+frag_keyframe+empty_moov' in cmd
+
+class StreamingR2:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.uploaded = b''
+
+    def upload_fileobj(self, fileobj, bucket, key, **kwargs):
+        while True:
+            chunk = fileobj.read(65536)
+            if not chunk:
+                break
+            self.uploaded += chunk
+            if self.fail:
+                raise ConnectionResetError('connection reset by peer')
+
+@pytest.mark.parametrize('fail', [False, True], ids=['uploaded', 'upload-failed'])
+def test_streaming_upload_fills_local_cache(tmp_path, monkeypatch, fail):
+    """Test that a streamed upload leaves its file in the local cache, only once the upload succeeded"""
+    monkeypatch.setattr(localcache, 'CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(localcache, 'MAX_BYTES', 1024 * 1024)
+    monkeypatch.setattr(tasks.storage, 'transfer_config', lambda: None)
+    monkeypatch.setenv('R2_BUCKET', 'bucket')
+    monkeypatch.setattr(stream, 'ffmpeg_command',
+                        lambda info, profile, passthrough: python_cmd("import sys; sys.stdout.buffer.write(b'a' * 200000)"))
+    r2 = StreamingR2(fail)
+    key = 'youtube:abc:mp3-192'
+    info = {'id': 'abc', 'url': 'https://example.com/a', 'protocol': 'https'}
+
+    if fail:
+        with pytest.raises(ConnectionResetError):
+            tasks.upload_streaming(fakeredis.FakeRedis(), r2, info, key, profiles.get_profile('mp3'), {})
+        assert not localcache.contains('cache/youtube/abc/mp3-192.mp3')
+        assert [p for p in (tmp_path / 'cache').rglob('*') if p.is_file()] == []
+    else:
+        tasks.upload_streaming(fakeredis.FakeRedis(), r2, info, key, profiles.get_profile('mp3'), {})
+        path = localcache.get('cache/youtube/abc/mp3-192.mp3')
+        assert open(path, 'rb').read() == r2.uploaded == b'a' * 200000
@@ -1,4 +1,13 @@
+import json
+import subprocess
+import sys
+import fakeredis
 import pytest
+from limits.storage import MemoryStorage
+from limits.strategies import MovingWindowRateLimiter
+from rq import Queue
+import batch
+import url_server
 from url_server import app
 import os
 
@@ -8,6 +17,23 @@ def client():
     with app.test_client() as client:
         yield client
 
+@pytest.fixture
+def conn(monkeypatch):
+    conn = fakeredis.FakeRedis()
+    monkeypatch.setattr(url_server, 'redis_conn', conn)
+    for name in ('high_q', 'default_q', 'long_q'):
+        monkeypatch.setattr(url_server, name, Queue(getattr(url_server, name).name, connection=conn))
+    return conn
+
+@pytest.fixture
+def probed(conn, monkeypatch):
+    """Metadata the probe returns for submitted URLs; tests change it in place"""
+    info = {'id': 'dQw4w9WgXcQ', 'extractor_key': 'Youtube', 'title': 'Song'}
+    monkeypatch.setattr(url_server.probe, 'extract', lambda conn, url, **kwargs: (dict(info), True))
+    monkeypatch.setattr(url_server, 'queue_full', lambda queue, needed=1: None)
+    monkeypatch.setattr(url_server.limiter, 'enabled', False)
+    return info
+
 def test_health_check_structure(client):
     """Test that health check returns the correct structure"""
     response = client.get('/health')
@@ -25,3 +51,163 @@ def test_index_route(client):
     response = client.get('/')
     assert response.status_code == 200
     assert b'YouTube Song Downloader' in response.data
+
+def test_liveness_and_readiness(client):
+    """Test that the probe endpoints answer without running checks inline"""
+    assert client.get('/health/live').status_code == 200
+    response = client.get('/health/ready')
+    assert response.status_code in (200, 503)
+    assert response.get_json()['status'] in ('ready', 'not ready')
+
+def test_duplicate_submissions_attach_to_one_job(client, probed):
+    """Test that submitting a video already being processed reuses its job"""
+    url = 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+    first = client.post('/download', data={'url': url}).get_json()
+    second = client.post('/download', data={'url': 'https://youtu.be/dQw4w9WgXcQ'}).get_json()
+    assert second['job_id'] == first['job_id']
+    assert second['attached']
+    assert url_server.high_q.count == 1
+
+    # Another format is a different file, so it gets its own job
+    third = client.post('/download', data={'url': url, 'format': 'opus'}).get_json()
+    assert third['job_id'] != first['job_id']
+
+def test_duplicate_during_enqueue_attaches(client, probed, monkeypatch):
+    """Test that a duplicate arriving after the claim but before the enqueue attaches instead of taking over"""
+    url = 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+    duplicates = []
+
+    def submit_duplicate(conn, queue_name):
+        # Runs between claim_inflight and enqueue
+        if not duplicates:
+            duplicates.append(None)
+            with app.test_client() as other:
+                duplicates[0] = other.post('/download', data={'url': url}).get_json()
+        return 0
+    monkeypatch.setattr(url_server.admission, 'estimated_wait', submit_duplicate)
+
+    first = client.post('/download', data={'url': url}).get_json()
+    assert duplicates[0]['attached']
+    assert duplicates[0]['job_id'] == first['job_id']
+    assert url_server.high_q.count == 1
+
+def test_local_file_supports_ranges(client, tmp_path, monkeypatch):
+    """Test that files on local disk are served with Range support and fall back to R2 when evicted"""
+    monkeypatch.setattr(url_server.localcache, 'CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(url_server, 'redis_conn', fakeredis.FakeRedis())
+    source = tmp_path / 'song.mp3'
+    source.write_bytes(bytes(range(256)) * 4)
+    url_server.localcache.put(str(source), 'cache/youtube/abc/mp3-192.mp3')
+
+    result = {'success': True, 'title': 'Song', 'object_key': 'cache/youtube/abc/mp3-192.mp3',
+              'download_url': 'https://r2.example/signed'}
+    with app.test_request_context():
+        link = url_server.local_result(result)['download_url']
+    assert link.startswith('/files/')
+
+    response = client.get(link, headers={'Range': 'bytes=10-19'})
+    assert response.status_code == 206
+    assert response.data == bytes(range(10, 20))
+    assert 'Song.mp3' in response.headers['Content-Disposition']
+
+    os.remove(url_server.localcache.path_for(result['object_key']))
+    class R2:
+        def generate_presigned_url(self, *args, **kwargs):
+            return 'https://r2.example/signed'
+    monkeypatch.setattr(url_server.storage, 'get_r2_client', R2)
+    monkeypatch.setenv('R2_BUCKET', 'bucket')
+    response = client.get(link)
+    assert response.status_code == 302
+    assert response.headers['Location'] == 'https://r2.example/signed'
+
+    assert client.get('/files/forged').status_code == 404
+
+def test_bulk_status_and_no_tracebacks(client, conn):
+    """Test that /status?ids= reads many jobs and failed jobs never expose a traceback"""
+    url_server.progress.create(conn, 'queued-job')
+    url_server.progress.finish(conn, 'failed-job', {'success': False, 'error': 'Video unavailable',
+                                                    'error_code': 'source_unavailable'})
+
+    jobs = client.get('/status?ids=queued-job,failed-job&ids=missing').get_json()['jobs']
+    assert jobs['queued-job']['status'] == 'queued'
+    assert jobs['failed-job']['error_code'] == 'source_unavailable'
+    assert jobs['missing'] is None
+    assert client.get('/status').status_code == 400
+    assert client.get('/status/missing').get_json()['error_code'] == 'not_found'
+
+    # Jobs from before the status hash existed fall back to RQ, without exc_info
+    job = Queue('high', connection=conn).enqueue('tasks.process_youtube_url', args=('url', 'user'))
+    job.set_status('failed')
+    job._exc_info = 'Traceback (most recent call last): secret'
+    job.save()
+    response = client.get(f'/status/{job.id}')
+    assert response.get_json()['error_code'] == 'internal'
+    assert b'Traceback' not in response.data
+
+def test_bulk_status_mixes_batch_and_legacy_jobs(client, conn, monkeypatch):
+    """Test that /status?ids= sees batch items and jobs without a status hash, like /status/<id> does"""
+    queue = Queue('high', connection=conn)
+    batch.start(queue, 'b1', 'user', ['https://youtu.be/video000000', 'https://youtu.be/video000001'],
+                concurrency=1)
+    legacy = queue.enqueue('tasks.process_youtube_url', args=('url', 'user'))
+
+    jobs = client.get(f'/status?ids=b1-0,{legacy.id},b1-1').get_json()['jobs']
+    assert jobs['b1-0']['status'] == 'queued'
+    assert jobs[legacy.id]['status'] == 'queued'
+    assert jobs['b1-1'] is None
+    for job_id in ('b1-0', legacy.id):
+        assert client.get(f'/status/{job_id}').get_json()['status'] == 'queued'
+
+    # The next item gets its status hash when it is queued
+    batch.finish_item(queue, 'b1', 0, {'success': True, 'title': 'One'})
+    assert client.get('/status?ids=b1-1').get_json()['jobs']['b1-1']['status'] == 'queued'
+
+    # Jobs without a hash are fetched from RQ together, not one round trip each
+    def fetch_one(job_id):
+        raise AssertionError('fetched one by one')
+    monkeypatch.setattr(url_server, 'fetch_job', fetch_one)
+    stale = [f'stale-{i}' for i in range(url_server.MAX_STATUS_IDS - 1)]
+    jobs = client.get(f"/status?ids={','.join(stale)},{legacy.id}").get_json()['jobs']
+    assert jobs[legacy.id]['status'] == 'queued'
+    assert all(jobs[job_id] is None for job_id in stale)
+
+def test_long_tracks_take_the_long_lane(client, probed):
+    """Test that a long mix is queued apart from short songs, with a scaled timeout and a wait estimate"""
+    probed.update(id='mixmixmix01', title='Mix', duration=3 * 3600)
+
+    response = client.post('/download', data={'url': 'https://www.youtube.com/watch?v=mixmixmix01'}).get_json()
+    assert response['queue'] == 'long'
+    assert response['estimated_wait'] == 0
+    job = url_server.long_q.fetch_job(response['job_id'])
+    assert job.timeout == url_server.admission.job_timeout(3 * 3600)
+    assert url_server.high_q.count == 0
+
+def test_request_id_is_echoed(client):
+    """Test that responses carry the proxy's request ID, or a generated one"""
+    assert client.get('/health/live', headers={'X-Request-ID': 'abc123'}).headers['X-Request-ID'] == 'abc123'
+    assert len(client.get('/health/live').headers['X-Request-ID']) == 32
+
+def test_rate_limits_are_per_client_behind_the_proxy(client, monkeypatch):
+    """Test that one client's 429s, by its X-Forwarded-For address, leave other clients alone"""
+    storage = MemoryStorage()
+    monkeypatch.setattr(url_server.limiter, '_storage', storage)
+    monkeypatch.setattr(url_server.limiter, '_limiter', MovingWindowRateLimiter(storage))
+
+    def submit(address):
+        return client.post('/download', data={'url': ''}, headers={'X-Forwarded-For': address}).status_code
+    statuses = [submit('203.0.113.1') for _ in range(40)]
+    assert 429 in statuses
+    assert submit('203.0.113.1') == 429
+    assert submit('198.51.100.7') == 400
+
+def test_held_long_polls_are_served_while_a_probe_runs(tmp_path):
+    """Test that a gevent worker answers a thousand held long-polls while a submission's probe keeps a CPU busy"""
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(tests_dir), LOG_STDERR='0',
+               LOG_FILE=str(tmp_path / 'app.log'))
+    process = subprocess.run([sys.executable, os.path.join(tests_dir, 'held_requests.py'), '1000', '3'],
+                             env=env, capture_output=True, text=True, timeout=120, check=True)
+    result = json.loads(process.stdout.splitlines()[-1])
+    assert result['finished'] == 1000 and result['download'] == 200
+    # Probing on the hub would hold every answer back until it was done
+    assert result['before_probe'] >= 500
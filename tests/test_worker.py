@@ -0,0 +1,30 @@
+import os
+import time
+import worker
+
+def test_supervisor_restarts_an_exited_worker(tmp_path, monkeypatch):
+    """Test that `worker.py --pool` starts a worker again when its process exits"""
+    starts = tmp_path / 'starts'
+
+    def exits_at_once(queues, mode):
+        with open(starts, 'a') as f:
+            f.write(f"{','.join(queues)} {os.getpid()}\n")
+
+    handlers = {}
+    monkeypatch.setattr(worker, 'run_worker', exits_at_once)
+    monkeypatch.setattr(worker.signal, 'signal', lambda signum, handler: handlers.setdefault(signum, handler))
+    sleep = time.sleep
+    deadline = time.monotonic() + 10
+
+    def stop_after_restart(seconds):
+        lines = starts.read_text().splitlines() if starts.exists() else []
+        if len(lines) >= 2 or time.monotonic() > deadline:
+            handlers[worker.signal.SIGTERM](worker.signal.SIGTERM, None)
+        sleep(0.05)
+    monkeypatch.setattr(worker.time, 'sleep', stop_after_restart)
+
+    worker.supervise([(['fetch'], 1)])
+    lines = starts.read_text().splitlines()
+    assert len(lines) >= 2
+    assert [line.split()[0] for line in lines] == ['fetch'] * len(lines)
+    assert len({line.split()[1] for line in lines}) == len(lines)
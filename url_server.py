@@ -1,34 +1,144 @@
-from flask import Flask, render_template, request, jsonify, session
+from flask import Flask, g, request, jsonify, session, Response, stream_with_context, redirect, send_file, url_for
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from itsdangerous import BadSignature, SignatureExpired, URLSafeTimedSerializer
+from werkzeug.middleware.proxy_fix import ProxyFix
 import redis
 from rq import Queue
-from tasks import process_youtube_url
+from rq.job import Job
+from rq.exceptions import NoSuchJobError
+from rq.worker_registration import WORKERS_BY_QUEUE_KEY
+import admission
+import batch
+import cache
+import events
+import health
+import localcache
+import log
+import metrics
+import probe
+import profiles
+import progress
+import storage
 import os
-import json
-import boto3
-from datetime import datetime
+import sys
+import time
+import uuid
 import logging
-from logging.handlers import RotatingFileHandler
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger('tinnito')
-logger.setLevel(logging.INFO)
-
-# Add file handler with rotation
-os.makedirs('logs', exist_ok=True)
-file_handler = RotatingFileHandler('logs/tinnito.log', maxBytes=1024*1024, backupCount=5)
-file_handler.setFormatter(logging.Formatter(
-    '%(asctime)s [%(levelname)s] %(message)s - {"component": "%(name)s", "path": "%(pathname)s:%(lineno)d"}'
-))
-logger.addHandler(file_handler)
+# JSON lines shipped off the request path (see log.py)
+logger = log.setup('web')
+access_logger = logging.getLogger('tinnito.access')
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'dev-secret-change-this')
+# Proxies in front of the app (Render's router, a load balancer). The client
+# address they append to X-Forwarded-For is what per-IP rate limits key on;
+# without this every client would share the proxy's address. Set to 0 when
+# clients connect directly, or they could pick their own address.
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', '1'))
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=TRUSTED_PROXY_HOPS)
 
-# Redis connection
+# Redis connection. One pool per process, shared by every request; under
+# gevent a request waits for a free connection instead of failing.
 redis_url = os.environ.get('REDIS_URL', 'redis://localhost:6379')
-redis_conn = redis.from_url(redis_url)
-q = Queue(connection=redis_conn)
+redis_pool = redis.BlockingConnectionPool.from_url(
+    redis_url,
+    max_connections=int(os.environ.get('REDIS_MAX_CONNECTIONS', '50')),
+    timeout=5
+)
+redis_conn = redis.Redis(connection_pool=redis_pool)
+# Event streams and long-polls share one pub/sub subscription per process
+event_hub = events.Hub(redis_conn)
+# Interactive downloads jump ahead of batch items, and short tracks ahead of
+# long ones (see admission.PRIORITY_QUEUES)
+high_q = Queue(admission.HIGH_PRIORITY, connection=redis_conn)
+default_q = Queue(admission.MEDIUM_PRIORITY, connection=redis_conn)
+long_q = Queue(admission.LONG_PRIORITY, connection=redis_conn)
+low_q = Queue(admission.LOW_PRIORITY, connection=redis_conn)
+
+# 'staged' splits each download into fetch, transcode and upload jobs on
+# separate queues, each served by its own worker pool (see worker.py)
+PIPELINE_MODE = os.environ.get('PIPELINE_MODE', 'single')
+fetch_q = Queue('fetch', connection=redis_conn)
+
+# Sync workers are killed after `timeout` seconds, so event streams and
+# long-polls end before that and the browser reconnects. Async workers have
+# no such limit, but short streams still spread reconnects across workers.
+EVENT_STREAM_SECONDS = int(os.environ.get('EVENT_STREAM_SECONDS', '25'))
+
+# Most job IDs a single bulk /status request may ask for
+MAX_STATUS_IDS = int(os.environ.get('MAX_STATUS_IDS', '100'))
+
+# Links to files kept on this host's disk; they live as long as a presigned R2 URL
+file_signer = URLSafeTimedSerializer(app.secret_key, salt='local-file')
+
+def session_key():
+    return session.get('user_id') or get_remote_address()
+
+# Counters live in Redis so every web process shares them; if Redis is
+# unreachable requests are let through rather than refused
+limiter = Limiter(
+    get_remote_address,
+    app=app,
+    storage_uri=os.environ.get('RATELIMIT_STORAGE_URI', redis_url),
+    strategy='moving-window',
+    headers_enabled=True,
+    swallow_errors=True
+)
+submission_limits = [
+    limiter.limit(admission.SESSION_RATE_LIMIT, key_func=session_key, scope='session'),
+    limiter.limit(admission.IP_RATE_LIMIT, scope='ip'),
+]
+
+def rate_limited(view):
+    for limit in submission_limits:
+        view = limit(view)
+    return view
+
+@app.errorhandler(429)
+def too_many_requests(e):
+    return jsonify({"error": f"Too many requests: {e.description}"}), 429
+
+# Every line logged while handling a request carries its ID, taken from the
+# proxy's X-Request-ID if it sent one and echoed back in the response
+@app.before_request
+def bind_request_id():
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    g.request_token = log.bind_request(g.request_id)
+    g.request_started = time.monotonic()
+
+@app.after_request
+def log_request(response):
+    # Hooks registered earlier, like the rate limiter's, can answer before bind_request_id runs
+    if 'request_id' not in g:
+        return response
+    response.headers['X-Request-ID'] = g.request_id
+    # Successful requests are sampled (LOG_SAMPLE_RATES); failures are always logged
+    level = logging.WARNING if response.status_code >= 500 else logging.INFO
+    access_logger.log(level, '%s %s %s', request.method, request.path, response.status_code, extra={
+        'method': request.method,
+        'path': request.path,
+        'status': response.status_code,
+        'duration_ms': round((time.monotonic() - g.request_started) * 1000, 1),
+    })
+    return response
+
+@app.teardown_request
+def unbind_request_id(exc):
+    if 'request_token' in g:
+        log.unbind_request(g.pop('request_token'))
+
+def queue_full(queue, needed=1):
+    """429 response when `queue` cannot take `needed` more jobs, or None"""
+    seconds = admission.retry_after(queue, needed)
+    if seconds is None:
+        return None
+    logger.warning(f'Queue {queue.name} is full, refusing new work for {seconds}s')
+    response = jsonify({"error": "The server is busy, please try again shortly", "retry_after": seconds})
+    response.headers['Retry-After'] = str(seconds)
+    return response, 429
 
 @app.route('/')
 def index():
@@ -122,17 +232,23 @@ def index():
                         headers: {
                             'Content-Type': 'application/x-www-form-urlencoded',
                         },
-                        body: 'url=' + encodeURIComponent(url)
+                        body: 'url=' + encodeURIComponent(url) +
+                              '&format=' + encodeURIComponent(document.getElementById('format').value)
                     })
                     .then(response => response.json())
                     .then(data => {
                         if (data.error) {
                             status.className = 'status error';
                             status.textContent = 'Error: ' + data.error;
+                        } else if (data.result) {
+                            showResult(data.result);
                         } else {
                             status.className = 'status success';
-                            status.textContent = 'Processing started...';
-                            checkStatus(data.job_id);
+                            status.firstChild.textContent = (data.info && data.info.title
+                                ? 'Processing "' + data.info.title + '"...'
+                                : 'Processing started...') +
+                                (data.estimated_wait > 0 ? ' (starts in about ' + Math.ceil(data.estimated_wait / 60) + ' min)' : '');
+                            watchJob(data.job_id);
                         }
                     })
                     .catch(error => {
@@ -141,38 +257,67 @@ def index():
                     });
                 }
                 
-                function checkStatus(jobId) {
+                function showResult(result) {
+                    const status = document.getElementById('status');
+                    status.className = 'status success';
+                    const downloadLink = document.createElement('div');
+                    downloadLink.innerHTML = `
+                        <p>Download ready!</p>
+                        <a href="${result.download_url}" class="download-btn" target="_blank">
+                            Download "${result.title}"
+                        </a>
+                    `;
+                    status.innerHTML = '';
+                    status.appendChild(downloadLink);
+                }
+                
+                function handleStatus(data) {
+                    // Returns true once the job has reached a final state
                     const status = document.getElementById('status');
                     const progressBar = status.querySelector('.progress-bar');
                     
-                    fetch('/status/' + jobId)
+                    if (data.error) {
+                        status.className = 'status error';
+                        status.textContent = 'Error: ' + data.error;
+                        return true;
+                    } else if (data.status === 'finished' && data.result && data.result.success) {
+                        showResult(data.result);
+                        return true;
+                    } else if (data.status === 'failed' || (data.result && data.result.success === false)) {
+                        status.className = 'status error';
+                        status.textContent = 'Download failed: ' + (data.error || data.result.error);
+                        return true;
+                    }
+                    if (progressBar) {
+                        progressBar.style.width = Math.min((data.progress || 0) * 100, 90) + '%';
+                    }
+                    status.firstChild.textContent = 'Processing... ' + (data.message || '');
+                    return false;
+                }
+                
+                function watchJob(jobId) {
+                    if (!window.EventSource) {
+                        checkStatus(jobId);
+                        return;
+                    }
+                    const source = new EventSource('/events/' + jobId);
+                    source.addEventListener('status', event => {
+                        if (handleStatus(JSON.parse(event.data))) {
+                            source.close();
+                        }
+                    });
+                }
+                
+                function checkStatus(jobId) {
+                    // Long-poll: the server answers when the job makes progress
+                    fetch('/status/' + jobId + '?wait=20')
                     .then(response => response.json())
                     .then(data => {
-                        if (data.error) {
-                            status.className = 'status error';
-                            status.textContent = 'Error: ' + data.error;
-                        } else if (data.status === 'finished' && data.result && data.result.success) {
-                            status.className = 'status success';
-                            const downloadLink = document.createElement('div');
-                            downloadLink.innerHTML = `
-                                <p>Download ready!</p>
-                                <a href="${data.result.download_url}" class="download-btn" target="_blank">
-                                    Download "${data.result.title}"
-                                </a>
-                            `;
-                            status.innerHTML = '';
-                            status.appendChild(downloadLink);
-                        } else if (data.status === 'failed') {
-                            status.className = 'status error';
-                            status.textContent = 'Download failed: ' + data.error;
-                        } else {
-                            if (progressBar) {
-                                progressBar.style.width = Math.min((data.progress || 0) * 100, 90) + '%';
-                            }
-                            status.textContent = 'Processing... ' + (data.message || '');
-                            setTimeout(() => checkStatus(jobId), 1000);
+                        if (!handleStatus(data)) {
+                            checkStatus(jobId);
                         }
-                    });
+                    })
+                    .catch(() => setTimeout(() => checkStatus(jobId), 1000));
                 }
             </script>
         </head>
@@ -180,6 +325,11 @@ def index():
             <h1>YouTube Song Downloader</h1>
             <div class="form">
                 <input type="text" id="url" placeholder="Enter YouTube URL" required>
+                <select id="format">
+                    <option value="mp3">MP3</option>
+                    <option value="m4a">M4A</option>
+                    <option value="opus">Opus</option>
+                </select>
                 <input type="submit" value="Download" onclick="submitForm(event)">
             </div>
             <div id="status" class="status"></div>
@@ -188,112 +338,383 @@ def index():
     '''
 
 @app.route('/download', methods=['POST'])
+@rate_limited
 def download_url():
-    url = request.form.get('url')
+    url = request.form.get('url', '').strip()
     if not url:
         return jsonify({"error": "No URL provided"}), 400
+    try:
+        probe.validate_url(url)
+    except probe.ProbeError as e:
+        return jsonify({"error": str(e)}), 400
+    profile = profiles.get_profile(request.form.get('format'))
+    if not profile:
+        return jsonify({"error": f"Unsupported format; choose one of: {', '.join(profiles.PROFILES)}"}), 400
 
     # Get user session ID or create new one
     if 'user_id' not in session:
         session['user_id'] = os.urandom(16).hex()
     
-    # Queue the download job
+    # Serve repeat requests straight from the artifact cache
+    key = None
+    parsed = cache.parse_video_id(url)
+    if parsed:
+        key = cache.artifact_key(*parsed, profile['name'], profile['quality'])
+        result = cached_download(key)
+        if result:
+            return result
+
+    # Reject bad URLs now instead of after a worker picks up the job
+    info = None
+    try:
+        info, from_cache = probe.extract(redis_conn, url, run=off_hub)
+        metrics.inc(redis_conn, 'tinnito_cache_requests_total', cache='probe', result='hit' if from_cache else 'miss')
+    except probe.ProbeError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.warning(f'Metadata probe failed, leaving it to the worker: {e}')
+
+    if info and not parsed:
+        key = cache.artifact_key(info['extractor_key'], info['id'], profile['name'], profile['quality'])
+        result = cached_download(key)
+        if result:
+            return result
+
+    # Queue the download job, unless one is already producing the same file
+    duration = info.get('duration') if info else None
+    queue = fetch_q if PIPELINE_MODE == 'staged' else lane_queue(duration)
+    timeout = admission.job_timeout(duration)
+    job_id = str(uuid.uuid4())
+    claimed = False
     try:
-        job = q.enqueue(
-            'tasks.process_youtube_url',
-            args=(url, session['user_id']),
-            job_timeout='10m'
+        # Before claiming, so a duplicate that finds the claim also finds a
+        # live status to attach to, even before the job is enqueued
+        progress.create(redis_conn, job_id)
+        if key:
+            holder = claim_inflight(key, job_id, timeout + cache.INFLIGHT_TTL - admission.DEFAULT_TIMEOUT)
+            if holder:
+                progress.discard(redis_conn, job_id)
+                metrics.inc(redis_conn, 'tinnito_cache_requests_total', cache='inflight', result='hit')
+                response = {
+                    "message": "Download already in progress",
+                    "job_id": holder,
+                    "attached": True
+                }
+                if info:
+                    response["info"] = probe.summary(info)
+                return jsonify(response)
+            claimed = True
+
+        busy = queue_full(queue)
+        if busy:
+            if claimed:
+                cache.release(redis_conn, key, job_id)
+            progress.discard(redis_conn, job_id)
+            return busy
+        metrics.inc(redis_conn, 'tinnito_cache_requests_total', cache='artifact', result='miss')
+        # Everything already waiting is ahead of this job
+        wait = admission.estimated_wait(redis_conn, queue.name)
+        job = queue.enqueue(
+            'tasks.fetch_stage' if PIPELINE_MODE == 'staged' else 'tasks.process_youtube_url',
+            args=(url, session['user_id'], profile['name']),
+            job_timeout=timeout,
+            job_id=job_id,
+            meta={'inflight': key} if claimed else {}
         )
-        return jsonify({
+        response = {
             "message": "Download started",
-            "job_id": job.id
-        })
+            "job_id": job.id,
+            "queue": queue.name
+        }
+        if wait is not None:
+            response["estimated_wait"] = wait
+        if info:
+            response["info"] = probe.summary(info)
+        return jsonify(response)
     except Exception as e:
+        try:
+            if claimed:
+                cache.release(redis_conn, key, job_id)
+            progress.discard(redis_conn, job_id)
+        except Exception:
+            pass
         return jsonify({"error": f"Failed to queue download: {str(e)}"}), 500
 
-@app.route('/status/<job_id>')
-def get_status(job_id):
-    job = q.fetch_job(job_id)
-    if not job:
-        return jsonify({"error": "Job not found"}), 404
-    
-    status = {
-        "id": job.id,
-        "status": job.get_status(),
-        "result": job.result,
-        "error": str(job.exc_info) if job.exc_info else None,
-        "progress": getattr(job, 'meta', {}).get('progress', 0),
-        "message": getattr(job, 'meta', {}).get('message', '')
-    }
-    return jsonify(status)
+def off_hub(func, *args):
+    """Run CPU-heavy work on gevent's thread pool when the process is patched,
+    so every other request the worker holds keeps being served meanwhile"""
+    if 'gevent.monkey' in sys.modules:
+        from gevent import get_hub, monkey
+        if monkey.is_module_patched('socket'):
+            return get_hub().threadpool.apply(func, args)
+    return func(*args)
 
-@app.route('/health')
-def health_check():
-    """Health check endpoint that verifies Redis and R2 connectivity."""
-    request_id = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
-    logger.info(f'Health check initiated - RequestID: {request_id}')
-    
-    status = {
-        'status': 'healthy',
-        'timestamp': datetime.now().isoformat(),
-        'version': 'unknown',
-        'request_id': request_id,
-        'checks': {
-            'redis': {
-                'status': 'unhealthy'
-            },
-            'r2_storage': {
-                'status': 'unhealthy'
-            }
-        }
-    }
+def lane_queue(duration):
+    """Queue for an interactive download of a track of `duration` seconds"""
+    return {
+        admission.HIGH_PRIORITY: high_q,
+        admission.MEDIUM_PRIORITY: default_q,
+        admission.LONG_PRIORITY: long_q,
+    }[admission.lane(duration)]
 
-    # Check Redis
+def claim_inflight(key, job_id, ttl=cache.INFLIGHT_TTL):
+    """Claim `key` for a new job; returns the ID of a live job already producing it, or None
+
+    A holder's status is written before its claim, so a holder that is not
+    in RQ yet is still being enqueued, not dead.
+    """
+    while True:
+        holder = cache.claim(redis_conn, key, job_id, ttl)
+        if not holder:
+            return None
+        status = job_status(holder)
+        if status and not events.is_terminal(status):
+            return holder
+        # The holder died (or finished) without releasing its claim
+        if cache.take_over(redis_conn, key, holder, job_id, ttl):
+            return None
+
+def cached_download(key):
+    """/download response for a cache hit, or None"""
     try:
-        logger.info(f'Testing Redis connection - RequestID: {request_id}')
-        redis_conn.ping()
-        status['checks']['redis'] = {
-            'status': 'healthy',
-            'message': 'Connected successfully'
-        }
-        logger.info(f'Redis check passed - RequestID: {request_id}')
+        result = storage.cached_result(redis_conn, key)
     except Exception as e:
-        error_msg = str(e)
-        status['checks']['redis'] = {
-            'status': 'unhealthy',
-            'error': error_msg
-        }
-        status['status'] = 'unhealthy'
-        logger.error(f'Redis check failed - RequestID: {request_id}, Error: {error_msg}')
+        logger.warning(f'Artifact cache lookup failed: {e}')
+        return None
+    if result:
+        metrics.inc(redis_conn, 'tinnito_cache_requests_total', cache='artifact', result='hit')
+        return jsonify({
+            "message": "Download ready",
+            "result": local_result(result)
+        })
+    return None
+
+def local_result(result):
+    """Point a finished result at the local copy of its file, if this host has one"""
+    if not result or not result.get('success') or not localcache.contains(result.get('object_key') or ''):
+        return result
+    token = file_signer.dumps({'key': result['object_key'], 'title': result['title']})
+    return dict(result, download_url=url_for('local_file', token=token))
+
+def local_status(status):
+    if status and status.get('result'):
+        return dict(status, result=local_result(status['result']))
+    return status
+
+@app.route('/batch', methods=['POST'])
+@rate_limited
+def submit_batch():
+    """Start a batch from several URLs (one per line or repeated fields) or a playlist URL"""
+    urls = [line.strip() for field in request.form.getlist('urls') for line in field.splitlines() if line.strip()]
+    if not urls:
+        return jsonify({"error": "No URLs provided"}), 400
+    if len(urls) > batch.MAX_ITEMS:
+        return jsonify({"error": f"At most {batch.MAX_ITEMS} URLs per batch"}), 400
 
-    # Check R2
+    concurrency = request.form.get('concurrency', batch.DEFAULT_CONCURRENCY, type=int)
+    concurrency = max(1, min(concurrency, batch.MAX_CONCURRENCY))
+    bundle = request.form.get('bundle') in ('1', 'true', 'on')
+
+    if 'user_id' not in session:
+        session['user_id'] = os.urandom(16).hex()
+
+    batch_id = os.urandom(8).hex()
     try:
-        logger.info(f'Testing R2 storage connection - RequestID: {request_id}')
-        s3_client = boto3.client(
-            's3',
-            endpoint_url=os.getenv('R2_ENDPOINT_URL'),
-            aws_access_key_id=os.getenv('R2_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.getenv('R2_SECRET_ACCESS_KEY')
-        )
-        bucket = os.getenv('R2_BUCKET')
-        s3_client.head_bucket(Bucket=bucket)
-        status['checks']['r2_storage'] = {
-            'status': 'healthy',
-            'message': f'Connected successfully to bucket {bucket}'
-        }
-        logger.info(f'R2 storage check passed - RequestID: {request_id}, Bucket: {bucket}')
+        busy = queue_full(low_q, min(len(urls), concurrency))
+        if busy:
+            return busy
+        if len(urls) == 1 and batch.is_playlist(urls[0]):
+            # Expanding a playlist takes a network round trip; leave it to a worker
+            batch.create(redis_conn, batch_id, session['user_id'], concurrency, bundle, state='expanding')
+            low_q.enqueue(
+                'tasks.expand_playlist',
+                args=(batch_id, urls[0], session['user_id'], concurrency, bundle),
+                job_id=f"{batch_id}-expand"
+            )
+        else:
+            batch.start(low_q, batch_id, session['user_id'], urls, concurrency, bundle)
+        return jsonify({
+            "message": "Batch started",
+            "batch_id": batch_id
+        })
     except Exception as e:
-        error_msg = str(e)
-        status['checks']['r2_storage'] = {
-            'status': 'unhealthy',
-            'error': error_msg
-        }
-        status['status'] = 'unhealthy'
-        logger.error(f'R2 storage check failed - RequestID: {request_id}, Error: {error_msg}')
+        return jsonify({"error": f"Failed to queue batch: {str(e)}"}), 500
+
+@app.route('/batch/<batch_id>')
+def get_batch_status(batch_id):
+    status = batch.status(redis_conn, batch_id)
+    if not status:
+        return jsonify({"error": "Batch not found"}), 404
+    return jsonify(status)
+
+def job_status(job_id):
+    """Current status of a job, in the shape shared by /status and /events, or None if unknown"""
+    return progress.status(redis_conn, job_id) or queued_job_status(job_id)
+
+def queued_job_status(job_id):
+    """Status of a job queued before the status hash existed, read from RQ itself"""
+    return rq_job_status(fetch_job(job_id))
 
+def rq_job_status(job):
+    """Status of an RQ job without a status hash, or None for no job"""
+    if not job:
+        return None
+    fields = progress.read(redis_conn, job.id)
+    state = job.get_status()
+    result = job.result
+    if state == 'failed' and not result:
+        # exc_info is a server-side traceback; clients only get a code
+        result = {'status': 'error', 'success': False, 'error': 'Download failed',
+                  'error_code': progress.ERROR_INTERNAL}
+    return progress.make_status(job.id, state, fields['progress'], fields['message'], result)
+
+def fetch_job(job_id):
+    """Look up a job on any queue"""
+    try:
+        return Job.fetch(job_id, connection=redis_conn)
+    except NoSuchJobError:
+        return None
+
+def job_not_found():
+    return jsonify({"error": "Job not found", "error_code": "not_found"}), 404
+
+@app.route('/status/<job_id>')
+def get_status(job_id):
+    status = job_status(job_id)
+    if not status:
+        return job_not_found()
+
+    # Long-poll fallback for clients without EventSource: hold the request
+    # until the next update instead of returning the same state again
+    wait = min(request.args.get('wait', 0, type=float), EVENT_STREAM_SECONDS)
+    if wait > 0 and not events.is_terminal(status):
+        initial = status
+        updates = events.listen(redis_conn, job_id, lambda: job_status(job_id) or initial, timeout=wait,
+                                heartbeat=wait, hub=event_hub)
+        status = next(updates)
+        if not events.is_terminal(status):
+            status = next((update for update in updates if update is not None), status)
+        updates.close()
+
+    return jsonify(local_status(status))
+
+@app.route('/status')
+def get_statuses():
+    """Statuses of several jobs (`ids`, comma-separated or repeated) in one round trip"""
+    job_ids = list(dict.fromkeys(
+        job_id for field in request.args.getlist('ids') for job_id in field.split(',') if job_id
+    ))
+    if not job_ids:
+        return jsonify({"error": "No job IDs provided", "error_code": "invalid_request"}), 400
+    if len(job_ids) > MAX_STATUS_IDS:
+        return jsonify({"error": f"At most {MAX_STATUS_IDS} job IDs per request",
+                        "error_code": "invalid_request"}), 400
+    statuses = progress.statuses(redis_conn, job_ids)
+    # Jobs queued before the status hash existed are looked up in RQ, all in
+    # one more round trip; unknown IDs map to null
+    missing = [job_id for job_id, status in statuses.items() if status is None]
+    if missing:
+        for job_id, job in zip(missing, Job.fetch_many(missing, connection=redis_conn)):
+            statuses[job_id] = rq_job_status(job)
+    return jsonify({"jobs": {job_id: local_status(status) for job_id, status in statuses.items()}})
+
+@app.route('/events/<job_id>')
+def job_events(job_id):
+    """Stream a job's progress as Server-Sent Events"""
+    initial = job_status(job_id)
+    if not initial:
+        return job_not_found()
+
+    def generate():
+        yield "retry: 1000\n\n"
+        for status in events.listen(redis_conn, job_id, lambda: job_status(job_id) or initial,
+                                    timeout=EVENT_STREAM_SECONDS, hub=event_hub):
+            yield events.format_sse(local_status(status)) if status is not None else ": keepalive\n\n"
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/files/<token>')
+def local_file(token):
+    """Serve a finished file from local disk, with Range support; falls back to R2"""
+    try:
+        entry = file_signer.loads(token, max_age=cache.ARTIFACT_TTL)
+    except SignatureExpired:
+        return jsonify({"error": "Download link expired"}), 410
+    except BadSignature:
+        return jsonify({"error": "File not found"}), 404
+
+    path = localcache.get(entry['key'])
+    if not path:
+        # Evicted (or kept on another host) since the link was handed out
+        metrics.inc(redis_conn, 'tinnito_cache_requests_total', cache='local', result='miss')
+        try:
+            return redirect(storage.presign_artifact(storage.get_r2_client(), {
+                'title': entry['title'],
+                'object_key': entry['key']
+            }))
+        except Exception as e:
+            logger.warning(f'Presigning {entry["key"]} failed: {e}')
+            return jsonify({"error": "File temporarily unavailable"}), 503
+
+    metrics.inc(redis_conn, 'tinnito_cache_requests_total', cache='local', result='hit')
+    # Served through the WSGI file wrapper, which gunicorn sends with sendfile()
+    return send_file(
+        os.path.abspath(path),
+        as_attachment=True,
+        download_name=entry['title'] + os.path.splitext(path)[1],
+        conditional=True
+    )
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics recorded by web processes and workers, plus live queue gauges"""
+    names = admission.PRIORITY_QUEUES + ['fetch', 'transcode', 'upload']
+    pipe = redis_conn.pipeline(transaction=False)
+    for name in names:
+        pipe.llen(Queue(name, connection=redis_conn).key)
+        pipe.scard(WORKERS_BY_QUEUE_KEY % name)
+    counts = pipe.execute()
+    gauges = {}
+    for i, name in enumerate(names):
+        gauges[metrics.series('tinnito_queue_depth', queue=name)] = counts[2 * i]
+        gauges[metrics.series('tinnito_queue_workers', queue=name)] = counts[2 * i + 1]
+    return Response(metrics.render(redis_conn, gauges), mimetype='text/plain; version=0.0.4')
+
+def check_redis():
+    redis_conn.ping()
+
+def check_r2():
+    bucket = os.getenv('R2_BUCKET')
+    storage.get_r2_client().head_bucket(Bucket=bucket)
+    return f'Connected successfully to bucket {bucket}'
+
+prober = health.HealthProber({'redis': check_redis, 'r2_storage': check_r2}, logger=logger)
+
+@app.route('/health')
+def health_check():
+    """Detailed health from the last background check of Redis and R2"""
+    prober.start()
+    status = prober.snapshot()
+    status['version'] = 'unknown'
     response_code = 200 if status['status'] == 'healthy' else 500
-    logger.info(f'Health check completed - RequestID: {request_id}, Status: {status["status"]}, Code: {response_code}')
     return jsonify(status), response_code
 
+@app.route('/health/live')
+def liveness():
+    """Liveness probe: the process is up and serving requests"""
+    prober.start()
+    return jsonify({'status': 'alive'})
+
+@app.route('/health/ready')
+def readiness():
+    """Readiness probe: Redis and R2 passed their most recent background check"""
+    prober.start()
+    if prober.is_ready():
+        return jsonify({'status': 'ready'})
+    return jsonify({'status': 'not ready'}), 503
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
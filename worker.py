@@ -1,18 +1,128 @@
+import argparse
+import logging
+import multiprocessing
 import redis
-from rq import Worker, Queue, Connection
+from rq import Worker, SimpleWorker, Queue, Connection
 import os
+import signal
 import sys
-
-listen = ['default']
+import time
 
 # Add the current directory to Python path
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
+import admission
+import log
+
+# Set up before any worker forks, so the supervisor owns this host's log file
+log.setup('worker')
+logger = logging.getLogger('tinnito.worker')
+
+# Earlier queues are drained first, so interactive downloads skip the batch backlog
+listen = admission.PRIORITY_QUEUES
+
 # Redis connection
 redis_url = os.getenv('REDIS_URL', 'redis://redis:6379')
 conn = redis.from_url(redis_url)
 
-if __name__ == '__main__':
-    with Connection(conn):
-        worker = Worker(['default'])
+# Worker pool started by `worker.py --pool`: (queues, number of processes).
+# Fetching is network-bound, so many fetchers can share a core; transcoding
+# is CPU-bound and gets about one worker per core. Long-lane workers take
+# hour-long mixes first, so those are not starved while the faster lanes stay
+# busy, and help with everything else when there are none.
+staged = os.getenv('PIPELINE_MODE', 'single') == 'staged'
+POOL = [
+    (listen, int(os.getenv('DEFAULT_WORKERS', '1'))),
+    ([admission.LONG_PRIORITY] + [name for name in listen if name != admission.LONG_PRIORITY],
+     int(os.getenv('LONG_WORKERS', '1'))),
+    (['fetch'], int(os.getenv('FETCH_WORKERS', '4' if staged else '0'))),
+    (['transcode'], int(os.getenv('TRANSCODE_WORKERS', str(multiprocessing.cpu_count()) if staged else '0'))),
+    (['upload'], int(os.getenv('UPLOAD_WORKERS', '2' if staged else '0'))),
+]
+
+# `fork` runs each job in a fresh work-horse that starts from the warm state
+# of its parent; `simple` runs jobs in the worker process itself, so the
+# downloader engine and its connections are reused across jobs as well
+WORKER_MODE = os.getenv('WORKER_MODE', 'fork')
+
+def worker_class(mode):
+    return SimpleWorker if mode == 'simple' else Worker
+
+def warm():
+    """Import the task code and build the downloader engines before the first job"""
+    import tasks
+    from downloader import engine
+    try:
+        engine.warm()
+        tasks.playlist_extractor()
+    except Exception as e:
+        logger.warning('Could not warm the downloader engine: %s', e)
+
+def make_worker(queues, mode=WORKER_MODE):
+    """A worker that records a failed status for jobs whose work-horse dies"""
+    import tasks
+    return worker_class(mode)(queues, work_horse_killed_handler=tasks.work_horse_killed)
+
+def run_worker(queues, mode=WORKER_MODE):
+    """Run one RQ worker; each process needs its own Redis connection"""
+    warm()
+    with Connection(redis.from_url(redis_url)):
+        worker = make_worker(queues, mode)
         worker.work()
+
+def supervise(pool, mode=WORKER_MODE):
+    """Start the worker processes in `pool` and restart any that exit"""
+    processes = {}
+    stopping = False
+
+    def start(slot, queues):
+        process = multiprocessing.Process(target=run_worker, args=(queues, mode), daemon=False)
+        process.start()
+        processes[slot] = (process, queues)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        # RQ workers finish their current job on SIGTERM
+        for process, _ in processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for queues, count in pool:
+        for i in range(count):
+            start((tuple(queues), i), queues)
+    logger.info('Started %d workers: %s', len(processes),
+                ', '.join(f"{count}x {','.join(queues)}" for queues, count in pool))
+
+    while not stopping:
+        for slot, (process, queues) in list(processes.items()):
+            if not process.is_alive() and not stopping:
+                logger.warning('Worker for %s exited with code %s, restarting', ','.join(queues), process.exitcode)
+                start(slot, queues)
+        time.sleep(1)
+
+    for process, _ in processes.values():
+        process.join()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run RQ workers')
+    parser.add_argument('--pool', action='store_true',
+                        help='supervise the default and stage worker pools (see POOL)')
+    parser.add_argument('--queues', nargs='+', default=listen, help='queues to listen on')
+    parser.add_argument('--count', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--simple', action='store_const', const='simple', dest='mode', default=WORKER_MODE,
+                        help='run jobs in the worker process instead of a forked work-horse')
+    args = parser.parse_args()
+
+    if args.pool:
+        supervise(POOL, args.mode)
+    elif args.count > 1:
+        supervise([(args.queues, args.count)], args.mode)
+    else:
+        warm()
+        with Connection(conn):
+            worker = make_worker(args.queues, args.mode)
+            worker.work()